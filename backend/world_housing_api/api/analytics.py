@@ -0,0 +1,268 @@
+from django.db.models import (
+    Avg,
+    Case,
+    CharField,
+    Count,
+    DateField,
+    F,
+    FloatField,
+    OuterRef,
+    Subquery,
+    Value,
+    When,
+    Window
+)
+from django.db.models.expressions import ValueRange
+from django.db.models.functions import (
+    Cast,
+    Concat,
+    FirstValue,
+    LPad
+)
+from .models import (
+    CurrencyRate,
+    HousingData
+)
+from .registry import registry
+from .utils import (
+    DOLAR,
+    get_currency_date,
+    get_rates,
+    get_year_month
+)
+
+DEFAULT_ROLLING_WINDOW = 12
+MAX_ROLLING_WINDOW = 120
+
+
+def store_conversion_rates(queryset, currency: str):
+    """Makes sure the rates the prices of queryset not in currency are
+    converted with (see utils.get_currency_date()) are stored, downloading
+    the missing ones (see utils.get_rates()). Raises ValueError for unknown
+    currencies.
+    """
+    keys = set(queryset.exclude(currency=currency).values_list(
+        'period', 'currency').distinct())
+    if not keys:
+        return
+    get_rates(
+        set(stored_currency for _, stored_currency in keys) | {currency},
+        set(get_currency_date(*get_year_month(period)) for period, _ in keys)
+    )
+
+
+def get_next_month_expression():
+    """Returns the first day of the month after an entry's, as a date"""
+    is_december = When(month=12, then=Value(1))
+    year = Case(is_december, default=Value(0)) + F('year')
+    month = Case(is_december, default=F('month') + 1)
+    return Cast(
+        Concat(
+            Cast(year, CharField()),
+            Value('-'),
+            LPad(Cast(month, CharField()), 2, Value('0')),
+            Value('-01'),
+            output_field=CharField()
+        ),
+        DateField()
+    )
+
+
+def get_rate_expression(currency):
+    """Returns the stored rate of currency (a code, or an expression) as of
+    the next_month annotation of a HousingData queryset: the rate of the
+    last day of the month, or of the latest day stored for the current one.
+    """
+    if isinstance(currency, str):
+        if currency == DOLAR:
+            return Value(1.0)
+        currency = Value(currency)
+    rates = CurrencyRate.objects.filter(
+        currency=currency, date__lt=OuterRef('next_month')
+    ).order_by('-date').values('rate')[:1]
+    return Subquery(rates, output_field=FloatField())
+
+
+def get_price_expression(currency: str):
+    """Returns square_meter_price converted from its stored currency to
+    currency, with rates joined per month by get_rate_expression()
+    """
+    price = Cast('square_meter_price', FloatField())
+    return Case(
+        When(currency=currency, then=price),
+        default=price * get_rate_expression(currency) / Case(
+            When(currency=DOLAR, then=Value(1.0)),
+            default=get_rate_expression(OuterRef('currency')),
+        ),
+        output_field=FloatField()
+    )
+
+
+def get_analytics_queryset(
+        country_id: int,
+        state_ids: list,
+        first_period: int,
+        last_period: int,
+        window: int = DEFAULT_ROLLING_WINDOW,
+        currency: str = DOLAR):
+    """Returns (state_id, period, price, previous_price, previous_period,
+    rolling_mean, rolling_count) rows of a country's housing data up to
+    last_period, for state_ids (national data if empty), ordered by state and
+    period. Prices are converted to currency before the analytics are
+    computed (see get_price_expression()), as months may be stored in
+    different currencies. Raises ValueError for unknown currencies.
+
+    The analytics are computed in the DB with window functions partitioned by
+    state and framed by period values, so months missing from the DB are
+    left out of the frames instead of shifting them:
+
+    - previous_price and previous_period: price and period of the first
+      stored month among the 12 before each one, which is the same month a
+      year before if previous_period is 12 months behind
+    - rolling_mean and rolling_count: mean and number of the stored prices
+      of the window months up to each one
+
+    Rows start up to 12 (or window - 1) months before first_period, as the
+    lookback of the first months, and are left to the caller to skip: a
+    WHERE on period would also take them out of the frames.
+    """
+    lookback_period = first_period - max(12, window - 1)
+    queryset = HousingData.objects.filter(
+        country_id=country_id,
+        period__range=(lookback_period, last_period)
+    )
+    if state_ids:
+        queryset = queryset.filter(state_id__in=state_ids)
+    else:
+        queryset = queryset.filter(state_id__isnull=True)
+
+    partition = {
+        'partition_by': [F('state_id')],
+        'order_by': F('period').asc(),
+    }
+    currency = currency.lower()
+    store_conversion_rates(queryset, currency)
+    return queryset.annotate(
+        next_month=get_next_month_expression(),
+    ).annotate(
+        price=get_price_expression(currency),
+    ).annotate(
+        previous_price=Window(
+            FirstValue('price'),
+            frame=ValueRange(start=-12, end=0),
+            **partition
+        ),
+        previous_period=Window(
+            FirstValue('period'),
+            frame=ValueRange(start=-12, end=0),
+            **partition
+        ),
+        rolling_mean=Window(
+            Avg('price'),
+            frame=ValueRange(start=-(window - 1), end=0),
+            **partition
+        ),
+        rolling_count=Window(
+            Count('price'),
+            frame=ValueRange(start=-(window - 1), end=0),
+            **partition
+        ),
+    ).order_by('state_id', 'period')\
+        .values_list(
+            'state_id',
+            'period',
+            'price',
+            'previous_price',
+            'previous_period',
+            'rolling_mean',
+            'rolling_count',
+        )
+
+
+def get_cagr(first_price, first_period: int, last_price, last_period: int):
+    """Returns the compound annual growth rate of the price between two
+    months, or None if it can't be told.
+    """
+    if last_period <= first_period or not first_price or last_price is None:
+        return None
+    return (float(last_price) / float(first_price))\
+        ** (12 / (last_period - first_period)) - 1
+
+
+def represent_analytics_rows(rows: list, window: int, currency: str):
+    """Returns the analytics of a single state's get_analytics_queryset()
+    rows, as:
+
+    {
+        "currency": str,        # of the prices, e.g. 'brl'
+        "cagr": float,          # annualised square_meter_price growth
+        "monthly": {
+            "MM/YYYY": {
+                "yoy": float,           # square_meter_price change in 12
+                                        # months (E.g. 0.01 = 1%)
+                "rolling_mean": float,  # mean square_meter_price of the
+                                        # last window months, in currency
+            },
+            ...
+        }
+    }
+
+    Values that can't be told from the stored months are null.
+    """
+    monthly = {}
+    for state_id, period, price, previous_price, previous_period,\
+            rolling_mean, rolling_count in rows:
+        year, month = get_year_month(period)
+        monthly[f'{"{:02d}".format(month)}/{year}'] = {
+            'yoy': float(price) / float(previous_price) - 1
+            if previous_period == period - 12 and previous_price
+            and price is not None else None,
+            'rolling_mean': round(float(rolling_mean), 2)
+            if rolling_count == window else None,
+        }
+    return {
+        'currency': currency,
+        'cagr': get_cagr(rows[0][2], rows[0][1], rows[-1][2], rows[-1][1])
+        if rows else None,
+        'monthly': monthly,
+    }
+
+
+def get_housing_analytics(
+        country: str,
+        states: list,
+        first_period: int,
+        last_period: int,
+        window: int = DEFAULT_ROLLING_WINDOW,
+        currency: str = DOLAR):
+    """Returns the analytics of a country's housing data from first_period to
+    last_period (see represent_analytics_rows()), with prices in currency,
+    or {state: analytics} for states. States with no stored data in the
+    range are omitted; for national data, None is returned instead. Raises
+    ValueError for unknown currencies.
+    """
+    currency = currency.lower()
+    state_ids = registry.get_state_ids(country, states) if states else []
+    state_rows = {}
+    for row in get_analytics_queryset(
+            registry.get_country_id(country),
+            state_ids,
+            first_period,
+            last_period,
+            window,
+            currency):
+        if row[1] >= first_period:
+            state_rows.setdefault(row[0], []).append(row)
+
+    if not states:
+        rows = state_rows.get(None)
+        return represent_analytics_rows(rows, window, currency)\
+            if rows else None
+    return {
+        registry.get_state_abbreviation(state_id):
+        represent_analytics_rows(rows, window, currency)
+        for state_id, rows in sorted(
+            state_rows.items(),
+            key=lambda item: registry.get_state_abbreviation(item[0])
+        )
+    }
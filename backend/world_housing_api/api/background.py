@@ -0,0 +1,100 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger()
+
+FILL_STATUS_KEY = 'housing:fill:{token}'
+# seconds a fill's status can be polled for after it's queued
+FILL_STATUS_TIMEOUT = 60 * 60
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class BackgroundFills:
+    """Fills missing housing data in a pool of HOUSING_BACKGROUND_WORKERS
+    threads, so requests in stale-while-revalidate mode can be answered from
+    the DB right away.
+
+    Each fill gets a token whose status (pending, done or failed) is kept in
+    Django's cache, so it can be polled from any process if CACHES points to
+    a shared backend. Fills for the same country and keys already queued in
+    this process are not queued again, and concurrent fetches of the same
+    blocks are shared anyway (see api.singleflight).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    getattr(settings, 'HOUSING_BACKGROUND_WORKERS', 4),
+                    thread_name_prefix='housing-fill'
+                )
+            return self._executor
+
+    @staticmethod
+    def get_status(token: str):
+        """Returns the status of the fill with token, or None if unknown"""
+        return cache.get(FILL_STATUS_KEY.format(token=token))
+
+    @staticmethod
+    def set_status(token: str, status: str):
+        cache.set(
+            FILL_STATUS_KEY.format(token=token), status, FILL_STATUS_TIMEOUT)
+
+    def submit(self, provider, missing_keys: set):
+        """Queues provider.fill_missing_housing_data(missing_keys) and
+        returns the fill's token.
+        """
+        key = (provider.COUNTRY, frozenset(missing_keys))
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending[0]
+            token = uuid.uuid4().hex
+            self.set_status(token, PENDING)
+            self._pending[key] = (token, None)
+
+        future = self.get_executor().submit(
+            self.fill, provider, missing_keys, token, key)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = (token, future)
+        return token
+
+    def fill(self, provider, missing_keys: set, token: str, key: tuple):
+        try:
+            provider.fill_missing_housing_data(missing_keys)
+            self.set_status(token, DONE)
+        except Exception:
+            logger.exception(
+                f'Background fill of {provider.COUNTRY} housing data failed')
+            self.set_status(token, FAILED)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            # the worker thread's own connections
+            connections.close_all()
+
+    def wait(self, timeout: float = None):
+        """Waits for the fills queued in this process to finish"""
+        with self._lock:
+            futures = [
+                future for token, future in self._pending.values()
+                if future is not None
+            ]
+        for future in futures:
+            future.exception(timeout)
+
+
+background_fills = BackgroundFills()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+from django.core.cache import cache
+from django.utils.http import quote_etag
+from .models import Country
+from .serializers import CountrySerializer
+
+CATALOGUE_VERSION_KEY = 'housing:catalogue:version'
+CATALOGUE_KEY = 'housing:catalogue:{version}'
+
+
+class CatalogueCache:
+    """Rendered catalogue of countries and their states, served by
+    CountryView and CountryStateView.
+
+    The catalogue is built with two queries (countries, prefetched states)
+    and kept in the process and in Django's cache, shared between processes
+    if CACHES points to a shared backend. Both are keyed by a version number
+    stored in the shared cache, which api.signals bumps whenever a Country or
+    CountryState is saved or deleted, so every process rebuilds it on next
+    use.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._catalogue = None
+
+    @staticmethod
+    def get_version():
+        version = cache.get(CATALOGUE_VERSION_KEY)
+        if version is None:
+            # not 1, so a cache that lost the key doesn't go back to a
+            # version already used by stale entries
+            cache.add(CATALOGUE_VERSION_KEY, time.time_ns())
+            version = cache.get(CATALOGUE_VERSION_KEY)
+        return version
+
+    @staticmethod
+    def bump_version():
+        """Makes every process rebuild the catalogue on next use"""
+        try:
+            cache.incr(CATALOGUE_VERSION_KEY)
+        except ValueError:
+            cache.set(CATALOGUE_VERSION_KEY, time.time_ns(), None)
+
+    @staticmethod
+    def get_etag(data):
+        return quote_etag(hashlib.sha256(
+            json.dumps(data, sort_keys=True).encode()).hexdigest())
+
+    def build(self):
+        """Returns the catalogue as {'countries': (data, etag), 'states':
+        {base_uri: (data, etag)}}, with the data CountrySerializer and
+        CountryStateSerializer render.
+        """
+        countries = CountrySerializer(
+            Country.objects.prefetch_related('states'), many=True).data
+        countries = json.loads(json.dumps(countries))
+        return {
+            'countries': (countries, self.get_etag(countries)),
+            'states': {
+                country['base_uri']: (
+                    country['states'], self.get_etag(country['states']))
+                for country in countries
+            },
+        }
+
+    def get(self):
+        """Returns the current catalogue (see build())"""
+        version = self.get_version()
+        with self._lock:
+            if self._version == version:
+                return self._catalogue
+
+        catalogue_key = CATALOGUE_KEY.format(version=version)
+        catalogue = cache.get(catalogue_key)
+        if catalogue is None:
+            catalogue = self.build()
+            cache.set(catalogue_key, catalogue, None)
+
+        with self._lock:
+            self._version = version
+            self._catalogue = catalogue
+        return catalogue
+
+    def get_countries(self):
+        """Returns (data, etag) for all countries and their states"""
+        return self.get()['countries']
+
+    def get_country_states(self, country: str):
+        """Returns (data, etag) for a country's states, or None for unknown
+        countries.
+        """
+        return self.get()['states'].get(country)
+
+
+catalogue = CatalogueCache()
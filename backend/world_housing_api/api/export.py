@@ -0,0 +1,156 @@
+import csv
+import json
+from .models import (
+    Country,
+    HousingData
+)
+from .registry import registry
+from .serializers import (
+    square_meter_price_field,
+    variation_field
+)
+from .utils import get_period
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# columns of each exported row; state is empty for national data, and
+# prices are in currency, as stored
+EXPORT_FIELDS = (
+    'country',
+    'state',
+    'year',
+    'month',
+    'square_meter_price',
+    'currency',
+    'variation',
+)
+
+# rows fetched from the DB cursor at a time
+EXPORT_CHUNK_SIZE = 2000
+
+
+class _Echo:
+    """File-like object whose write() returns what it is given, so csv.writer
+    produces lines instead of buffering them.
+    """
+    def write(self, value):
+        return value
+
+
+def get_export_queryset(
+        countries: list = None,
+        states: list = None,
+        since: tuple = None,
+        until: tuple = None):
+    """Returns the HousingData rows to export as (country_id, state_id, year,
+    month, square_meter_price, currency, variation) tuples, ordered by
+    country, state and period.
+
+    countries are base_uris and states abbreviations (of any of the selected
+    countries), both all by default; since and until are (year, month)
+    pairs. With states, national data is left out. Raises ValueError for
+    unknown countries or states.
+
+    Rows are ordered like ix_country_state_period_hd and only read columns
+    it covers, so the export is a single index scan without joins or sorting.
+    """
+    queryset = HousingData.objects.all()
+    if countries:
+        try:
+            country_ids = [
+                registry.get_country_id(country) for country in countries]
+        except Country.DoesNotExist as e:
+            raise ValueError(str(e))
+        queryset = queryset.filter(country_id__in=country_ids)
+    else:
+        countries = registry.get_countries()
+
+    if states:
+        states = [state.lower() for state in states]
+        state_ids = [
+            state_id
+            for country in countries
+            for state_id in registry.get_state_ids(country, states)
+        ]
+        known_states = {
+            registry.get_state_abbreviation(state_id)
+            for state_id in state_ids
+        }
+        unknown_states = set(states) - known_states
+        if unknown_states:
+            raise ValueError(
+                f'Invalid states: {", ".join(sorted(unknown_states))}')
+        queryset = queryset.filter(state_id__in=state_ids)
+
+    if since is not None:
+        queryset = queryset.filter(period__gte=get_period(*since))
+    if until is not None:
+        queryset = queryset.filter(period__lte=get_period(*until))
+
+    return queryset.order_by('country_id', 'state_id', 'period').values_list(
+        'country_id',
+        'state_id',
+        'year',
+        'month',
+        'square_meter_price',
+        'currency',
+        'variation',
+    )
+
+
+def iter_export_rows(queryset):
+    """Yields a dict per row of a get_export_queryset() queryset, keyed by
+    EXPORT_FIELDS and with values represented like the API does. The
+    queryset is read with a server-side cursor, EXPORT_CHUNK_SIZE rows at a
+    time.
+    """
+    countries = {}
+    for country_id, state_id, year, month, price, currency, variation in\
+            queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        if country_id not in countries:
+            countries[country_id] = registry.get_country_base_uri(country_id)
+        yield {
+            'country': countries[country_id],
+            'state': registry.get_state_abbreviation(state_id)
+            if state_id is not None else '',
+            'year': year,
+            'month': month,
+            'square_meter_price':
+            square_meter_price_field.to_representation(price),
+            'currency': currency,
+            'variation': variation_field.to_representation(variation),
+        }
+
+
+def iter_csv(rows):
+    """Yields a CSV header line followed by a line per row"""
+    writer = csv.DictWriter(_Echo(), fieldnames=EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_ndjson(rows):
+    """Yields a JSON line per row"""
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def export_housing_data(export_format: str = 'csv', **filters):
+    """Returns an iterator over the lines of the housing data matching
+    filters (see get_export_queryset()) in export_format, one of
+    EXPORT_FORMATS. Rows are streamed from the DB, so memory use does not
+    depend on how many are exported.
+
+    Filters are validated right away, raising ValueError.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f'Format must be one of {", ".join(EXPORT_FORMATS)}')
+    rows = iter_export_rows(get_export_queryset(**filters))
+    if export_format == 'ndjson':
+        return iter_ndjson(rows)
+    return iter_csv(rows)
@@ -1,33 +1,316 @@
+import hashlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.http import (
+    parse_etags,
+    quote_etag
+)
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import NotAcceptable
 from rest_framework.generics import RetrieveAPIView
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .analytics import (
+    DEFAULT_ROLLING_WINDOW,
+    MAX_ROLLING_WINDOW,
+    get_housing_analytics
+)
 from .models import HousingData
+from .renderers import (
+    HOUSING_DATA_RANGE_RENDERER_CLASSES,
+    HOUSING_DATA_RENDERER_CLASSES
+)
 from .serializers import (
     HousingDataRangeSerializer,
     HousingDateStatesSerializer,
     HousingDataValuesSerializer,
     HousingDateStatesRangeSerializer,
 )
+from .metrics import timed
 from .mixins import HousingDataMixin
+from .utils import (
+    get_period,
+    get_year_month
+)
+
+
+class ConditionalHousingDataMixin:
+    """Adds HTTP conditional caching to housing data responses: a strong ETag
+    derived from the stored rows, 304 Not Modified for matching
+    If-None-Match headers, and a long Cache-Control max-age for complete
+    responses that end before the latest published month, which are not
+    expected to change anymore.
+    """
+    def get_housing_data_etag(
+            self, rows: list, is_single_entry=False, variations: dict = None):
+        """Returns a strong ETag for rows and the way they are rendered"""
+        digest = hashlib.sha256()
+        digest.update(self.get_serializer_class().__name__.encode())
+        digest.update(
+            getattr(self.request, 'accepted_media_type', '').encode())
+        digest.update(repr(rows[:1] if is_single_entry else rows).encode())
+        if variations is not None:
+            digest.update(repr(sorted(
+                variations.items(), key=lambda item: item[0] or '')).encode())
+        return quote_etag(digest.hexdigest())
+
+    def get_cache_max_age(self, rows: list):
+        """Returns the Cache-Control max-age for rows"""
+        year = self.kwargs.get('year')
+        month = self.kwargs.get('month')
+        final_year = self.kwargs.get('final_year', year)
+        final_month = self.kwargs.get('final_month', month)
+        states = self.kwargs.get('states')
+        requested_keys = self.get_requested_keys(
+            year=year,
+            month=month,
+            final_year=final_year,
+            final_month=final_month,
+            states=states.lower().split('-') if states is not None else [],
+        )
+
+        with timed('db'):
+            latest_period = self.get_latest_period()
+        if len(rows) == len(requested_keys) and latest_period is not None\
+                and get_period(final_year, final_month) < latest_period:
+            return getattr(settings, 'HOUSING_CACHE_MAX_AGE', 2592000)
+        return getattr(settings, 'HOUSING_RECENT_CACHE_MAX_AGE', 300)
+
+    def get_housing_data_response(
+            self, rows: list, is_single_entry=False, variations: dict = None):
+        # converted first, so the ETag changes with the currency and rates
+        rows = self.get_converted_rows(rows)
+        if isinstance(rows, Response):
+            return rows
+        with timed('serialize'):
+            etag = self.get_housing_data_etag(
+                rows, is_single_entry, variations)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={self.get_cache_max_age(rows)}',
+            # the format depends on it (see api.renderers)
+            'Vary': 'Accept',
+        }
 
+        if_none_match = parse_etags(
+            self.request.headers.get('If-None-Match', ''))
+        if '*' in if_none_match or etag in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers=headers)
 
-class RetrieveHousingDataAPIView(HousingDataMixin, RetrieveAPIView):
+        response = super().get_housing_data_response(
+            rows, is_single_entry, variations)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+
+class RetrieveHousingDataAPIView(
+        ConditionalHousingDataMixin, HousingDataMixin, RetrieveAPIView):
     queryset = HousingData.objects.all()
     serializer_class = HousingDataValuesSerializer
+    renderer_classes = HOUSING_DATA_RENDERER_CLASSES
 
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(
             request, *args, is_single_entry=True, **kwargs)
 
 
-class RetrieveHousingDataRangeAPIView(HousingDataMixin, RetrieveAPIView):
+class RetrieveHousingDataRangeAPIView(
+        ConditionalHousingDataMixin, HousingDataMixin, RetrieveAPIView):
     queryset = HousingData.objects.all()
     serializer_class = HousingDataRangeSerializer
+    renderer_classes = HOUSING_DATA_RANGE_RENDERER_CLASSES
 
 
-class RetrieveHousingDataStatesAPIView(HousingDataMixin, RetrieveAPIView):
+class RetrieveHousingDataStatesAPIView(
+        ConditionalHousingDataMixin, HousingDataMixin, RetrieveAPIView):
     queryset = HousingData.objects.all()
     serializer_class = HousingDateStatesSerializer
+    renderer_classes = HOUSING_DATA_RENDERER_CLASSES
 
 
-class RetrieveHousingDataStatesRangeAPIView(HousingDataMixin, RetrieveAPIView):
+class RetrieveHousingDataStatesRangeAPIView(
+        ConditionalHousingDataMixin, HousingDataMixin, RetrieveAPIView):
     queryset = HousingData.objects.all()
     serializer_class = HousingDateStatesRangeSerializer
+    renderer_classes = HOUSING_DATA_RANGE_RENDERER_CLASSES
+
+
+class RetrieveHousingDataAnalyticsAPIView(HousingDataMixin, APIView):
+    """Year-over-year change, rolling mean (of ?window= months, 12 by
+    default) and annualised growth of square_meter_price over a range, for
+    the country or its states (see api.analytics), with prices in
+    ?currency= (HOUSING_DEFAULT_CURRENCY by default). Computed in the DB, so
+    clients get compact series instead of the monthly data.
+    """
+    def get(self, request, *args, **kwargs):
+        year = kwargs.get('year')
+        month = kwargs.get('month')
+        final_year = kwargs.get('final_year')
+        final_month = kwargs.get('final_month')
+        states = kwargs.get('states')
+        states = states.lower().split('-') if states is not None else []
+
+        try:
+            window = int(request.query_params.get(
+                'window', DEFAULT_ROLLING_WINDOW))
+        except ValueError:
+            window = 0
+        if not 1 <= window <= MAX_ROLLING_WINDOW:
+            return Response(
+                f'Window must be between 1 and {MAX_ROLLING_WINDOW} months',
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            currency = self.get_requested_currency()
+        except ValueError as e:
+            return Response(str(e), status.HTTP_400_BAD_REQUEST)
+
+        error = self.check_housing_data_request(
+            year, month, final_year, final_month)
+        if error is not None:
+            return error
+
+        # make sure the range and the months the analytics look back on are
+        # stored, as the range endpoints would
+        first_period = get_period(year, month)
+        lookback_year, lookback_month = get_year_month(
+            first_period - max(12, window - 1))
+        instances = self.get_housing_data(
+            year=lookback_year,
+            month=lookback_month,
+            final_year=final_year,
+            final_month=final_month,
+            states=states,
+        )
+        if isinstance(instances, Response):
+            return instances
+
+        try:
+            analytics = get_housing_analytics(
+                self.COUNTRY,
+                states,
+                first_period,
+                get_period(final_year, final_month),
+                window,
+                currency
+            )
+        except ValueError as e:
+            return Response(str(e), status.HTTP_400_BAD_REQUEST)
+        if not analytics:
+            return Response(
+                'Housing data not found',
+                status.HTTP_404_NOT_FOUND
+            )
+        return Response(analytics)
+
+
+class AsyncRetrieveHousingDataBaseView(
+        ConditionalHousingDataMixin, HousingDataMixin, View):
+    """Async counterpart of the RetrieveHousingData*APIView generics, for ASGI
+    deployments (see HOUSING_ASYNC_VIEWS). Upstream I/O goes through
+    aget_housing_data(), so a slow remote doesn't block a worker, and
+    responses are rendered with the formats their DRF counterparts
+    negotiate.
+    """
+    serializer_class = None
+    renderer_classes = HOUSING_DATA_RENDERER_CLASSES
+    is_single_entry = False
+
+    def get_serializer_class(self):
+        return self.serializer_class
+
+    def negotiate_renderer(self, request):
+        """Sets request.accepted_renderer and accepted_media_type, as DRF
+        views do, leaving the browsable API out since this is not a DRF view.
+        Returns a 406 Response if no renderer is acceptable.
+        """
+        renderers = [
+            renderer() for renderer in self.renderer_classes
+            if not issubclass(renderer, BrowsableAPIRenderer)
+        ]
+        try:
+            request.accepted_renderer, request.accepted_media_type =\
+                DefaultContentNegotiation().select_renderer(
+                    Request(request), renderers)
+        except NotAcceptable as e:
+            request.accepted_renderer = renderers[0]
+            request.accepted_media_type = renderers[0].media_type
+            return Response(
+                {'detail': e.detail}, status.HTTP_406_NOT_ACCEPTABLE)
+        return None
+
+    def render_response(self, response: Response):
+        response.accepted_renderer = self.request.accepted_renderer
+        response.accepted_media_type = self.request.accepted_media_type
+        response.renderer_context = {
+            'view': self, 'request': self.request, 'response': response}
+        return response.render()
+
+    async def get(self, request, *args, **kwargs):
+        error = self.negotiate_renderer(request)
+        if error is not None:
+            return self.render_response(error)
+        states = kwargs.get('states')
+        if states is not None:
+            states = states.lower().split('-')
+        response = await sync_to_async(self.retrieve_paginated)(
+            request, **{**kwargs, 'states': states})
+        if response is not None:
+            return self.render_response(response)
+        if self.prefers_respond_async(request):
+            response = await sync_to_async(self.retrieve_stale)(
+                request, *args, is_single_entry=self.is_single_entry,
+                **{**kwargs, 'states': states})
+            return self.render_response(response)
+        instances = await self.aget_housing_data(
+            year=kwargs.get('year'),
+            month=kwargs.get('month'),
+            final_year=kwargs.get('final_year'),
+            final_month=kwargs.get('final_month'),
+            states=states,
+        )
+        if isinstance(instances, Response):
+            return self.render_response(instances)
+        with timed('db'):
+            rows = await sync_to_async(self.get_housing_data_rows)(instances)
+        if not rows:
+            return self.render_response(Response(
+                'Housing data not found',
+                status.HTTP_404_NOT_FOUND
+            ))
+        # converted here so missing rates are downloaded concurrently, which
+        # leaves nothing for get_housing_data_response() to convert
+        rows = await self.aget_converted_rows(rows)
+        if isinstance(rows, Response):
+            return self.render_response(rows)
+        response = await sync_to_async(self.get_housing_data_response)(
+            rows, self.is_single_entry)
+        with timed('serialize'):
+            return self.render_response(response)
+
+
+class AsyncRetrieveHousingDataAPIView(AsyncRetrieveHousingDataBaseView):
+    serializer_class = HousingDataValuesSerializer
+    is_single_entry = True
+
+
+class AsyncRetrieveHousingDataRangeAPIView(AsyncRetrieveHousingDataBaseView):
+    serializer_class = HousingDataRangeSerializer
+    renderer_classes = HOUSING_DATA_RANGE_RENDERER_CLASSES
+
+
+class AsyncRetrieveHousingDataStatesAPIView(AsyncRetrieveHousingDataBaseView):
+    serializer_class = HousingDateStatesSerializer
+
+
+class AsyncRetrieveHousingDataStatesRangeAPIView(
+        AsyncRetrieveHousingDataBaseView):
+    serializer_class = HousingDateStatesRangeSerializer
+    renderer_classes = HOUSING_DATA_RANGE_RENDERER_CLASSES
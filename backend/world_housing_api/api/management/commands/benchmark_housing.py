@@ -0,0 +1,122 @@
+import json
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from api.sync import parse_year_month
+from benchmarks.runner import (
+    ENDPOINTS,
+    SCENARIOS,
+    BenchmarkRunner,
+    compare_results
+)
+
+
+def parse_int_list(value: str):
+    return tuple(int(item) for item in value.split(','))
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the Brazil housing data endpoints against local '\
+           'stand-ins for the IBGE and currency APIs, on a throwaway DB, '\
+           'and writes the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', '-o', default='benchmark.json',
+            help='File to write the results to (default: benchmark.json)')
+        parser.add_argument(
+            '--compare',
+            help='Results file of a previous run to compare latencies with')
+        parser.add_argument(
+            '--scenario', action='append', dest='scenarios',
+            choices=SCENARIOS,
+            help='Scenario to run (repeatable, all by default)')
+        parser.add_argument(
+            '--endpoint', action='append', dest='endpoints',
+            choices=ENDPOINTS,
+            help='Endpoint to benchmark (repeatable, all by default)')
+        parser.add_argument(
+            '--requests', type=int, default=50,
+            help='Requests per case (default: 50)')
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help='Concurrent requests, except for cold cases (default: 1)')
+        parser.add_argument(
+            '--states', type=parse_int_list, default=(1, 5, 27),
+            help='Comma-separated state counts (default: 1,5,27)')
+        parser.add_argument(
+            '--months', type=parse_int_list, default=(12, 60),
+            help='Comma-separated range lengths in months (default: 12,60)')
+        parser.add_argument(
+            '--until', default='2024-06',
+            help='Last month requested and published, as YYYY-MM '
+                 '(default: 2024-06)')
+        parser.add_argument(
+            '--latency', type=float, default=50,
+            help='Remote API latency in ms (default: 50)')
+        parser.add_argument(
+            '--jitter', type=float, default=0,
+            help='Extra random remote API latency, up to this many ms '
+                 '(default: 0)')
+        parser.add_argument(
+            '--miss-ratio', type=float, default=0.2,
+            help='Chance of a mixed request missing data (default: 0.2)')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed for the mixed scenario (default: 0)')
+
+    def handle(self, *args, **options):
+        try:
+            until = parse_year_month(options['until'])
+        except ValueError:
+            raise CommandError('Months must be formatted as YYYY-MM')
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('Requests and concurrency must be positive')
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        runner = BenchmarkRunner(
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            state_counts=options['states'],
+            range_months=options['months'],
+            until=until,
+            latency=options['latency'] / 1000,
+            jitter=options['jitter'] / 1000,
+            miss_ratio=options['miss_ratio'],
+            seed=options['seed'],
+            log=lambda message: self.stderr.write(message),
+        )
+        results = runner.run(
+            scenarios=options['scenarios'] or SCENARIOS,
+            endpoints=options['endpoints'] or ENDPOINTS,
+        )
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+
+        for result in results['results']:
+            self.stdout.write(
+                f'{result["scenario"]:<6} {result["endpoint"]:<13}'
+                f'states={result["states"] or "-":<3} '
+                f'months={result["months"] or "-":<3} '
+                f'p50={result["p50_ms"]:8.1f}ms '
+                f'p95={result["p95_ms"]:8.1f}ms '
+                f'p99={result["p99_ms"]:8.1f}ms '
+                f'{result["throughput_rps"]:8.1f} req/s'
+            )
+        self.stdout.write(f'Results written to {options["output"]}')
+
+        if baseline is not None:
+            self.stdout.write(f'Compared with {options["compare"]}:')
+            for case, metric, before, after, ratio in compare_results(
+                    baseline, results):
+                if ratio is None:
+                    continue
+                self.stdout.write(
+                    f'{" ".join(str(item or "-") for item in case)} '
+                    f'{metric}: {before:.1f} -> {after:.1f} ({ratio:.2f}x)'
+                )
@@ -0,0 +1,60 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from api.export import (
+    EXPORT_FORMATS,
+    export_housing_data
+)
+from api.sync import parse_year_month
+
+
+class Command(BaseCommand):
+    help = 'Streams stored housing data as CSV or NDJSON, to stdout or a file'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', default='csv', choices=list(EXPORT_FORMATS),
+            dest='export_format', help='Output format (default: csv)')
+        parser.add_argument(
+            '--country', action='append', dest='countries',
+            help='Country base_uri to export (repeatable, all by default)')
+        parser.add_argument(
+            '--state', action='append', dest='states',
+            help='State abbreviation to export (repeatable, all by default)')
+        parser.add_argument(
+            '--since', help='First month to export, as YYYY-MM')
+        parser.add_argument(
+            '--until', help='Last month to export, as YYYY-MM')
+        parser.add_argument(
+            '--output', '-o',
+            help='File to write to (default: stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            since = until = None
+            if options['since']:
+                since = parse_year_month(options['since'])
+            if options['until']:
+                until = parse_year_month(options['until'])
+        except ValueError:
+            raise CommandError('Months must be formatted as YYYY-MM')
+
+        try:
+            lines = export_housing_data(
+                options['export_format'],
+                countries=options['countries'],
+                states=options['states'],
+                since=since,
+                until=until,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+            return
+
+        for line in lines:
+            self.stdout.write(line, ending='')
@@ -0,0 +1,49 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from api.sync import (
+    parse_year_month,
+    sync_housing_data
+)
+
+
+class Command(BaseCommand):
+    help = 'Fetches housing data from every country provider and stores it, '\
+           'so requests are served from the DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--country', action='append', dest='countries',
+            help='Country base_uri to sync (repeatable, all by default)')
+        parser.add_argument(
+            '--since', default='2000-01',
+            help='First month to sync, as YYYY-MM (default: 2000-01)')
+        parser.add_argument(
+            '--until',
+            help='Last month to sync, as YYYY-MM (default: current month)')
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only fetch months after the latest one stored')
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_year_month(options['since'])
+            until = None
+            if options['until']:
+                until = parse_year_month(options['until'])
+        except ValueError:
+            raise CommandError('Months must be formatted as YYYY-MM')
+
+        try:
+            saved_entries = sync_housing_data(
+                countries=options['countries'],
+                since=since,
+                until=until,
+                incremental=options['incremental'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for country, count in saved_entries.items():
+            self.stdout.write(f'{country}: {count} entries saved')
@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# seconds, from a DB hit to a slow multi-month remote fill
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30,
+)
+
+
+def format_labels(label_names: tuple, label_values: tuple):
+    if not label_names:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for name, value in zip(label_names, label_values)
+    )
+    return f'{{{labels}}}'
+
+
+class Counter:
+    """Prometheus counter, by label values"""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}_total{format_labels(self.label_names, key)} '\
+                  f'{value}'
+
+
+class Histogram:
+    """Prometheus histogram, by label values"""
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def collect(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()
+            }
+        label_names = self.label_names + ('le',)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative_count = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative_count += count
+                bucket = '+Inf' if bucket == math.inf else repr(bucket)
+                yield f'{self.name}_bucket'\
+                      f'{format_labels(label_names, key + (bucket,))} '\
+                      f'{cumulative_count}'
+            labels = format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {cumulative_count}'
+
+
+class MetricsRegistry:
+    """In-process metrics, rendered in the Prometheus text format by the
+    /metrics endpoint. Each process exposes its own.
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+request_duration = metrics.register(Histogram(
+    'housing_request_duration_seconds',
+    'Time to serve API requests',
+    ('endpoint', 'country', 'status'),
+))
+phase_duration = metrics.register(Histogram(
+    'housing_phase_duration_seconds',
+    'Time spent per request on each phase (db, remote, fx, serialize and '
+    'each upstream)',
+    ('phase', 'country'),
+))
+upstream_duration = metrics.register(Histogram(
+    'housing_upstream_request_duration_seconds',
+    'Time of each call to an upstream API, retries included',
+    ('upstream',),
+))
+upstream_retries = metrics.register(Counter(
+    'housing_upstream_retries',
+    'Retried attempts of calls to upstream APIs',
+    ('upstream',),
+))
+upstream_failures = metrics.register(Counter(
+    'housing_upstream_failures',
+    'Calls to upstream APIs that failed after their retries, with an error '
+    'or a 4xx/5xx response',
+    ('upstream',),
+))
+housing_data_keys = metrics.register(Counter(
+    'housing_data_keys',
+    'Requested housing data months by where they were found: db, remote '
+    'when they had to be fetched, or unpublished when known not to be '
+    'published yet, and not fetched',
+    ('country', 'source'),
+))
+
+
+class RequestTimings:
+    """Durations of each phase of the request being served"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+
+    def add(self, phase: str, seconds: float):
+        with self._lock:
+            self.durations[phase] = self.durations.get(phase, 0) + seconds
+
+    def get_server_timing(self, total_seconds: float):
+        """Returns the Server-Timing header value, in milliseconds"""
+        with self._lock:
+            durations = dict(self.durations)
+        durations['total'] = total_seconds
+        return ', '.join(
+            f'{phase};dur={seconds * 1000:.1f}'
+            for phase, seconds in durations.items()
+        )
+
+
+_request_timings = ContextVar('housing_request_timings', default=None)
+
+
+def start_request_timings():
+    """Starts collecting phase timings for the current request. Returns a
+    token for stop_request_timings().
+    """
+    return _request_timings.set(RequestTimings())
+
+
+def stop_request_timings(token):
+    """Stops collecting phase timings and returns them"""
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    return timings
+
+
+def get_request_timings():
+    """Returns the RequestTimings of the request being served, or None"""
+    return _request_timings.get()
+
+
+@contextmanager
+def timed(phase: str):
+    """Adds the time spent in the block to phase of the current request, if
+    any. Works around awaits too, and phases may nest (e.g. an upstream call
+    within remote).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(phase, time.perf_counter() - start)
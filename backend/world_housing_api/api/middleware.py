@@ -0,0 +1,96 @@
+import time
+from asgiref.sync import (
+    iscoroutinefunction,
+    markcoroutinefunction
+)
+from .metrics import (
+    phase_duration,
+    request_duration,
+    start_request_timings,
+    stop_request_timings
+)
+from .routers import read_only_request
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ServerTimingMiddleware:
+    """Times each request and the phases instrumented with
+    api.metrics.timed() while serving it. Adds them to the response's
+    Server-Timing header, in milliseconds, and to the request and phase
+    histograms served by /metrics, labelled with the view's country.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        token = start_request_timings()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = stop_request_timings(token)
+        return self.process_timings(request, response, timings, start)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        token = start_request_timings()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timings = stop_request_timings(token)
+        return self.process_timings(request, response, timings, start)
+
+    @staticmethod
+    def process_timings(request, response, timings, start: float):
+        total_seconds = time.perf_counter() - start
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_class = getattr(resolver_match, 'func', None)
+        country = getattr(
+            getattr(view_class, 'view_class', None), 'COUNTRY', None)\
+            or getattr(resolver_match, 'kwargs', {}).get('country', '')
+
+        request_duration.observe(
+            total_seconds,
+            endpoint=resolver_match.route if resolver_match else '',
+            country=country,
+            status=response.status_code,
+        )
+        for phase, seconds in timings.durations.items():
+            phase_duration.observe(seconds, phase=phase, country=country)
+        response['Server-Timing'] = timings.get_server_timing(total_seconds)
+        return response
+
+
+class ReadOnlyRequestMiddleware:
+    """Marks GET, HEAD and OPTIONS requests as read-only, so their reads go
+    to the read-only DB alias (see api.routers.ReadOnlyRouter).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if request.method not in READ_ONLY_METHODS:
+            return self.get_response(request)
+        with read_only_request():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if request.method not in READ_ONLY_METHODS:
+            return await self.get_response(request)
+        with read_only_request():
+            return await self.get_response(request)
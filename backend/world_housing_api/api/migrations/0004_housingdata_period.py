@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+def backfill_period(apps, schema_editor):
+    HousingData = apps.get_model('api', 'HousingData')
+    HousingData.objects.update(
+        period=models.F('year') * 12 + models.F('month') - 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_currencyrate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='housingdata',
+            name='period',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_period, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='housingdata',
+            name='period',
+            field=models.IntegerField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='housingdata',
+            index=models.Index(fields=['country', 'state', 'period', 'year', 'month', 'square_meter_price', 'variation'], name='ix_country_state_period_hd'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:10
+
+import math
+from django.db import migrations, models
+
+
+def backfill_cumulative_log_growth(apps, schema_editor):
+    HousingData = apps.get_model('api', 'HousingData')
+    updated_entries = []
+    cumulative_log_growth = None
+    previous_key = None
+    for entry_id, country_id, state_id, variation in\
+            HousingData.objects.order_by('country', 'state', 'period')\
+            .values_list('id', 'country_id', 'state_id', 'variation')\
+            .iterator():
+        if (country_id, state_id) != previous_key:
+            previous_key = (country_id, state_id)
+            cumulative_log_growth = 0.0
+        if cumulative_log_growth is not None and variation > -1:
+            cumulative_log_growth += math.log1p(float(variation))
+        else:
+            cumulative_log_growth = None
+        updated_entries.append(HousingData(
+            id=entry_id, cumulative_log_growth=cumulative_log_growth))
+    HousingData.objects.bulk_update(
+        updated_entries, ['cumulative_log_growth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_housingdata_period'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='housingdata',
+            name='ix_country_state_period_hd',
+        ),
+        migrations.AddField(
+            model_name='housingdata',
+            name='cumulative_log_growth',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.RunPython(
+            backfill_cumulative_log_growth, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='housingdata',
+            index=models.Index(fields=['country', 'state', 'period', 'year', 'month', 'square_meter_price', 'variation', 'cumulative_log_growth'], name='ix_country_state_period_hd'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_housingdata_cumulative_log_growth'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='housingdata',
+            name='ix_country_state_period_hd',
+        ),
+        migrations.AddField(
+            model_name='housingdata',
+            name='currency',
+            field=models.CharField(default='usd', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='housingdata',
+            index=models.Index(fields=['country', 'state', 'period', 'year', 'month', 'square_meter_price', 'currency', 'variation', 'cumulative_log_growth'], name='ix_country_state_period_hd'),
+        ),
+    ]
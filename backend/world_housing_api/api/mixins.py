@@ -1,16 +1,49 @@
-from datetime import (
-    datetime,
-    timedelta
+import asyncio
+import base64
+from asgiref.sync import sync_to_async
+from decimal import Decimal
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    Max,
+    Q,
+    QuerySet
 )
-from django.db.models import Q
 from rest_framework import status
 from rest_framework.response import Response
-from .models import (
-    Country,
-    CountryState,
-    HousingData
+from rest_framework.utils.urls import replace_query_param
+from .background import background_fills
+from .metrics import (
+    housing_data_keys,
+    timed
+)
+from .models import HousingData
+from .registry import registry
+from .renderers import is_columnar
+from .serializers import (
+    HOUSING_DATA_ROW_FIELDS,
+    HousingDataRangeSerializer,
+    HousingDataValuesSerializer,
+    HousingDateStatesRangeSerializer,
+    HousingDateStatesSerializer
+)
+from .singleflight import single_flight
+from .unpublished import unpublished
+from .utils import (
+    DOLAR,
+    aget_rates,
+    get_conversion_factor,
+    get_currency_date,
+    get_period,
+    get_range_variation,
+    get_rates,
+    get_year_month,
+    update_cumulative_log_growth
 )
-from .utils import convert_to_dolar
+
+# prices are quantized like HousingData.square_meter_price once converted
+PRICE_QUANTUM = Decimal('0.01')
 
 
 class HousingDataMixin:
@@ -18,6 +51,22 @@ class HousingDataMixin:
     remote or any (DB-first).
     """
     COUNTRY = 'undefined'
+    # currency prices are published in
+    CURRENCY = DOLAR
+    INGEST_BATCH_SIZE = 500
+
+    # Prefer header value opting into stale-while-revalidate responses
+    RESPOND_ASYNC = 'respond-async'
+
+    # country base_uri -> the class that implements it (see api.sync)
+    PROVIDERS = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # register each country's implementation, not views built on it
+        if 'COUNTRY' in cls.__dict__:
+            HousingDataMixin.PROVIDERS[cls.COUNTRY] = cls
+
     def get_housing_data_from_remote(
             self,
             year: int,
@@ -33,24 +82,59 @@ class HousingDataMixin:
                 "year": int,
                 "month": int,
                 "square_meter_price": float,
+                "currency": str,  # e.g. 'brl', dolar if omitted
                 "variation": float,
                 "state_id": CountryState.id | null
             },
             ...
         ]
 
+        Prices are kept in the currency they are published in, and only
+        converted when read (see convert_housing_data_rows()).
+
         In case of error, an error can be raised or a falsey value is returned.
+        Months not published yet are left out; if none of the requested ones
+        are, an empty list is returned, so they are remembered as unpublished
+        (see api.unpublished) rather than taken as an error.
         """
         raise NotImplementedError(
             "get_housing_data_from_remote() must be implemented"
         )
 
 
+    async def aget_housing_data_from_remote(
+            self,
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = []):
+        """Async version of get_housing_data_from_remote(). Countries can
+        override it with native async I/O; by default, the sync method runs in
+        a worker thread.
+        """
+        return await sync_to_async(
+            self.get_housing_data_from_remote, thread_sensitive=False)(
+                year=year,
+                month=month,
+                final_year=final_year,
+                final_month=final_month,
+                states=states
+            )
+
     def retrieve(
             self, request, *args, is_single_entry: bool = False, **kwargs):
         states = kwargs.get('states')
         if states is not None:
             states = states.lower().split('-')
+        response = self.retrieve_paginated(
+            request, **{**kwargs, 'states': states})
+        if response is not None:
+            return response
+        if self.prefers_respond_async(request):
+            return self.retrieve_stale(
+                request, *args, is_single_entry=is_single_entry,
+                **{**kwargs, 'states': states})
         instances = self.get_housing_data(
             year=kwargs.get('year'),
             month=kwargs.get('month'),
@@ -60,15 +144,357 @@ class HousingDataMixin:
         )
         if isinstance(instances, Response):
             return instances
-        if not instances:
+        with timed('db'):
+            rows = self.get_housing_data_rows(instances)
+        if not rows:
+            return Response(
+                'Housing data not found',
+                status.HTTP_404_NOT_FOUND
+            )
+        return self.get_housing_data_response(rows, is_single_entry)
+
+    def retrieve_stale(
+            self, request, *args, is_single_entry: bool = False, **kwargs):
+        """Stale-while-revalidate version of retrieve(): answers with the
+        stored data right away, while the missing months are filled in the
+        background (see get_stored_housing_data_and_fill()).
+        """
+        result = self.get_stored_housing_data_and_fill(
+            year=kwargs.get('year'),
+            month=kwargs.get('month'),
+            final_year=kwargs.get('final_year'),
+            final_month=kwargs.get('final_month'),
+            states=kwargs.get('states'),
+        )
+        if isinstance(result, Response):
+            return result
+        rows, missing_keys, token = result
+        return self.get_stale_housing_data_response(
+            rows, missing_keys, token, is_single_entry)
+
+    @staticmethod
+    def get_key_order(key: tuple):
+        """Sort key of (period, state) keys: by state, then period, as rows
+        are ordered
+        """
+        period, state = key
+        return state or '', period
+
+    @staticmethod
+    def encode_cursor(key: tuple):
+        period, state = key
+        return base64.urlsafe_b64encode(
+            f'{state or ""}:{period}'.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        """Returns the (period, state) key of a cursor from
+        encode_cursor(), or raises ValueError
+        """
+        try:
+            state, period = base64.urlsafe_b64decode(
+                cursor.encode()).decode().split(':')
+            return int(period), state or None
+        except ValueError:
+            raise ValueError('Invalid cursor')
+
+    def get_pagination(
+            self,
+            request,
+            year: int,
+            month: int,
+            final_year: int,
+            final_month: int,
+            states: list = []):
+        """Returns (cursor key, page size) if a range request is to be
+        paginated: when asked to with ?cursor= or ?page_size=, or when it
+        spans more than HOUSING_MAX_PAGE_SIZE (period, state) keys. Returns
+        None otherwise, or an error Response for invalid parameters.
+        """
+        max_page_size = getattr(settings, 'HOUSING_MAX_PAGE_SIZE', 5000)
+        cursor = request.GET.get('cursor')
+        page_size = request.GET.get('page_size')
+        if cursor is None and page_size is None:
+            error = self.check_housing_data_request(
+                year, month, final_year, final_month)
+            if error is not None:
+                return error
+            key_count = (get_period(final_year, final_month)
+                         - get_period(year, month) + 1) * len(states or [None])
+            if key_count <= max_page_size:
+                return None
+
+        try:
+            page_size = int(page_size or max_page_size)
+        except ValueError:
+            page_size = 0
+        if not 1 <= page_size <= max_page_size:
+            return Response(
+                f'Page size must be between 1 and {max_page_size}',
+                status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            cursor = self.decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return Response(str(e), status.HTTP_400_BAD_REQUEST)
+        return cursor, page_size
+
+    def retrieve_paginated(self, request, **kwargs):
+        """Returns a page from retrieve_page() for range requests to be
+        paginated (see get_pagination()), an error Response, or None.
+        """
+        states = kwargs.get('states')
+        if kwargs.get('final_year') is None\
+                or kwargs.get('final_month') is None:
+            return None
+        pagination = self.get_pagination(
+            request,
+            kwargs['year'],
+            kwargs['month'],
+            kwargs['final_year'],
+            kwargs['final_month'],
+            states
+        )
+        if pagination is None or isinstance(pagination, Response):
+            return pagination
+        return self.retrieve_page(
+            request,
+            kwargs['year'],
+            kwargs['month'],
+            kwargs['final_year'],
+            kwargs['final_month'],
+            states or [],
+            *pagination
+        )
+
+    def retrieve_page(
+            self,
+            request,
+            year: int,
+            month: int,
+            final_year: int,
+            final_month: int,
+            states: list,
+            cursor: tuple,
+            page_size: int):
+        """Paginated version of retrieve() for range requests (see
+        get_pagination()). A page holds the page_size (period, state) keys,
+        in (state, period) order, after the cursor one, and links to the next
+        page in a Link header.
+
+        The page's states are stored over the whole range, so their variation
+        is the one for the whole range, read from cumulative_log_growth (see
+        get_range_variations()). So pages only store and read at most
+        page_size keys plus the two states they may share with their
+        neighbours, however large the range is.
+        """
+        error = self.check_housing_data_request(
+            year, month, final_year, final_month)
+        if error is not None:
+            return error
+
+        requested_keys = sorted(
+            self.get_requested_keys(
+                year, month, final_year, final_month, states),
+            key=self.get_key_order
+        )
+        if cursor is not None:
+            requested_keys = [
+                key for key in requested_keys
+                if self.get_key_order(key)
+                > self.get_key_order(cursor)
+            ]
+        page_keys = requested_keys[:page_size]
+        page_states = sorted(set(
+            state for period, state in page_keys if state is not None))
+
+        rows = []
+        variations = {}
+        if page_keys:
+            _, missing_keys = self.get_stored_housing_data(
+                year, month, final_year, final_month, page_states)
+            if missing_keys:
+                self.fill_missing_housing_data(missing_keys)
+
+            # each state's periods in the page are contiguous
+            segments_filter = Q(pk__in=[])
+            for state in page_states or [None]:
+                periods = [
+                    period for period, key_state in page_keys
+                    if key_state == state
+                ]
+                segments_filter |= Q(
+                    state_id=registry.get_state_id(self.COUNTRY, state)
+                    if state is not None else None,
+                    period__range=(min(periods), max(periods))
+                )
+            with timed('db'):
+                rows = list(HousingData.objects.filter(
+                        country_id=registry.get_country_id(self.COUNTRY)
+                    ).filter(segments_filter)
+                    .order_by('state__abbreviation', 'period')
+                    .values_list(*HOUSING_DATA_ROW_FIELDS))
+                variations = self.get_range_variations(
+                    year, month, final_year, final_month, page_states)
+
+        next_cursor = None
+        if len(requested_keys) > page_size:
+            next_cursor = self.encode_cursor(page_keys[-1])
+        if not rows and next_cursor is None:
             return Response(
                 'Housing data not found',
                 status.HTTP_404_NOT_FOUND
             )
-        if is_single_entry:
-            instances = instances[0]
-        serializer = self.get_serializer(instances)
-        return Response(serializer.data)
+
+        response = self.get_housing_data_response(rows, variations=variations)
+        if next_cursor is not None:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor', next_cursor)
+            response['Link'] = f'<{next_url}>; rel="next"'
+        return response
+
+    @classmethod
+    def prefers_respond_async(cls, request):
+        """Whether the request opted into stale-while-revalidate responses
+        with a 'Prefer: respond-async' header (RFC 7240)
+        """
+        return cls.RESPOND_ASYNC in (
+            preference.strip().split(';')[0].strip().lower()
+            for preference in request.headers.get('Prefer', '').split(',')
+        )
+
+    @staticmethod
+    def get_missing_periods(missing_keys: set):
+        """Returns the distinct months of missing (period, state) keys, as
+        sorted 'YYYY-MM' strings.
+        """
+        return [
+            '{}-{:02d}'.format(*get_year_month(period))
+            for period in sorted(set(period for period, state in missing_keys))
+        ]
+
+    def get_stale_housing_data_response(
+            self, rows: list, missing_keys: set, token: str,
+            is_single_entry=False):
+        """Renders rows from retrieve_stale(). If months are being filled,
+        the response lists them in X-Missing-Periods and carries the fill's
+        token in X-Fill-Token, polled at /housing/fills/<token>, and is not
+        cached. With no rows to show yet, it is a 202 Accepted instead.
+        """
+        if not missing_keys:
+            if not rows:
+                return Response(
+                    'Housing data not found',
+                    status.HTTP_404_NOT_FOUND
+                )
+            return self.get_housing_data_response(rows, is_single_entry)
+
+        missing_periods = self.get_missing_periods(missing_keys)
+        headers = {
+            'Preference-Applied': self.RESPOND_ASYNC,
+            'X-Missing-Periods': ', '.join(missing_periods),
+            'X-Fill-Token': token,
+        }
+        if not rows:
+            location = f'/housing/fills/{token}'
+            return Response(
+                {
+                    'token': token,
+                    'status': background_fills.get_status(token),
+                    'missing_periods': missing_periods,
+                    'location': location,
+                },
+                status.HTTP_202_ACCEPTED,
+                headers={**headers, 'Location': location}
+            )
+
+        response = self.get_housing_data_response(rows, is_single_entry)
+        for header, value in headers.items():
+            response[header] = value
+        response['Cache-Control'] = 'no-store'
+        return response
+
+    def get_requested_currency(self):
+        """Returns the currency prices are requested in with ?currency=,
+        HOUSING_DEFAULT_CURRENCY by default, or raises ValueError.
+        """
+        request = getattr(self, 'request', None)
+        currency = request.GET.get('currency') if request is not None\
+            else None
+        currency = (currency or getattr(
+            settings, 'HOUSING_DEFAULT_CURRENCY', 'usd')).lower()
+        if not currency.isalnum() or len(currency) > 10:
+            raise ValueError('Invalid currency')
+        return currency
+
+    def get_converted_rows(self, rows: list):
+        """Returns rows in the requested currency (see
+        get_requested_currency() and convert_housing_data_rows()), or an
+        error Response for invalid currencies.
+        """
+        try:
+            with timed('fx'):
+                return self.convert_housing_data_rows(
+                    rows, self.get_requested_currency())
+        except ValueError as e:
+            return Response(str(e), status.HTTP_400_BAD_REQUEST)
+
+    async def aget_converted_rows(self, rows: list):
+        """Async version of get_converted_rows()"""
+        try:
+            with timed('fx'):
+                return await self.aconvert_housing_data_rows(
+                    rows, self.get_requested_currency())
+        except ValueError as e:
+            return Response(str(e), status.HTTP_400_BAD_REQUEST)
+
+    def get_housing_data_response(
+            self, rows: list, is_single_entry=False, variations: dict = None):
+        """Renders rows from get_housing_data_rows() with the view's
+        serializer, in the columnar layout if the negotiated renderer takes
+        it (see api.renderers), and with prices in the requested currency.
+        Range serializers render variations ({state: variation}) if given,
+        instead of working them out from rows.
+        """
+        rows = self.get_converted_rows(rows)
+        if isinstance(rows, Response):
+            return rows
+        serializer_class = self.get_serializer_class()
+        with timed('serialize'):
+            if is_single_entry:
+                return Response(serializer_class.represent_row(rows[0]))
+            represent_rows = serializer_class.represent_rows
+            request = getattr(self, 'request', None)
+            if is_columnar(getattr(request, 'accepted_renderer', None)):
+                represent_rows = serializer_class.represent_columns
+            if variations is not None:
+                return Response(represent_rows(rows, variations))
+            return Response(represent_rows(rows))
+
+    @staticmethod
+    def get_housing_data_rows(instances):
+        """Returns HOUSING_DATA_ROW_FIELDS tuples for the result of
+        get_housing_data(), which serializers render without building model
+        instances or per-row serializers. Querysets are read with a single
+        values_list() query, and lists of rows are returned as they are.
+        """
+        if isinstance(instances, QuerySet):
+            return list(instances.values_list(*HOUSING_DATA_ROW_FIELDS))
+        if instances and isinstance(instances[0], tuple):
+            return instances
+        return [
+            (
+                registry.get_state_abbreviation(entry.state_id)
+                if entry.state_id is not None else None,
+                entry.year,
+                entry.month,
+                entry.square_meter_price,
+                entry.variation,
+                entry.cumulative_log_growth,
+                entry.currency,
+            )
+            for entry in instances
+        ]
 
 
     def get_housing_data_from_db(
@@ -81,22 +507,23 @@ class HousingDataMixin:
         """Retrieve queryset for all values matching parameters."""
         states_filter = Q(state_id__isnull=True)
         if states:
-            states_filter = Q(state__abbreviation__in=states)
+            states_filter = Q(
+                state_id__in=registry.get_state_ids(self.COUNTRY, states))
+        country_id = registry.get_country_id(self.COUNTRY)
         if final_year is None or final_month is None:
             return HousingData.objects.filter(
-                    country__base_uri=self.COUNTRY, year=year, month=month
-                ).filter(states_filter).order_by('state')
-
-        date_range_filter = Q(
-                year=year, month__gte=month
-            ) | Q(
-                year__gt=year, year__lt=final_year
-            ) | Q(
-                year=final_year, month__lte=final_month
-            )
-        return HousingData.objects.filter(country__base_uri=self.COUNTRY)\
-            .filter(date_range_filter).filter(states_filter)\
-            .order_by('state', 'year', 'month')
+                    country_id=country_id, period=get_period(year, month)
+                ).filter(states_filter).select_related('state')\
+                .order_by('state__abbreviation')
+
+        return HousingData.objects.filter(
+                country_id=country_id,
+                period__range=(
+                    get_period(year, month),
+                    get_period(final_year, final_month)
+                )
+            ).filter(states_filter)\
+            .select_related('state').order_by('state__abbreviation', 'period')
 
     @staticmethod
     def get_requested_entries(
@@ -134,26 +561,81 @@ class HousingDataMixin:
         return requested_entries
 
     @staticmethod
-    def convert_to_dolar_on_month(
-            currency: str,
-            value: float | int,
-            year: int, month: int):
-        """Takes a year-month pair and passes a date to
-        utils.convert_to_dolar().
+    def get_conversion_dates(rows: list, currency: str):
+        """Returns {(year, month): date} for the HOUSING_DATA_ROW_FIELDS rows
+        not in currency, with the dates their prices are converted with (see
+        utils.get_currency_date()).
         """
-        today = datetime.today()
-        if month == 12:
-            month = 0
-            year += 1
+        return {
+            (row[1], row[2]): get_currency_date(row[1], row[2])
+            for row in rows if row[6] != currency
+        }
 
-        # use last day of month
-        currency_date = datetime(
-            year=year, month=month + 1, day=1) - timedelta(days=1)
+    @staticmethod
+    def apply_conversion(
+            rows: list, currency: str, conversion_dates: dict, rates: dict):
+        """Returns rows with their prices converted to currency with rates
+        (see utils.get_rates()), worked out once per distinct month and
+        stored currency. Rows already in currency are left as they are.
+        """
+        factors = {}
+        converted_rows = []
+        for row in rows:
+            if row[6] == currency:
+                converted_rows.append(row)
+                continue
+            factor_key = (row[1], row[2], row[6])
+            factor = factors.get(factor_key)
+            if factor is None:
+                factor = factors[factor_key] = Decimal(get_conversion_factor(
+                    rates, conversion_dates[(row[1], row[2])],
+                    row[6], currency
+                ))
+            converted_rows.append((
+                *row[:3],
+                (row[3] * factor).quantize(PRICE_QUANTUM),
+                *row[4:6],
+                currency,
+            ))
+        return converted_rows
 
-        if currency_date > today:
-            currency_date = today
+    @staticmethod
+    def convert_housing_data_rows(rows: list, currency: str):
+        """Returns HOUSING_DATA_ROW_FIELDS rows with their prices converted
+        to currency, with the rates of their months (see
+        get_conversion_dates()). Rates for all the rows are looked up at
+        once (see utils.get_rates()).
 
-        return convert_to_dolar(currency, value, currency_date)
+        Raises ValueError for unknown currencies.
+        """
+        currency = currency.lower()
+        conversion_dates = HousingDataMixin.get_conversion_dates(
+            rows, currency)
+        if not conversion_dates:
+            return rows
+        rates = get_rates(
+            set(row[6] for row in rows) | {currency},
+            conversion_dates.values()
+        )
+        return HousingDataMixin.apply_conversion(
+            rows, currency, conversion_dates, rates)
+
+    @staticmethod
+    async def aconvert_housing_data_rows(rows: list, currency: str):
+        """Async version of convert_housing_data_rows(), downloading missing
+        rates concurrently (see utils.aget_rates()).
+        """
+        currency = currency.lower()
+        conversion_dates = HousingDataMixin.get_conversion_dates(
+            rows, currency)
+        if not conversion_dates:
+            return rows
+        rates = await aget_rates(
+            set(row[6] for row in rows) | {currency},
+            conversion_dates.values()
+        )
+        return HousingDataMixin.apply_conversion(
+            rows, currency, conversion_dates, rates)
 
     def get_housing_data(
             self,
@@ -169,6 +651,89 @@ class HousingDataMixin:
 
         NOTE: entries not found are simply not returned.
         """
+        error = self.check_housing_data_request(
+            year, month, final_year, final_month)
+        if error is not None:
+            return error
+
+        rows, missing_keys = self.get_stored_housing_data(
+            year, month, final_year, final_month, states)
+        if not missing_keys:
+            return rows
+
+        self.fill_missing_housing_data(
+            missing_keys,
+            coalesce=not get_individual_remote
+        )
+        # read again, as filling a month updates the cumulative_log_growth
+        # of the stored months after it
+        return self.get_housing_data_from_db(
+            year, month, final_year, final_month, states)
+
+    def get_stored_housing_data_and_fill(
+            self,
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = []):
+        """Stale-while-revalidate version of get_housing_data(): returns a
+        tuple (rows, missing_keys, token) without waiting on the remotes,
+        with the rows read before the fill starts writing. The missing keys
+        are queued to be filled in the background (see api.background), token
+        being the fill's, or None if nothing is missing. Returns an error
+        Response for invalid parameters.
+        """
+        error = self.check_housing_data_request(
+            year, month, final_year, final_month)
+        if error is not None:
+            return error
+
+        rows, missing_keys = self.get_stored_housing_data(
+            year, month, final_year, final_month, states)
+        token = None
+        if missing_keys:
+            token = background_fills.submit(
+                self.PROVIDERS[self.COUNTRY](), missing_keys)
+        return rows, missing_keys, token
+
+    async def aget_housing_data(
+            self,
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = [],
+            get_individual_remote: bool = False):
+        """Async version of get_housing_data(). DB access runs in a worker
+        thread, while remote blocks are fetched concurrently through
+        aget_housing_data_from_remote().
+        """
+        error = self.check_housing_data_request(
+            year, month, final_year, final_month)
+        if error is not None:
+            return error
+
+        rows, missing_keys = await sync_to_async(
+            self.get_stored_housing_data)(
+                year, month, final_year, final_month, states)
+        if not missing_keys:
+            return rows
+
+        await self.afill_missing_housing_data(
+            missing_keys,
+            coalesce=not get_individual_remote
+        )
+        return self.get_housing_data_from_db(
+            year, month, final_year, final_month, states)
+
+    @staticmethod
+    def check_housing_data_request(
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None):
+        """Returns an error Response for invalid parameters, or None"""
         if month > 12 or month < 1 or (
                 final_month is not None and
                 (final_month > 12 or final_month < 1)):
@@ -184,8 +749,21 @@ class HousingDataMixin:
                 'End time must be less than or equal to start time',
                 status=status.HTTP_400_BAD_REQUEST
             )
+        return None
 
-        requested_entries = HousingDataMixin.get_requested_entries(
+    def get_stored_housing_data(
+            self,
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = []):
+        """Returns a tuple (rows, missing_keys), with the
+        HOUSING_DATA_ROW_FIELDS rows of get_housing_data_from_db() and the set
+        of requested (period, state) keys not found in them nor known not to
+        be published yet. The rows are read with a single query.
+        """
+        requested_keys = HousingDataMixin.get_requested_keys(
             year=year, month=month, final_year=final_year,
             final_month=final_month, states=states)
 
@@ -198,36 +776,186 @@ class HousingDataMixin:
             states
         )
 
-        if len(db_entries) == len(requested_entries):
-            # assume all entries were found in the DB
-            return db_entries
-
-        entries_from_remote = []
-        new_db_entries = []
-        if get_individual_remote:
-            new_db_entries = db_entries
-            # check entries to get from remote
-            for entry in requested_entries:
-                state = entry.get('state')
-                for db_entry in db_entries:
-                    if db_entry.year == entry['year'] and\
-                            db_entry.month == entry['month'] and\
-                            (state is None or db_entry.state == state):
-                        break
-                else:
-                    remote_res = self.get_housing_data_from_remote(
-                        year=entry['year'],
-                        month=entry['month'],
-                        states=[state]
-                    )
-                    if len(remote_res) > 1:
-                        raise Exception(
-                            f'get_housing_data_from_remote() for {self.COUNTRY} '
-                            'returned multiple results when only one expected'
-                        )
-                    if remote_res:
-                        entries_from_remote.append(remote_res[0])
-        else:
+        with timed('db'):
+            rows = self.get_housing_data_rows(db_entries)
+        missing_keys = requested_keys - self.get_stored_keys(rows)
+        stored_count = len(requested_keys) - len(missing_keys)
+        missing_keys = self.discard_unpublished_keys(missing_keys)
+        housing_data_keys.inc(
+            stored_count, country=self.COUNTRY, source='db')
+        housing_data_keys.inc(
+            len(missing_keys), country=self.COUNTRY, source='remote')
+        return rows, missing_keys
+
+    def discard_unpublished_keys(self, missing_keys: set):
+        """Returns missing (period, state) keys but the ones known not to be
+        published yet (see api.unpublished), which are not fetched.
+        """
+        unpublished_keys = unpublished.get_unpublished_keys(
+            self.COUNTRY, missing_keys)
+        housing_data_keys.inc(
+            len(unpublished_keys), country=self.COUNTRY, source='unpublished')
+        return missing_keys - unpublished_keys
+
+    @staticmethod
+    def get_requested_keys(
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = []):
+        """Returns a set with the (period, state) keys of all the requested
+        data (see utils.get_period()), where state is None for national data.
+        """
+        first_period = get_period(year, month)
+        last_period = first_period
+        if final_year is not None and final_month is not None:
+            last_period = get_period(final_year, final_month)
+        return set(
+            (period, state)
+            for period in range(first_period, last_period + 1)
+            for state in (states or [None])
+        )
+
+    @staticmethod
+    def get_stored_keys(rows: list):
+        """Returns a set with the (period, state) keys of
+        HOUSING_DATA_ROW_FIELDS rows.
+        """
+        return set(
+            (get_period(year, month), state)
+            for state, year, month, *_ in rows
+        )
+
+    @staticmethod
+    def plan_missing_blocks(missing_keys: set, coalesce: bool = True):
+        """Groups missing (period, state) keys into as few remote requests as
+        possible. Each state's periods are split into contiguous runs, then
+        states sharing the same run are requested together.
+
+        Returns a list of (first_period, last_period, states) blocks, where
+        states is empty for national data. Without coalesce, each key is a
+        block of its own.
+        """
+        if not coalesce:
+            return sorted(
+                (period, period, [state] if state is not None else [])
+                for period, state in missing_keys
+            )
+
+        state_periods = {}
+        for period, state in missing_keys:
+            state_periods.setdefault(state, []).append(period)
+
+        # national data is never requested along with states
+        run_states = {}
+        for state, periods in state_periods.items():
+            periods.sort()
+            first_period = previous_period = periods[0]
+            for period in periods[1:]:
+                if period != previous_period + 1:
+                    run_states.setdefault(
+                        (first_period, previous_period, state is None), []
+                    ).append(state)
+                    first_period = period
+                previous_period = period
+            run_states.setdefault(
+                (first_period, previous_period, state is None), []
+            ).append(state)
+
+        return sorted(
+            (
+                first_period,
+                last_period,
+                [] if is_national else sorted(states)
+            )
+            for (first_period, last_period, is_national), states
+            in run_states.items()
+        )
+
+    @staticmethod
+    def get_block_range(first_period: int, last_period: int):
+        """Returns (year, month, final_year, final_month) for a block from
+        plan_missing_blocks(), with no final values for single months.
+        """
+        year, month = get_year_month(first_period)
+        final_year, final_month = None, None
+        if last_period != first_period:
+            final_year, final_month = get_year_month(last_period)
+        return year, month, final_year, final_month
+
+    @staticmethod
+    def get_entry_key(entry: dict):
+        """Returns the (period, state) key of a remote entry"""
+        state_id = entry.get('state_id')
+        return (
+            get_period(entry['year'], entry['month']),
+            registry.get_state_abbreviation(state_id)
+            if state_id is not None else None
+        )
+
+    @staticmethod
+    def filter_missing_entries(entries: list, missing_keys: set):
+        """Discards remote entries other than the missing (period, state)
+        keys.
+        """
+        return [
+            entry for entry in entries or []
+            if HousingDataMixin.get_entry_key(entry) in missing_keys
+        ]
+
+    def add_unpublished_keys(self, missing_keys: set, entries: list):
+        """Remembers the missing (period, state) keys a remote fetch didn't
+        return as not published (see api.unpublished). Failed fetches, where
+        entries is None, are not remembered.
+        """
+        if entries is None:
+            return
+        unpublished.add(self.COUNTRY, missing_keys, set(
+            self.get_entry_key(entry) for entry in entries))
+
+    def get_block_key(self, first_period: int, last_period: int, states):
+        """Returns the single-flight key of a plan_missing_blocks() block"""
+        return f'{self.COUNTRY}:{first_period}:{last_period}:'\
+            f'{"-".join(states)}'
+
+    def get_block_stored_data(
+            self, first_period: int, last_period: int, states: list):
+        """Returns a tuple (stored_entries, missing_keys) for a
+        plan_missing_blocks() block, as found in the DB right now.
+        """
+        year, month, final_year, final_month = self.get_block_range(
+            first_period, last_period)
+        block_keys = self.get_requested_keys(
+            year, month, final_year, final_month, states)
+        stored_entries = list(self.get_housing_data_from_db(
+            year, month, final_year, final_month, states))
+        return stored_entries, block_keys - set(
+            (
+                entry.period,
+                registry.get_state_abbreviation(entry.state_id)
+                if entry.state_id is not None else None
+            )
+            for entry in stored_entries
+        )
+
+    def fill_missing_block(
+            self, first_period: int, last_period: int, states: list):
+        """Fetches a plan_missing_blocks() block from remote and stores it.
+        Entries stored in the meantime (e.g. by another process) are not
+        fetched again.
+
+        Returns all the block's HousingData instances.
+        """
+        with timed('db'):
+            stored_entries, missing_keys = self.get_block_stored_data(
+                first_period, last_period, states)
+        if not missing_keys:
+            return stored_entries
+
+        year, month, final_year, final_month = self.get_block_range(
+            first_period, last_period)
+        with timed('remote'):
             entries_from_remote = self.get_housing_data_from_remote(
                 year=year,
                 month=month,
@@ -235,33 +963,336 @@ class HousingDataMixin:
                 final_month=final_month,
                 states=states
             )
+        self.add_unpublished_keys(missing_keys, entries_from_remote)
+        with timed('db'):
+            saved_entries = self.save_housing_data(
+                self.filter_missing_entries(
+                    entries_from_remote, missing_keys))
+        return stored_entries + saved_entries
 
-        country = Country.objects.get(base_uri=self.COUNTRY)
-        for entry in entries_from_remote:
-            try:
-                new_entry = HousingData.objects.get(
-                    country=country,
-                    year=entry['year'],
-                    month=entry['month'],
-                    state_id=entry.get('state_id')
+    async def afill_missing_block(
+            self, first_period: int, last_period: int, states: list):
+        """Async version of fill_missing_block()"""
+        with timed('db'):
+            stored_entries, missing_keys = await sync_to_async(
+                self.get_block_stored_data)(first_period, last_period, states)
+        if not missing_keys:
+            return stored_entries
+
+        with timed('remote'):
+            entries_from_remote = await self.aget_housing_data_from_remote(
+                *self.get_block_range(first_period, last_period),
+                states=states
+            )
+        await sync_to_async(self.add_unpublished_keys)(
+            missing_keys, entries_from_remote)
+        with timed('db'):
+            saved_entries = await sync_to_async(self.save_housing_data)(
+                await sync_to_async(self.filter_missing_entries)(
+                    entries_from_remote, missing_keys)
+            )
+        return stored_entries + saved_entries
+
+    def fill_missing_housing_data(self, missing_keys: set, coalesce=True):
+        """Fetches the missing (period, state) keys from remote and stores
+        them, one call to get_housing_data_from_remote() per block planned by
+        plan_missing_blocks(). Concurrent requests for the same block share a
+        single fetch (see api.singleflight).
+
+        Returns the HousingData instances for the missing keys.
+        """
+        entries = []
+        for first_period, last_period, states in\
+                self.plan_missing_blocks(missing_keys, coalesce):
+            entries += single_flight.do(
+                self.get_block_key(first_period, last_period, states),
+                lambda: self.fill_missing_block(
+                    first_period, last_period, states)
+            )
+        return entries
+
+    async def afill_missing_housing_data(
+            self, missing_keys: set, coalesce=True):
+        """Async version of fill_missing_housing_data(), fetching all the
+        blocks concurrently.
+        """
+        blocks = await asyncio.gather(*(
+            single_flight.ado(
+                self.get_block_key(first_period, last_period, states),
+                partial(
+                    self.afill_missing_block,
+                    first_period, last_period, states
+                )
+            )
+            for first_period, last_period, states
+            in self.plan_missing_blocks(missing_keys, coalesce)
+        ))
+        entries = []
+        for block in blocks:
+            entries += block
+        return entries
+
+    def save_housing_data(self, entries: list, batch_size: int = None):
+        """Upserts entries in the format returned by
+        get_housing_data_from_remote() in a single transaction, in chunks of
+        batch_size (INGEST_BATCH_SIZE by default) rows.
+
+        Returns the saved HousingData instances, in the order of entries.
+        """
+        batch_size = batch_size or self.INGEST_BATCH_SIZE
+        country_id = registry.get_country_id(self.COUNTRY)
+
+        # later entries for the same month and state take precedence
+        new_entries = {}
+        for entry in entries:
+            new_entry = HousingData(
+                country_id=country_id,
+                period=get_period(entry['year'], entry['month']),
+                **entry
+            )
+            # hold the same values read back from the DB would have
+            for field_name in ('square_meter_price', 'variation'):
+                field = HousingData._meta.get_field(field_name)
+                setattr(new_entry, field_name, field.to_python(
+                    getattr(new_entry, field_name)
+                ).quantize(Decimal(1).scaleb(-field.decimal_places)))
+            new_entries[(
+                entry['year'], entry['month'], entry.get('state_id')
+            )] = new_entry
+
+        state_entries = [
+            entry for entry in new_entries.values()
+            if entry.state_id is not None
+        ]
+        national_entries = [
+            entry for entry in new_entries.values()
+            if entry.state_id is None
+        ]
+
+        with transaction.atomic():
+            HousingData.objects.bulk_create(
+                state_entries,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['country', 'year', 'month', 'state'],
+                update_fields=['square_meter_price', 'currency', 'variation'],
+            )
+
+            # NULL states never conflict on
+            # un_country_year_month_state_housing_data, so national entries
+            # are matched against the stored ones explicitly
+            if national_entries:
+                stored_ids = dict(HousingData.objects.filter(
+                    country_id=country_id,
+                    state__isnull=True,
+                    period__in=[entry.period for entry in national_entries],
+                ).values_list('period', 'id'))
+                updated_entries = []
+                created_entries = []
+                for entry in national_entries:
+                    stored_id = stored_ids.get(entry.period)
+                    if stored_id is None:
+                        created_entries.append(entry)
+                        continue
+                    entry.pk = stored_id
+                    updated_entries.append(entry)
+
+                HousingData.objects.bulk_update(
+                    updated_entries,
+                    ['square_meter_price', 'currency', 'variation'],
+                    batch_size=batch_size
                 )
-                new_entry.square_meter_price = entry.get('square_meter_price')
-                new_entry.variation = entry.get('variation')
-            except HousingData.DoesNotExist as e:
-                new_entry = HousingData(
-                    country=country,
-                    **entry
+                HousingData.objects.bulk_create(
+                    created_entries, batch_size=batch_size)
+
+            # only the months from the earliest saved one on are affected
+            first_periods = {}
+            for entry in new_entries.values():
+                first_periods[entry.state_id] = min(
+                    entry.period,
+                    first_periods.get(entry.state_id, entry.period)
                 )
-            new_db_entries.append(new_entry)
-            new_entry.save()
+            for state_id, first_period in first_periods.items():
+                cumulative_log_growths = update_cumulative_log_growth(
+                    country_id, state_id, first_period)
+                for entry in new_entries.values():
+                    if entry.state_id == state_id:
+                        entry.cumulative_log_growth =\
+                            cumulative_log_growths.get(entry.period)
+
+        return list(new_entries.values())
+
+    def get_latest_period(self):
+        """Returns the period (see utils.get_period()) of the latest data
+        stored for the country, or None.
+        """
+        return HousingData.objects.filter(
+                country_id=registry.get_country_id(self.COUNTRY)
+            ).aggregate(latest_period=Max('period'))['latest_period']
+
+    def get_range_variations(
+            self,
+            year: int,
+            month: int,
+            final_year: int,
+            final_month: int,
+            states: list = []):
+        """Returns {state: variation} with the compound variation over the
+        stored months in the range for each state, or {None: variation} for
+        national data, as HousingDataRangeSerializer renders it. Each is
+        worked out from cumulative_log_growth of the first and last stored
+        months, two index lookups per state, however long the range is.
+        States with no data in the range are omitted.
+        """
+        country_id = registry.get_country_id(self.COUNTRY)
+        first_period = get_period(year, month)
+        last_period = get_period(final_year, final_month)
+        variations = {}
+        for state in states or [None]:
+            state_id = registry.get_state_id(self.COUNTRY, state)\
+                if state is not None else None
+            entries = HousingData.objects.filter(
+                country_id=country_id,
+                state_id=state_id,
+                period__range=(first_period, last_period)
+            ).values_list('variation', 'cumulative_log_growth')
+            first_entry = entries.order_by('period').first()
+            if first_entry is None:
+                continue
+            last_entry = entries.order_by('-period').first()
+            variation = get_range_variation(first_entry, last_entry)
+            if variation is None:
+                variation = 1.0
+                for entry_variation in entries.order_by('period')\
+                        .values_list('variation', flat=True):
+                    variation *= 1 + float(entry_variation)
+                variation -= 1
+            variations[state] = variation
+        return variations
 
-        return new_db_entries
+    def get_latest_periods(self, states: list = []):
+        """Returns {state: period} with the latest period stored for each
+        state, or {None: period} for national data. States with no data are
+        omitted.
+        """
+        states_filter = Q(state_id__isnull=True)
+        if states:
+            states_filter = Q(
+                state_id__in=registry.get_state_ids(self.COUNTRY, states))
+        return {
+            registry.get_state_abbreviation(state_id)
+            if state_id is not None else None: latest_period
+            for state_id, latest_period in HousingData.objects.filter(
+                    country_id=registry.get_country_id(self.COUNTRY)
+                ).filter(states_filter).values('state_id').annotate(
+                    latest_period=Max('period')
+                ).values_list('state_id', 'latest_period').order_by()
+        }
+
+    def get_housing_data_batch(self, specs: list):
+        """Resolves many requests for this country at once. Each spec is a
+        dict with year, month, final_year, final_month and states, as taken
+        by get_housing_data(), and optionally the currency to convert prices
+        to (HOUSING_DEFAULT_CURRENCY by default).
+
+        Stored data for all the specs is read with a single query, and all
+        their missing keys are filled in a single planned remote pass (see
+        fill_missing_housing_data()). Returns a (status, data) tuple for each
+        spec, where data is rendered as by the equivalent GET endpoint.
+        """
+        spec_keys = []
+        specs_filter = Q(pk__in=[])
+        for spec in specs:
+            error = self.check_housing_data_request(
+                spec['year'], spec['month'],
+                spec.get('final_year'), spec.get('final_month'))
+            if error is not None:
+                spec_keys.append(error)
+                continue
+
+            requested_keys = self.get_requested_keys(
+                spec['year'], spec['month'],
+                spec.get('final_year'), spec.get('final_month'),
+                spec.get('states'))
+            spec_keys.append(requested_keys)
+
+            periods = [period for period, state in requested_keys]
+            states_filter = Q(state_id__isnull=True)
+            if spec.get('states'):
+                states_filter = Q(state_id__in=registry.get_state_ids(
+                    self.COUNTRY, spec['states']))
+            specs_filter |= Q(
+                period__range=(min(periods), max(periods))) & states_filter
+
+        stored_rows_queryset = HousingData.objects.filter(
+                country_id=registry.get_country_id(self.COUNTRY)
+            ).filter(specs_filter).order_by().values_list(
+                'period', *HOUSING_DATA_ROW_FIELDS)
+        stored_rows = {
+            (period, row[0]): row for period, *row in stored_rows_queryset
+        }
+
+        missing_keys = set()
+        for requested_keys in spec_keys:
+            if not isinstance(requested_keys, Response):
+                missing_keys |= requested_keys - stored_rows.keys()
+        missing_keys = self.discard_unpublished_keys(missing_keys)
+        if missing_keys:
+            self.fill_missing_housing_data(missing_keys)
+            # read again, as filling a month updates the
+            # cumulative_log_growth of the stored months after it
+            stored_rows = {
+                (period, row[0]): row
+                for period, *row in stored_rows_queryset.all()
+            }
+
+        results = []
+        for spec, requested_keys in zip(specs, spec_keys):
+            if isinstance(requested_keys, Response):
+                results.append((requested_keys.status_code,
+                                requested_keys.data))
+                continue
+
+            rows = [
+                stored_rows[key]
+                for key in sorted(
+                    requested_keys,
+                    key=lambda key: (key[1] or '', key[0])
+                )
+                if key in stored_rows
+            ]
+            if not rows:
+                results.append(
+                    (status.HTTP_404_NOT_FOUND, 'Housing data not found'))
+                continue
+            try:
+                with timed('fx'):
+                    rows = self.convert_housing_data_rows(
+                        rows,
+                        spec.get('currency')
+                        or getattr(settings, 'HOUSING_DEFAULT_CURRENCY', 'usd')
+                    )
+            except ValueError as e:
+                results.append((status.HTTP_400_BAD_REQUEST, str(e)))
+                continue
 
+            is_range = spec.get('final_year') is not None\
+                and spec.get('final_month') is not None
+            if spec.get('states'):
+                serializer_class = HousingDateStatesRangeSerializer\
+                    if is_range else HousingDateStatesSerializer
+            elif is_range:
+                serializer_class = HousingDataRangeSerializer
+            else:
+                results.append((
+                    status.HTTP_200_OK,
+                    HousingDataValuesSerializer.represent_row(rows[0])
+                ))
+                continue
+            results.append(
+                (status.HTTP_200_OK, serializer_class.represent_rows(rows)))
+        return results
 
     def get_state_id_from_abbreviation(self, abbreviation: str):
         """Returns CountryState.id from abbreviation"""
-        entry = CountryState.objects.only('id').filter(
-                country__base_uri=self.COUNTRY,
-                abbreviation=abbreviation
-            ).get()
-        return entry.id
+        return registry.get_state_id(self.COUNTRY, abbreviation)
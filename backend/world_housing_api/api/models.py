@@ -51,14 +51,26 @@ class HousingData(models.Model):
     """Stored housing data"""
     month = models.SmallIntegerField(validators=[MinValueValidator(1), MaxValueValidator(12)])
     year = models.SmallIntegerField(validators=[MinValueValidator(1), MaxValueValidator(2200)])
+    # month ordinal (year * 12 + month - 1), see api.utils.get_period()
+    period = models.IntegerField(editable=False)
     variation = models.DecimalField(max_digits=20, decimal_places=5)
+    # in currency, as published, see api.utils.get_rates() for conversions
     square_meter_price = models.DecimalField(max_digits=20, decimal_places=2)
+    # lowercase code, e.g. 'brl'
+    currency = models.CharField(max_length=10, default='usd')
+    # sum of log(1 + variation) over the stored months of the same country
+    # and state up to this one, see api.utils.update_cumulative_log_growth()
+    cumulative_log_growth = models.FloatField(null=True, editable=False)
     country = models.ForeignKey(Country, on_delete=models.CASCADE)
     state = models.ForeignKey(CountryState, on_delete=models.CASCADE, null=True)
 
     def __str__(self):
-        return f'{"{:02d}".format(self.month)}/{self.year} /{self.country.name}{"/" + self.state.abbreviation if self.state else ""} {self.square_meter_price} {self.variation}'
+        return f'{"{:02d}".format(self.month)}/{self.year} /{self.country.name}{"/" + self.state.abbreviation if self.state else ""} {self.square_meter_price} {self.currency.upper()} {self.variation}'
     
+    def save(self, *args, **kwargs):
+        self.period = self.year * 12 + self.month - 1
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['country', '-year', '-month']
         constraints = [
@@ -67,3 +79,34 @@ class HousingData(models.Model):
                 name="un_country_year_month_state_housing_data"
             ),
         ]
+        indexes = [
+            # range scans by period; the trailing columns make it covering
+            # for reads of values (SQLite has no INCLUDE)
+            models.Index(
+                fields=[
+                    'country', 'state', 'period',
+                    'year', 'month', 'square_meter_price', 'currency',
+                    'variation', 'cumulative_log_growth'
+                ],
+                name='ix_country_state_period_hd'
+            ),
+        ]
+
+
+class CurrencyRate(models.Model):
+    """Stored exchange rates, as units of currency per dolar"""
+    date = models.DateField()
+    currency = models.CharField(max_length=10)
+    rate = models.FloatField()
+
+    def __str__(self):
+        return f'{self.date} {self.currency.upper()} {self.rate}'
+
+    class Meta:
+        ordering = ['currency', '-date']
+        constraints = [
+            models.UniqueConstraint(
+                'date', 'currency',
+                name="un_date_currency_currency_rate"
+            ),
+        ]
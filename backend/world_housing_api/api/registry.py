@@ -0,0 +1,127 @@
+import threading
+from .models import (
+    Country,
+    CountryState
+)
+
+
+class LocalityRegistry:
+    """Process-wide, lazily loaded lookup of countries and states.
+
+    Maps Country.base_uri to Country.id, (base_uri, abbreviation) to
+    CountryState.id and back, as well as providers' own state codes (e.g.
+    IBGE's locality codes for Brazil) to abbreviations and back. The DB maps
+    are loaded with two queries on first use and reloaded after invalidate(),
+    which api.signals calls whenever a Country or CountryState is saved or
+    deleted.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._country_ids = {}
+        self._state_ids = {}
+        self._state_abbreviations = {}
+        self._state_codes = {}
+        self._code_states = {}
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            country_ids = dict(
+                Country.objects.values_list('base_uri', 'id'))
+            state_ids = {}
+            state_abbreviations = {}
+            for state_id, country, abbreviation in\
+                    CountryState.objects.values_list(
+                        'id', 'country__base_uri', 'abbreviation'):
+                state_ids[(country, abbreviation)] = state_id
+                state_abbreviations[state_id] = abbreviation
+            self._country_ids = country_ids
+            self._state_ids = state_ids
+            self._state_abbreviations = state_abbreviations
+            self._loaded = True
+
+    def invalidate(self):
+        """Drops the DB maps, so they are reloaded on next use."""
+        with self._lock:
+            self._loaded = False
+
+    def get_country_id(self, country: str):
+        """Returns Country.id from base_uri"""
+        self._load()
+        try:
+            return self._country_ids[country]
+        except KeyError:
+            raise Country.DoesNotExist(f'Country {country} does not exist')
+
+    def get_country_base_uri(self, country_id: int):
+        """Returns Country.base_uri from id"""
+        self._load()
+        for country, known_country_id in self._country_ids.items():
+            if known_country_id == country_id:
+                return country
+        raise Country.DoesNotExist(f'Country {country_id} does not exist')
+
+    def get_countries(self):
+        """Returns all the country base_uris"""
+        self._load()
+        return sorted(self._country_ids)
+
+    def get_state_id(self, country: str, abbreviation: str):
+        """Returns CountryState.id from country base_uri and abbreviation"""
+        self._load()
+        try:
+            return self._state_ids[(country, abbreviation.lower())]
+        except KeyError:
+            raise CountryState.DoesNotExist(
+                f'State {abbreviation} does not exist for {country}')
+
+    def get_state_ids(self, country: str, abbreviations: list):
+        """Returns CountryState.id for each known abbreviation, skipping
+        unknown ones.
+        """
+        self._load()
+        return [
+            self._state_ids[(country, abbreviation.lower())]
+            for abbreviation in abbreviations
+            if (country, abbreviation.lower()) in self._state_ids
+        ]
+
+    def get_state_abbreviation(self, state_id: int):
+        """Returns CountryState.abbreviation from id"""
+        self._load()
+        try:
+            return self._state_abbreviations[state_id]
+        except KeyError:
+            raise CountryState.DoesNotExist(
+                f'State {state_id} does not exist')
+
+    def get_country_states(self, country: str):
+        """Returns all the state abbreviations for a country"""
+        self._load()
+        return sorted(
+            abbreviation for state_country, abbreviation in self._state_ids
+            if state_country == country
+        )
+
+    def register_state_codes(self, country: str, codes: dict):
+        """Registers a provider's own codes for states, as a dict
+        {abbreviation: code}.
+        """
+        with self._lock:
+            self._state_codes[country] = dict(codes)
+            self._code_states[country] = {
+                code: abbreviation for abbreviation, code in codes.items()
+            }
+
+    def get_state_code(self, country: str, abbreviation: str):
+        """Returns the provider's code for a state abbreviation"""
+        return self._state_codes[country][abbreviation.lower()]
+
+    def get_state_from_code(self, country: str, code):
+        """Returns the state abbreviation for a provider's code, or None"""
+        return self._code_states.get(country, {}).get(code)
+
+
+registry = LocalityRegistry()
@@ -0,0 +1,72 @@
+from datetime import (
+    date,
+    datetime
+)
+from decimal import Decimal
+from rest_framework.renderers import (
+    BaseRenderer,
+    JSONRenderer
+)
+from rest_framework.settings import api_settings
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional, see requirements.txt
+    msgpack = None
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """JSON with range data in the columnar layout (see the range
+    serializers' represent_columns()), requested with
+    'Accept: application/vnd.housing.columnar+json' or ?format=columnar.
+    """
+    media_type = 'application/vnd.housing.columnar+json'
+    format = 'columnar'
+    columnar = True
+
+
+class MessagePackRenderer(BaseRenderer):
+    """MessagePack, requested with 'Accept: application/msgpack' or
+    ?format=msgpack
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, Decimal):
+            return str(value)
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=self.encode)
+
+
+class ColumnarMessagePackRenderer(MessagePackRenderer):
+    """MessagePack with range data in the columnar layout, requested with
+    'Accept: application/vnd.housing.columnar+msgpack' or
+    ?format=columnar-msgpack
+    """
+    media_type = 'application/vnd.housing.columnar+msgpack'
+    format = 'columnar-msgpack'
+    columnar = True
+
+
+# renderers offered by the housing data views, the first one being the
+# default; binary ones only if msgpack is installed
+HOUSING_DATA_RENDERER_CLASSES = list(api_settings.DEFAULT_RENDERER_CLASSES)\
+    + ([MessagePackRenderer] if msgpack is not None else [])
+HOUSING_DATA_RANGE_RENDERER_CLASSES = HOUSING_DATA_RENDERER_CLASSES\
+    + [ColumnarJSONRenderer]\
+    + ([ColumnarMessagePackRenderer] if msgpack is not None else [])
+
+
+def is_columnar(renderer):
+    """Whether renderer takes range data in the columnar layout"""
+    return getattr(renderer, 'columnar', False)
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    connections
+)
+
+READ_ONLY_DB_ALIAS = 'readonly'
+
+_read_only_request = ContextVar('housing_read_only_request', default=False)
+
+
+@contextmanager
+def read_only_request():
+    """Marks the block as serving a read-only (GET or HEAD) request, whose
+    reads ReadOnlyRouter sends to the read-only alias.
+    """
+    token = _read_only_request.set(True)
+    try:
+        yield
+    finally:
+        _read_only_request.reset(token)
+
+
+def read_only_iterator(iterable):
+    """Iterates iterable as a read-only request (see read_only_request()),
+    e.g. the content of a streaming response, which is consumed after the
+    view returns. Marked item by item, as each may be read in a different
+    context, e.g. a thread of an ASGI server.
+    """
+    iterator = iter(iterable)
+    while True:
+        with read_only_request():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ReadOnlyRouter:
+    """Sends reads of read-only requests to the READ_ONLY_DB_ALIAS connection
+    (the same SQLite file, opened with query_only), so they are served from
+    WAL snapshots without waiting on the writes of remote fills. Writes, and
+    reads within a transaction on the default connection, which must see
+    its uncommitted writes, use the default alias.
+    """
+    def db_for_read(self, model, **hints):
+        if not _read_only_request.get()\
+                or READ_ONLY_DB_ALIAS not in connections.settings\
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return READ_ONLY_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases are the same database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != READ_ONLY_DB_ALIAS
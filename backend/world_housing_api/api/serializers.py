@@ -1,4 +1,5 @@
 from rest_framework.serializers import (
+    DecimalField,
     ModelSerializer,
     Serializer,
     SerializerMethodField
@@ -8,6 +9,30 @@ from .models import (
     CountryState,
     HousingData
 )
+from .utils import get_range_variation
+
+# Columns read by the fast rendering path (see represent_row() and
+# represent_rows() below), in the order they appear in each row
+HOUSING_DATA_ROW_FIELDS = (
+    'state__abbreviation',
+    'year',
+    'month',
+    'square_meter_price',
+    'variation',
+    'cumulative_log_growth',
+    'currency',
+)
+
+# same representation as the fields HousingDataValuesSerializer builds
+square_meter_price_field = DecimalField(max_digits=20, decimal_places=2)
+variation_field = DecimalField(max_digits=20, decimal_places=5)
+
+
+def get_row_period(row):
+    """Returns the 'YYYY-MM' month of a HOUSING_DATA_ROW_FIELDS row, as
+    listed by the columnar layout
+    """
+    return '{}-{:02d}'.format(row[1], row[2])
 
 
 class HousingDataValuesSerializer(ModelSerializer):
@@ -15,6 +40,15 @@ class HousingDataValuesSerializer(ModelSerializer):
         model = HousingData
         fields = ['square_meter_price', 'variation']
 
+    @staticmethod
+    def represent_row(row):
+        """Same as .data, from a HOUSING_DATA_ROW_FIELDS row"""
+        return {
+            'square_meter_price':
+            square_meter_price_field.to_representation(row[3]),
+            'variation': variation_field.to_representation(row[4]),
+        }
+
 
 class CountryStateSerializer(ModelSerializer):
     class Meta:
@@ -34,6 +68,14 @@ class HousingDataRangeSerializer(Serializer):
     monthly = SerializerMethodField()
 
     def get_variation(self, obj):
+        if obj:
+            variation = get_range_variation(
+                (obj[0].variation, obj[0].cumulative_log_growth),
+                (obj[-1].variation, obj[-1].cumulative_log_growth),
+            )
+            if variation is not None:
+                return variation
+
         res = 1.0
         for housing_data in obj:
             res *= 1 + float(housing_data.variation)
@@ -46,6 +88,48 @@ class HousingDataRangeSerializer(Serializer):
             for entry in obj
         }
 
+    @staticmethod
+    def get_rows_variation(rows, variations: dict = None):
+        """Same as get_variation(), from HOUSING_DATA_ROW_FIELDS rows, or
+        the rows' state one in variations ({state: variation}) if given
+        """
+        if rows and variations and rows[0][0] in variations:
+            return variations[rows[0][0]]
+        variation = get_range_variation(rows[0][4:6], rows[-1][4:6])\
+            if rows else None
+        if variation is None:
+            variation = 1.0
+            for row in rows:
+                variation *= 1 + float(row[4])
+            variation -= 1
+        return variation
+
+    @staticmethod
+    def represent_rows(rows, variations: dict = None):
+        """Same as .data, from HOUSING_DATA_ROW_FIELDS rows"""
+        return {
+            'variation': HousingDataRangeSerializer.get_rows_variation(
+                rows, variations),
+            'monthly': {
+                f'{"{:02d}".format(row[2])}/{row[1]}':
+                HousingDataValuesSerializer.represent_row(row)
+                for row in rows
+            },
+        }
+
+    @staticmethod
+    def represent_columns(rows, variations: dict = None):
+        """Columnar layout of represent_rows(): the months in periods, and
+        their prices and variations, as numbers, in lists in the same order.
+        """
+        return {
+            'variation': HousingDataRangeSerializer.get_rows_variation(
+                rows, variations),
+            'periods': [get_row_period(row) for row in rows],
+            'square_meter_prices': [float(row[3]) for row in rows],
+            'variations': [float(row[4]) for row in rows],
+        }
+
 
 class HousingDateStatesSerializer(Serializer):
     def to_representation(self, obj):
@@ -54,6 +138,14 @@ class HousingDateStatesSerializer(Serializer):
             res[entry.state.abbreviation] = HousingDataValuesSerializer(entry).data
         return res
 
+    @staticmethod
+    def represent_rows(rows):
+        """Same as .data, from HOUSING_DATA_ROW_FIELDS rows"""
+        return {
+            row[0]: HousingDataValuesSerializer.represent_row(row)
+            for row in rows
+        }
+
 
 class HousingDateStatesRangeSerializer(Serializer):
     def to_representation(self, obj):
@@ -67,3 +159,50 @@ class HousingDateStatesRangeSerializer(Serializer):
         for state, state_entries in state_data.items():
             res[state] = HousingDataRangeSerializer(state_entries).data
         return res
+
+    @staticmethod
+    def represent_rows(rows, variations: dict = None):
+        """Same as .data, from HOUSING_DATA_ROW_FIELDS rows"""
+        state_rows = {}
+        for row in rows:
+            if row[0] not in state_rows:
+                state_rows[row[0]] = []
+            state_rows[row[0]].append(row)
+
+        return {
+            state: HousingDataRangeSerializer.represent_rows(
+                state_entries, variations)
+            for state, state_entries in state_rows.items()
+        }
+
+    @staticmethod
+    def represent_columns(rows, variations: dict = None):
+        """Columnar layout of represent_rows(): the months any state has
+        data for in periods, and each state's range variation, and prices and
+        variations as lists aligned with periods, with None for months the
+        state has no data for.
+        """
+        periods = sorted(set(get_row_period(row) for row in rows))
+        period_indexes = {
+            period: index for index, period in enumerate(periods)}
+        state_rows = {}
+        for row in rows:
+            if row[0] not in state_rows:
+                state_rows[row[0]] = []
+            state_rows[row[0]].append(row)
+
+        states = {}
+        for state, state_entries in state_rows.items():
+            square_meter_prices = [None] * len(periods)
+            monthly_variations = [None] * len(periods)
+            for row in state_entries:
+                index = period_indexes[get_row_period(row)]
+                square_meter_prices[index] = float(row[3])
+                monthly_variations[index] = float(row[4])
+            states[state] = {
+                'variation': HousingDataRangeSerializer.get_rows_variation(
+                    state_entries, variations),
+                'square_meter_prices': square_meter_prices,
+                'variations': monthly_variations,
+            }
+        return {'periods': periods, 'states': states}
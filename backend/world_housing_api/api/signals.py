@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models.signals import (
+    post_delete,
+    post_save
+)
+from django.dispatch import receiver
+from .catalogue import catalogue
+from .models import (
+    Country,
+    CountryState,
+    HousingData
+)
+from .registry import registry
+from .utils import update_cumulative_log_growth
+
+
+@receiver(post_save, sender=Country)
+@receiver(post_delete, sender=Country)
+@receiver(post_save, sender=CountryState)
+@receiver(post_delete, sender=CountryState)
+def invalidate_registry(sender, **kwargs):
+    """Reloads the locality registry and the country catalogue once changes
+    are visible
+    """
+    registry.invalidate()
+    catalogue.bump_version()
+    transaction.on_commit(registry.invalidate)
+    transaction.on_commit(catalogue.bump_version)
+
+
+@receiver(post_save, sender=HousingData)
+def update_housing_data_growth(sender, instance, raw=False, **kwargs):
+    """Keeps cumulative_log_growth up to date when a single entry is saved
+    (bulk ingest in HousingDataMixin.save_housing_data() updates it itself).
+    Deletes don't, as a post_delete receiver would rule out fast deletes:
+    use utils.delete_housing_data() instead.
+    """
+    if raw:
+        return
+    update_cumulative_log_growth(
+        instance.country_id, instance.state_id, instance.period)
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from asgiref.sync import sync_to_async
+from contextlib import contextmanager
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs a function at most once at a time per key.
+
+    Within a process, callers arriving while a call for the same key is in
+    flight wait for it and share its result (or exception). Across processes,
+    calls for the same key are serialized by an exclusive lock on a lease
+    file under HOUSING_LOCK_DIR (see lease()), so functions should re-check
+    whether their work is still needed once they run (e.g. whether another
+    process already stored the data).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+
+    @staticmethod
+    def get_lease_path(key: str):
+        lock_dir = getattr(settings, 'HOUSING_LOCK_DIR', None)\
+            or os.path.join(tempfile.gettempdir(), 'world_housing_api')
+        os.makedirs(lock_dir, exist_ok=True)
+        return os.path.join(
+            lock_dir, hashlib.sha1(key.encode()).hexdigest() + '.lock')
+
+    @staticmethod
+    def is_current_lease(lease_file, path: str):
+        """Returns whether lease_file is still the one at path, which the
+        previous holder removes on release
+        """
+        try:
+            return os.path.samestat(
+                os.fstat(lease_file.fileno()), os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def lease(self, key: str):
+        """Holds the cross-process lease for key, waiting at most
+        HOUSING_LEASE_TIMEOUT seconds for it. On timeout, or where file locks
+        are not supported, proceeds without it.
+
+        The lease file is removed on release, so HOUSING_LOCK_DIR only holds
+        the leases in use. Waiters that locked a removed file open it again.
+        """
+        if fcntl is None:
+            yield
+            return
+
+        timeout = getattr(settings, 'HOUSING_LEASE_TIMEOUT', 60)
+        deadline = time.monotonic() + timeout
+        path = self.get_lease_path(key)
+        lease_file = open(path, 'a')
+        while True:
+            try:
+                fcntl.flock(lease_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    lease_file.close()
+                    logger.warn(
+                        f'Timed out waiting for lease on {key}, '
+                        'proceeding without it.'
+                    )
+                    yield
+                    return
+                time.sleep(0.05)
+                continue
+            if self.is_current_lease(lease_file, path):
+                break
+            lease_file.close()
+            lease_file = open(path, 'a')
+
+        try:
+            yield
+        finally:
+            # removed while still locked, so no one else locks it afterwards
+            # without noticing (see is_current_lease())
+            os.unlink(path)
+            fcntl.flock(lease_file, fcntl.LOCK_UN)
+            lease_file.close()
+
+    def do(self, key: str, fn):
+        """Returns fn(), shared with concurrent callers for the same key"""
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with self.lease(key):
+                call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key: str, coroutine_fn):
+        """Async version of do(), for coroutine functions. Concurrent
+        callers on the same event loop share the result.
+        """
+        loop = asyncio.get_running_loop()
+        calls = self._async_calls.setdefault(loop, {})
+        if key in calls:
+            return await asyncio.shield(calls[key])
+
+        future = calls[key] = loop.create_future()
+        try:
+            lease = self.lease(key)
+            await sync_to_async(lease.__enter__, thread_sensitive=False)()
+            try:
+                result = await coroutine_fn()
+            finally:
+                await sync_to_async(
+                    lease.__exit__, thread_sensitive=False)(None, None, None)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieved here, so waiters are the only ones raising it
+            future.exception()
+            raise
+        finally:
+            del calls[key]
+            if not calls:
+                self._async_calls.pop(loop, None)
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,99 @@
+import logging
+from datetime import date
+from django.utils.module_loading import autodiscover_modules
+from .mixins import HousingDataMixin
+from .registry import registry
+from .unpublished import unpublished
+from .utils import get_period
+
+logger = logging.getLogger()
+
+
+def get_providers(countries: list = None):
+    """Returns {base_uri: class} for every country implementing
+    HousingDataMixin, optionally only for countries. Each app's mixins module
+    is imported so its provider gets registered. Raises ValueError for
+    countries without a provider or a Country row.
+    """
+    autodiscover_modules('mixins')
+    providers = dict(HousingDataMixin.PROVIDERS)
+    if countries:
+        countries = [country.lower() for country in countries]
+        unknown_countries = set(countries) - providers.keys()
+        if unknown_countries:
+            raise ValueError(
+                f'No housing data provider for {", ".join(unknown_countries)}'
+            )
+        providers = {
+            country: providers[country] for country in countries
+        }
+
+    missing_countries = set(providers) - set(registry.get_countries())
+    if missing_countries:
+        raise ValueError(
+            f'No Country stored for {", ".join(sorted(missing_countries))}')
+    return providers
+
+
+def sync_housing_data(
+        countries: list = None,
+        since: tuple = (2000, 1),
+        until: tuple = None,
+        incremental: bool = False):
+    """Fetches national and all-state housing data for each provider from
+    since until until (the current month by default), both (year, month)
+    pairs, and upserts it. Each level is fetched with a single remote call.
+
+    With incremental, only periods after the latest stored one are fetched
+    (for states, after the state that is furthest behind).
+
+    Meant to be run periodically (see the sync_housing command), so requests
+    are served from the DB. Returns {country: number of saved entries}.
+    """
+    if until is None:
+        until = (date.today().year, date.today().month)
+
+    saved_entries = {}
+    for country, provider_class in get_providers(countries).items():
+        provider = provider_class()
+        saved_entries[country] = 0
+        for states in ([], registry.get_country_states(country)):
+            first_period = get_period(*since)
+            if incremental:
+                latest_periods = provider.get_latest_periods(states)
+                if len(latest_periods) == len(states or [None]):
+                    first_period = max(
+                        first_period, min(latest_periods.values()) + 1)
+
+            last_period = get_period(*until)
+            if first_period > last_period:
+                continue
+
+            year, month, final_year, final_month = provider.get_block_range(
+                first_period, last_period)
+            logger.info(
+                f'Syncing {country} {"states" if states else "national"} '
+                f'housing data from {month:02d}/{year} until '
+                f'{until[1]:02d}/{until[0]}'
+            )
+            entries = provider.get_housing_data_from_remote(
+                year=year,
+                month=month,
+                final_year=final_year,
+                final_month=final_month,
+                states=states
+            )
+            country_entries = provider.save_housing_data(entries or [])
+            saved_entries[country] += len(country_entries)
+        # newly published months are no longer hidden
+        unpublished.clear(country)
+    return saved_entries
+
+
+def parse_year_month(value: str):
+    """Parses 'YYYY-MM' into a (year, month) pair"""
+    year, month = value.split('-')
+    year_month = (int(year), int(month))
+    if not 1 <= year_month[1] <= 12:
+        raise ValueError(f'Invalid month in {value}')
+    return year_month
@@ -1,3 +1,2246 @@
-from django.test import TestCase
+import asyncio
+import httpx
+import json
+import math
+import os
+import requests
+import tempfile
+import threading
+import time
+from asgiref.sync import sync_to_async
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+from unittest import (
+    mock,
+    skipIf
+)
+from django.core.cache import cache
+from django.core.management import (
+    CommandError,
+    call_command
+)
+from django.db import connections
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
 
-# Create your tests here.
+from brazil.mixins import BrazilHousingDataMixin
+from brazil.views import (
+    AsyncRetrieveBrazilHousingData,
+    AsyncRetrieveBrazilHousingDataRange,
+    AsyncRetrieveBrazilHousingDataStatesRange,
+    RetrieveBrazilHousingDataStatesRange
+)
+from .background import (
+    DONE,
+    background_fills
+)
+from .catalogue import catalogue
+from .export import EXPORT_FIELDS
+from .metrics import (
+    housing_data_keys,
+    upstream_failures,
+    upstream_retries
+)
+from .models import (
+    Country,
+    CountryState,
+    CurrencyRate,
+    HousingData
+)
+from .registry import registry
+from .routers import READ_ONLY_DB_ALIAS
+from .singleflight import (
+    SingleFlight,
+    fcntl
+)
+from .serializers import (
+    HOUSING_DATA_ROW_FIELDS,
+    HousingDataRangeSerializer,
+    HousingDataValuesSerializer,
+    HousingDateStatesRangeSerializer,
+    HousingDateStatesSerializer
+)
+from .unpublished import unpublished
+from .upstream import UpstreamClient
+from .utils import (
+    LATEST_RATES_KEY,
+    clear_rates_cache,
+    delete_housing_data,
+    get_currency_date,
+    get_period,
+    get_rates,
+    get_year_month
+)
+
+
+def get_price(year, month, state):
+    return 100 + month
+
+
+def get_remote_entries(
+        mixin, year, month, final_year=None, final_month=None, states=[]):
+    """Returns what mixin.get_housing_data_from_remote() would for a remote
+    that has all the requested months
+    """
+    return [
+        {
+            'year': entry['year'],
+            'month': entry['month'],
+            'square_meter_price': 100,
+            'variation': 0.01,
+            'state_id': mixin.get_state_id_from_abbreviation(
+                entry['state']) if states else None,
+        }
+        for entry in mixin.get_requested_entries(
+            year, month, final_year, final_month, states)
+    ]
+
+
+class HousingDataFixtureMixin:
+    """Stores generated housing data for Brazil in test cases"""
+    fixtures = ['brazil']
+
+    def setUp(self):
+        super().setUp()
+        self.mixin = BrazilHousingDataMixin()
+        # rolling back changes to countries and states doesn't reload it
+        self.addCleanup(registry.invalidate)
+
+    def save_housing_data(
+            self,
+            years,
+            months=range(1, 13),
+            states=(None,),
+            square_meter_price=get_price,
+            variation=0.01,
+            **fields):
+        """Saves an entry for each of the months of years and states (None
+        for national data). square_meter_price and variation are values, or
+        functions of (year, month, state) returning them.
+        """
+        def get_value(value, year, month, state):
+            return value(year, month, state) if callable(value) else value
+
+        return self.mixin.save_housing_data([
+            {
+                'year': year,
+                'month': month,
+                'square_meter_price': get_value(
+                    square_meter_price, year, month, state),
+                'variation': get_value(variation, year, month, state),
+                'state_id': self.mixin.get_state_id_from_abbreviation(state)
+                if state is not None else None,
+                **fields,
+            }
+            for year in years
+            for month in months
+            for state in states
+        ])
+
+
+class HousingDataTestCase(HousingDataFixtureMixin, TestCase):
+    """Test case with the Brazil fixture. Reads stay on the default alias
+    (see api.routers.ReadOnlyRouter), as they run in the test's transaction.
+    """
+
+
+class HousingDataTransactionTestCase(
+        HousingDataFixtureMixin, TransactionTestCase):
+    """Test case with the Brazil fixture, whose data is committed, so GETs
+    read it through the readonly alias, if configured.
+    """
+    databases = '__all__'
+
+
+class LocalityRegistryTestCase(HousingDataTestCase):
+    """Countries and states are looked up in memory, and reloaded when they
+    change
+    """
+    def setUp(self):
+        super().setUp()
+        registry.invalidate()
+
+    def test_lookups_stop_hitting_the_db(self):
+        with self.assertNumQueries(2):
+            country_id = registry.get_country_id('brazil')
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_country_id('brazil'), country_id)
+            self.assertEqual(
+                registry.get_country_base_uri(country_id), 'brazil')
+            self.assertIn('brazil', registry.get_countries())
+            state_id = registry.get_state_id('brazil', 'SC')
+            self.assertEqual(registry.get_state_abbreviation(state_id), 'sc')
+            self.assertEqual(
+                registry.get_state_ids('brazil', ['sc', 'xx']), [state_id])
+            self.assertIn('sc', registry.get_country_states('brazil'))
+            with self.assertRaises(Country.DoesNotExist):
+                registry.get_country_id('narnia')
+            with self.assertRaises(CountryState.DoesNotExist):
+                registry.get_state_id('brazil', 'xx')
+
+    def test_saves_and_deletes_invalidate(self):
+        registry.get_country_id('brazil')
+        # and once committed, for the other threads
+        with self.captureOnCommitCallbacks() as callbacks:
+            country = Country.objects.create(name='Narnia', base_uri='narnia')
+        self.assertIn(registry.invalidate, callbacks)
+        self.assertEqual(registry.get_country_id('narnia'), country.id)
+
+        state = CountryState.objects.create(
+            name='Cair Paravel', abbreviation='cp', country=country)
+        self.assertEqual(registry.get_state_id('narnia', 'cp'), state.id)
+        state.abbreviation = 'cv'
+        state.save()
+        self.assertEqual(registry.get_state_id('narnia', 'cv'), state.id)
+        with self.assertRaises(CountryState.DoesNotExist):
+            registry.get_state_id('narnia', 'cp')
+
+        state.delete()
+        self.assertEqual(registry.get_country_states('narnia'), [])
+        country.delete()
+        with self.assertRaises(Country.DoesNotExist):
+            registry.get_country_id('narnia')
+
+
+class CatalogueTestCase(HousingDataTestCase):
+    """Countries and states are served from the catalogue, with ETags that
+    change along with them
+    """
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(catalogue.bump_version)
+
+    def get(self, url, etag=None):
+        headers = {'If-None-Match': etag} if etag is not None else {}
+        return self.client.get(url, headers=headers)
+
+    def test_etag(self):
+        for url in ('/housing/countries', '/housing/brazil/states'):
+            response = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Cache-Control'], 'public, no-cache')
+            etag = response['ETag']
+
+            # answered from memory
+            with self.assertNumQueries(0):
+                response = self.get(url, etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(self.get(url, '"other"').status_code, 200)
+            self.assertEqual(self.get(url, '*').status_code, 304)
+
+        self.assertIn(
+            'sc',
+            [
+                state['abbreviation']
+                for state in self.get('/housing/brazil/states').json()
+            ]
+        )
+        self.assertEqual(self.get('/housing/narnia/states').status_code, 404)
+
+    def test_changes_bump_the_version(self):
+        countries_etag = self.get('/housing/countries')['ETag']
+        states_etag = self.get('/housing/brazil/states')['ETag']
+        version = catalogue.get_version()
+
+        country = Country.objects.create(name='Narnia', base_uri='narnia')
+        self.assertNotEqual(catalogue.get_version(), version)
+        response = self.get('/housing/countries', countries_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'narnia', [country['base_uri'] for country in response.json()])
+        self.assertEqual(self.get('/housing/narnia/states').json(), [])
+        # the data of other countries is the same, and so are their ETags
+        self.assertEqual(
+            self.get('/housing/brazil/states', states_etag).status_code, 304)
+
+        state = CountryState.objects.create(
+            name='Cair Paravel', abbreviation='cp', country=country)
+        self.assertEqual(
+            [
+                state['abbreviation']
+                for state in self.get('/housing/narnia/states').json()
+            ],
+            ['cp']
+        )
+        state.delete()
+        self.assertEqual(self.get('/housing/narnia/states').json(), [])
+        country.delete()
+        self.assertEqual(self.get('/housing/narnia/states').status_code, 404)
+
+
+class HousingDataPeriodIndexTestCase(HousingDataTestCase):
+    """Range queries filter on HousingData.period and are served by
+    ix_country_state_period_hd.
+    """
+    INDEX = 'ix_country_state_period_hd'
+
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data(range(2019, 2023), states=(None, 'sc', 'rj'))
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        self.assertIn(self.INDEX, plan)
+        self.assertIn('period', plan)
+
+    def test_period_is_stored(self):
+        entry = HousingData.objects.filter(year=2020, month=3).first()
+        self.assertEqual(entry.period, 2020 * 12 + 2)
+
+    def test_single_month_uses_index(self):
+        self.assertUsesIndex(self.mixin.get_housing_data_from_db(2020, 5))
+        self.assertUsesIndex(self.mixin.get_housing_data_from_db(
+            2020, 5, states=['sc', 'rj']))
+
+    def test_range_uses_index(self):
+        self.assertUsesIndex(self.mixin.get_housing_data_from_db(
+            2019, 11, 2021, 2))
+        self.assertUsesIndex(self.mixin.get_housing_data_from_db(
+            2019, 11, 2021, 2, ['sc', 'rj']))
+
+    def test_rows_use_covering_index(self):
+        queryset = self.mixin.get_housing_data_from_db(
+            2019, 11, 2021, 2, ['sc', 'rj'])
+        plan = queryset.values_list(*HOUSING_DATA_ROW_FIELDS).explain()
+        self.assertIn(f'COVERING INDEX {self.INDEX}', plan)
+
+    def test_range_bounds(self):
+        entries = self.mixin.get_housing_data_from_db(2019, 11, 2021, 2)
+        self.assertEqual(
+            [(entry.year, entry.month) for entry in entries][:3],
+            [(2019, 11), (2019, 12), (2020, 1)]
+        )
+        self.assertEqual(entries.count(), 16)
+
+        entries = self.mixin.get_housing_data_from_db(
+            2020, 3, 2020, 5, ['sc', 'rj'])
+        self.assertEqual(
+            [
+                (entry.state.abbreviation, entry.month)
+                for entry in entries
+            ],
+            [('rj', 3), ('rj', 4), ('rj', 5), ('sc', 3), ('sc', 4), ('sc', 5)]
+        )
+
+    def test_same_year_range(self):
+        # not the whole year, as either bound matched every month of it
+        for final_month in (5, 12):
+            entries = self.mixin.get_housing_data_from_db(
+                2020, 5, 2020, final_month)
+            self.assertEqual(
+                [(entry.year, entry.month) for entry in entries],
+                [(2020, month) for month in range(5, final_month + 1)]
+            )
+
+
+class CumulativeLogGrowthTestCase(HousingDataTestCase):
+    """Range variations come from HousingData.cumulative_log_growth, which
+    ingest keeps up to date.
+    """
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data(
+            range(2019, 2023),
+            square_meter_price=100,
+            variation=lambda year, month, state: (month - 6) / 100
+        )
+
+    def get_product_variation(self, first_period, last_period, state=None):
+        variation = 1.0
+        for entry_variation in HousingData.objects.filter(
+                period__range=(first_period, last_period),
+                state__abbreviation=state
+                ).order_by('period').values_list('variation', flat=True):
+            variation *= 1 + float(entry_variation)
+        return variation - 1
+
+    def test_range_variation(self):
+        self.assertAlmostEqual(
+            self.mixin.get_range_variations(2019, 3, 2021, 8)[None],
+            self.get_product_variation(2019 * 12 + 2, 2021 * 12 + 7),
+            places=12
+        )
+
+    def test_suffix_is_recomputed(self):
+        self.save_housing_data([2020], [5], variation=0.5)
+        self.assertAlmostEqual(
+            self.mixin.get_range_variations(2020, 1, 2022, 12)[None],
+            self.get_product_variation(2020 * 12, 2022 * 12 + 11),
+            places=12
+        )
+
+    def test_deleted_months(self):
+        self.save_housing_data([2020], states=['sc'], variation=0.02)
+        self.assertEqual(delete_housing_data(HousingData.objects.filter(
+            period__in=[get_period(2020, 5), get_period(2021, 2)])), 3)
+        self.assertAlmostEqual(
+            self.mixin.get_range_variations(2020, 1, 2022, 12)[None],
+            self.get_product_variation(2020 * 12, 2022 * 12 + 11),
+            places=12
+        )
+        self.assertAlmostEqual(
+            self.mixin.get_range_variations(2020, 1, 2020, 12, ['sc'])['sc'],
+            self.get_product_variation(2020 * 12, 2020 * 12 + 11, 'sc'),
+            places=12
+        )
+        # a single delete query, with no signal receivers on the way
+        with self.assertNumQueries(1):
+            HousingData.objects.filter(year=2022).delete()
+
+
+class SaveHousingDataTestCase(HousingDataTestCase):
+    """Ingest upserts entries on (country, year, month, state)"""
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data([2020], states=(None, 'sc', 'rj'))
+
+    def get_stored_values(self):
+        return {
+            (entry.state_id, entry.period): (
+                entry.square_meter_price,
+                entry.variation,
+                entry.currency,
+                entry.cumulative_log_growth,
+            )
+            for entry in HousingData.objects.all()
+        }
+
+    def test_reingest(self):
+        sc_id = self.mixin.get_state_id_from_abbreviation('sc')
+        entries = [
+            {
+                'year': 2020,
+                'month': month,
+                'square_meter_price': 200,
+                'variation': 0.02,
+                'currency': 'brl',
+                'state_id': state_id,
+            }
+            for month in (3, 4, 5)
+            for state_id in (None, sc_id)
+        ] + [
+            # new months are created along with the updated ones
+            {
+                'year': 2021,
+                'month': 1,
+                'square_meter_price': 300,
+                'variation': 0.01,
+                'state_id': state_id,
+            }
+            for state_id in (None, sc_id)
+        ]
+        saved_entries = self.mixin.save_housing_data(entries, batch_size=2)
+
+        self.assertEqual(HousingData.objects.count(), 38)
+        stored_values = self.get_stored_values()
+        self.assertEqual(
+            [
+                (entry.year, entry.month, entry.state_id)
+                for entry in saved_entries
+            ],
+            [
+                (entry['year'], entry['month'], entry['state_id'])
+                for entry in entries
+            ]
+        )
+        for entry in saved_entries:
+            self.assertIsNotNone(entry.pk)
+            self.assertEqual(
+                (
+                    entry.square_meter_price,
+                    entry.variation,
+                    entry.currency,
+                    entry.cumulative_log_growth,
+                ),
+                stored_values[(entry.state_id, entry.period)]
+            )
+        self.assertEqual(
+            stored_values[(sc_id, get_period(2020, 4))][:3],
+            (200, Decimal('0.0200'), 'brl')
+        )
+        self.assertEqual(
+            stored_values[(None, get_period(2020, 4))][:3],
+            (200, Decimal('0.0200'), 'brl')
+        )
+        # the months after the updated ones accumulate their variation
+        self.assertAlmostEqual(
+            stored_values[(None, get_period(2020, 12))][3],
+            9 * math.log(1.01) + 3 * math.log(1.02),
+            places=12
+        )
+
+    def test_duplicate_entries(self):
+        entries = self.mixin.save_housing_data([
+            {
+                'year': 2020,
+                'month': 6,
+                'square_meter_price': square_meter_price,
+                'variation': 0.01,
+            }
+            for square_meter_price in (150, 160)
+        ])
+        # the later entry wins
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(HousingData.objects.count(), 36)
+        self.assertEqual(
+            HousingData.objects.get(
+                state__isnull=True, year=2020, month=6).square_meter_price,
+            160
+        )
+
+
+class UnpublishedHousingDataTestCase(HousingDataTestCase):
+    """Months the remote had no data for are not fetched again"""
+
+    class RemoteMixin(BrazilHousingDataMixin):
+        def __init__(self, published_period):
+            self.published_period = published_period
+            self.remote_calls = 0
+
+        def get_housing_data_from_remote(
+                self, year, month, final_year=None, final_month=None,
+                states=[]):
+            self.remote_calls += 1
+            return [
+                {
+                    'year': entry['year'],
+                    'month': entry['month'],
+                    'square_meter_price': 100,
+                    'variation': 0.01,
+                    'state_id': self.get_state_id_from_abbreviation(
+                        entry['state']) if states else None,
+                }
+                for entry in self.get_requested_entries(
+                    year, month, final_year, final_month, states)
+                if get_period(entry['year'], entry['month'])
+                <= self.published_period
+            ]
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.current_period = unpublished.get_current_period()
+        self.mixin = self.RemoteMixin(self.current_period - 2)
+
+    def get_housing_data(self, period, final_period=None, states=[]):
+        final_year, final_month = get_year_month(final_period)\
+            if final_period is not None else (None, None)
+        return list(self.mixin.get_housing_data(
+            *get_year_month(period), final_year, final_month, states))
+
+    def test_unpublished_month_is_not_fetched_again(self):
+        self.assertEqual(self.get_housing_data(self.current_period - 1), [])
+        self.assertEqual(self.get_housing_data(self.current_period - 1), [])
+        self.assertEqual(self.mixin.remote_calls, 1)
+
+    def test_latest_published_period(self):
+        entries = self.get_housing_data(
+            self.current_period - 3, self.current_period - 1)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(
+            self.get_housing_data(self.current_period - 1, states=['sc']), [])
+        self.assertEqual(self.mixin.remote_calls, 1)
+
+    def test_future_month_is_not_fetched(self):
+        self.assertEqual(self.get_housing_data(self.current_period + 1), [])
+        self.assertEqual(self.mixin.remote_calls, 0)
+
+
+class MissingBlocksTestCase(HousingDataTestCase):
+    """Missing keys are fetched in as few contiguous blocks as possible"""
+
+    class RemoteMixin(BrazilHousingDataMixin):
+        def __init__(self):
+            self.remote_calls = []
+
+        def get_housing_data_from_remote(
+                self, year, month, final_year=None, final_month=None,
+                states=[]):
+            self.remote_calls.append(
+                (year, month, final_year, final_month, states))
+            return get_remote_entries(
+                self, year, month, final_year, final_month, states)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.remote_mixin = self.RemoteMixin()
+
+    def plan(self, *keys, coalesce=True):
+        return self.mixin.plan_missing_blocks(
+            set(
+                (get_period(2020, month), state)
+                for months, state in keys
+                for month in months
+            ),
+            coalesce
+        )
+
+    def test_hole_in_the_middle(self):
+        self.assertEqual(
+            self.plan(([1, 2, 3, 6, 7], 'sc'), ([4], None)),
+            [
+                (get_period(2020, 1), get_period(2020, 3), ['sc']),
+                (get_period(2020, 4), get_period(2020, 4), []),
+                (get_period(2020, 6), get_period(2020, 7), ['sc']),
+            ]
+        )
+
+    def test_partially_stored_states(self):
+        self.assertEqual(
+            self.plan(
+                (range(1, 13), 'sc'),
+                (range(1, 7), 'rj'),
+                (range(1, 7), 'ac'),
+                (range(1, 13), None),
+            ),
+            [
+                (get_period(2020, 1), get_period(2020, 6), ['ac', 'rj']),
+                (get_period(2020, 1), get_period(2020, 12), []),
+                (get_period(2020, 1), get_period(2020, 12), ['sc']),
+            ]
+        )
+
+    def test_without_coalescing(self):
+        self.assertEqual(
+            self.plan(([1, 2], 'sc'), ([1], None), coalesce=False),
+            [
+                (get_period(2020, 1), get_period(2020, 1), []),
+                (get_period(2020, 1), get_period(2020, 1), ['sc']),
+                (get_period(2020, 2), get_period(2020, 2), ['sc']),
+            ]
+        )
+
+    def test_fill_holes(self):
+        self.save_housing_data(
+            [2020], [1, 2, 3, 4, 7, 8, 9, 10, 11, 12], ['sc'])
+        self.save_housing_data([2020], range(7, 13), ['rj'])
+        entries = self.remote_mixin.get_housing_data(
+            2020, 1, 2020, 12, ['sc', 'rj'])
+        self.assertEqual(len(entries), 24)
+        self.assertEqual(sorted(self.remote_mixin.remote_calls), [
+            (2020, 1, 2020, 6, ['rj']),
+            (2020, 5, 2020, 6, ['sc']),
+        ])
+        self.assertEqual(HousingData.objects.filter(
+            state__abbreviation__in=['sc', 'rj']).count(), 24)
+
+        self.remote_mixin.remote_calls.clear()
+        self.remote_mixin.get_housing_data(2020, 1, 2020, 12, ['sc', 'rj'])
+        self.assertEqual(self.remote_mixin.remote_calls, [])
+
+    def test_stored_range_is_read_once(self):
+        self.save_housing_data([2020], states=['sc', 'rj'])
+        with self.assertNumQueries(1):
+            rows = self.mixin.get_housing_data_rows(
+                self.remote_mixin.get_housing_data(
+                    2020, 1, 2020, 12, ['sc', 'rj']))
+        self.assertEqual(len(rows), 24)
+        self.assertEqual(self.remote_mixin.remote_calls, [])
+
+    def test_fill_range_edges(self):
+        self.save_housing_data([2020])
+        entries = self.remote_mixin.get_housing_data(2019, 12, 2021, 1)
+        self.assertEqual(len(entries), 14)
+        # single months are requested without final values
+        self.assertEqual(sorted(self.remote_mixin.remote_calls), [
+            (2019, 12, None, None, []),
+            (2021, 1, None, None, []),
+        ])
+
+    def test_fill_updates_later_months(self):
+        # the months stored after a hole accumulate its variation once filled
+        self.save_housing_data([2020], [1, 2, 4])
+        rows = self.mixin.get_housing_data_rows(
+            self.remote_mixin.get_housing_data(2020, 1, 2020, 4))
+        self.assertEqual([row[2] for row in rows], [1, 2, 3, 4])
+        self.assertAlmostEqual(rows[-1][5], 4 * math.log(1.01), places=12)
+
+    def test_fill_individually(self):
+        self.save_housing_data([2020], [2])
+        self.remote_mixin.get_housing_data(
+            2020, 1, 2020, 3, get_individual_remote=True)
+        self.assertEqual(sorted(self.remote_mixin.remote_calls), [
+            (2020, 1, None, None, []),
+            (2020, 3, None, None, []),
+        ])
+
+
+class BackgroundFillTestCase(HousingDataTransactionTestCase):
+    """Stale-while-revalidate requests don't wait on the remotes"""
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        published_mixin = UnpublishedHousingDataTestCase.RemoteMixin(
+            get_period(2023, 12))
+        patcher = mock.patch.object(
+            BrazilHousingDataMixin, 'get_housing_data_from_remote',
+            lambda mixin, *args, **kwargs:
+                published_mixin.get_housing_data_from_remote(*args, **kwargs)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_missing_months_are_filled_in_background(self):
+        db_entries, missing_keys, token = \
+            self.mixin.get_stored_housing_data_and_fill(2023, 1, 2023, 3)
+        self.assertEqual(list(db_entries), [])
+        self.assertEqual(
+            self.mixin.get_missing_periods(missing_keys),
+            ['2023-01', '2023-02', '2023-03']
+        )
+
+        background_fills.wait()
+        self.assertEqual(background_fills.get_status(token), DONE)
+        db_entries, missing_keys, token = \
+            self.mixin.get_stored_housing_data_and_fill(2023, 1, 2023, 3)
+        self.assertEqual(len(db_entries), 3)
+        self.assertEqual(missing_keys, set())
+        self.assertIsNone(token)
+
+    def test_respond_async_preference(self):
+        response = self.client.get(
+            '/housing/brazil/2023/1', headers={'Prefer': 'respond-async'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['X-Missing-Periods'], '2023-01')
+        background_fills.wait()
+        response = self.client.get(
+            '/housing/brazil/2023/1', headers={'Prefer': 'respond-async'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Fill-Token', response)
+
+
+class ColumnarLayoutTestCase(HousingDataTestCase):
+    """Range data can be rendered as columns instead of nested months"""
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data([2020], [1, 2, 3], ['sc'])
+        self.save_housing_data([2020], [2, 3], ['rj'])
+        self.rows = self.mixin.get_housing_data_rows(
+            self.mixin.get_housing_data_from_db(
+                2020, 1, 2020, 3, ['sc', 'rj']))
+
+    def test_states_columns(self):
+        columns = HousingDateStatesRangeSerializer.represent_columns(self.rows)
+        rows = HousingDateStatesRangeSerializer.represent_rows(self.rows)
+        self.assertEqual(columns['periods'], ['2020-01', '2020-02', '2020-03'])
+        self.assertEqual(
+            columns['states']['sc']['square_meter_prices'],
+            [101.0, 102.0, 103.0]
+        )
+        self.assertEqual(
+            columns['states']['rj']['square_meter_prices'],
+            [None, 102.0, 103.0]
+        )
+        self.assertEqual(
+            columns['states']['rj']['variation'], rows['rj']['variation'])
+
+    def test_content_negotiation(self):
+        url = '/housing/brazil/sc/2020/1/2020/3'
+        response = self.client.get(
+            url, headers={'Accept': 'application/vnd.housing.columnar+json'})
+        self.assertEqual(
+            response.json()['periods'], ['2020-01', '2020-02', '2020-03'])
+        self.assertIn('monthly', self.client.get(url).json()['sc'])
+
+
+class RangePaginationTestCase(HousingDataTestCase):
+    """Range requests can be crawled page by page"""
+    URL = '/housing/brazil/rj-sc/2019/3/2020/8'
+
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data(
+            (2019, 2020),
+            states=('sc', 'rj'),
+            variation=lambda year, month, state: month / 1000
+        )
+
+    def test_pages(self):
+        url = self.URL + '?page_size=7'
+        monthly = {}
+        page_count = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page_count += 1
+            for state, data in response.json().items():
+                self.assertLessEqual(len(data['monthly']), 7)
+                monthly.setdefault(state, {}).update(data['monthly'])
+                self.assertEqual(
+                    data['variation'],
+                    self.client.get(self.URL).json()[state]['variation']
+                )
+            url = response.headers.get('Link', '')[1:].split('>')[0]
+
+        self.assertEqual(page_count, 6)
+        self.assertEqual(monthly, {
+            state: data['monthly']
+            for state, data in self.client.get(self.URL).json().items()
+        })
+
+    @override_settings(HOUSING_MAX_PAGE_SIZE=10)
+    def test_max_page_size(self):
+        response = self.client.get(self.URL)
+        self.assertEqual(len(response.json()['rj']['monthly']), 10)
+        self.assertIn('rel="next"', response['Link'])
+        self.assertEqual(
+            self.client.get(self.URL + '?page_size=11').status_code, 400)
+
+
+class CurrencyConversionTestCase(HousingDataTestCase):
+    """Prices are stored as published and converted when read"""
+    URL = '/housing/brazil/2020/1/2020/2'
+
+    def setUp(self):
+        super().setUp()
+        clear_rates_cache()
+        self.addCleanup(clear_rates_cache)
+        self.save_housing_data(
+            [2020], [1], square_meter_price=1000, currency='brl')
+        # stored in dolars, as before prices were kept as published
+        self.save_housing_data([2020], [2], square_meter_price=250)
+        CurrencyRate.objects.bulk_create([
+            CurrencyRate(date=rate_date, currency=currency, rate=rate)
+            for rate_date, rates in (
+                (date(2020, 1, 31), {'brl': 5.0, 'eur': 0.9}),
+                (date(2020, 2, 29), {'brl': 4.0, 'eur': 0.8}),
+            )
+            for currency, rate in rates.items()
+        ])
+        # downloads of either kind (the async views use the latter)
+        patcher = mock.patch('api.utils.fetch_dolar_rates')
+        self.fetch_dolar_rates = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('api.utils.afetch_dolar_rates')
+        self.afetch_dolar_rates = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_downloaded_rates(self, rates: dict):
+        self.fetch_dolar_rates.return_value = (rates, True)
+        self.afetch_dolar_rates.return_value = (rates, True)
+
+    def get_download_count(self):
+        return self.fetch_dolar_rates.call_count\
+            + self.afetch_dolar_rates.await_count
+
+    def get_prices(self, query: str = ''):
+        response = self.client.get(self.URL + query)
+        self.assertEqual(response.status_code, 200)
+        return {
+            month: values['square_meter_price']
+            for month, values in response.json()['monthly'].items()
+        }
+
+    def test_conversion(self):
+        self.assertEqual(
+            self.get_prices(), {'01/2020': '200.00', '02/2020': '250.00'})
+        self.assertEqual(
+            self.get_prices('?currency=EUR'),
+            {'01/2020': '180.00', '02/2020': '200.00'}
+        )
+        self.assertEqual(
+            self.get_prices('?currency=brl'),
+            {'01/2020': '1000.00', '02/2020': '1000.00'}
+        )
+        self.assertEqual(self.get_download_count(), 0)
+        self.assertNotEqual(
+            self.client.get(self.URL)['ETag'],
+            self.client.get(self.URL + '?currency=eur')['ETag']
+        )
+
+    async def test_async_conversion(self):
+        view = AsyncRetrieveBrazilHousingDataRange.as_view()
+        with mock.patch('api.mixins.get_rates') as get_rates:
+            response = await view(
+                AsyncRequestFactory().get(self.URL + '?currency=eur'),
+                year=2020, month=1, final_year=2020, final_month=2
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {
+                month: values['square_meter_price']
+                for month, values in json.loads(
+                    response.content)['monthly'].items()
+            },
+            {'01/2020': '180.00', '02/2020': '200.00'}
+        )
+        # rates are looked up with aget_rates() instead
+        get_rates.assert_not_called()
+
+    def test_unknown_currency(self):
+        self.set_downloaded_rates({'brl': 5.0})
+        for _ in range(2):
+            self.assertEqual(
+                self.client.get(self.URL + '?currency=xyz').status_code, 400)
+        self.assertEqual(
+            self.client.get(self.URL + '?currency=a-b').status_code, 400)
+        # checked against the stored currencies, without downloading
+        self.assertEqual(self.get_download_count(), 0)
+
+    def test_fill_does_not_download_rates(self):
+        class RemoteMixin(BrazilHousingDataMixin):
+            def get_housing_data_from_remote(
+                    self, year, month, final_year=None, final_month=None,
+                    states=[]):
+                return [
+                    {
+                        'year': entry['year'],
+                        'month': entry['month'],
+                        'square_meter_price': 500,
+                        'currency': self.CURRENCY,
+                        'variation': 0.01,
+                    }
+                    for entry in self.get_requested_entries(
+                        year, month, final_year, final_month)
+                ]
+
+        self.set_downloaded_rates({'brl': 5.0, 'eur': 0.9, 'usd': 1.0})
+        entries = RemoteMixin().get_housing_data(2021, 1, 2021, 3)
+        self.assertEqual(len(entries), 3)
+        # ingest doesn't wait on the currency API
+        self.assertEqual(self.get_download_count(), 0)
+
+        # the first read downloads the rates of the filled months and
+        # stores them for the next ones
+        for _ in range(2):
+            clear_rates_cache()
+            response = self.client.get(
+                '/housing/brazil/2021/1/2021/3?currency=eur')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.get_download_count(), 3)
+        self.assertEqual(
+            set(CurrencyRate.objects.filter(currency='brl').values_list(
+                'date', flat=True)),
+            {
+                date(2020, 1, 31),
+                date(2020, 2, 29),
+                date(2021, 1, 31),
+                date(2021, 2, 28),
+                date(2021, 3, 31),
+            }
+        )
+
+    @mock.patch.object(
+        BrazilHousingDataMixin, 'get_housing_data_from_remote',
+        return_value=[])
+    def test_analytics_mixed_currencies(self, get_housing_data_from_remote):
+        def get_analytics(query: str = ''):
+            response = self.client.get(
+                '/housing/brazil/analytics/2020/1/2020/2?window=2' + query)
+            self.assertEqual(response.status_code, 200)
+            return response.json()
+
+        # converted to dolars by default, before the window math
+        analytics = get_analytics()
+        self.assertEqual(analytics['currency'], 'usd')
+        self.assertAlmostEqual(analytics['cagr'], 1.25 ** 12 - 1)
+        self.assertEqual(analytics['monthly']['02/2020']['rolling_mean'], 225)
+
+        analytics = get_analytics('&currency=brl')
+        self.assertEqual(analytics['currency'], 'brl')
+        self.assertEqual(analytics['cagr'], 0)
+        self.assertEqual(
+            analytics['monthly']['02/2020']['rolling_mean'], 1000)
+
+        self.assertEqual(self.client.get(
+            '/housing/brazil/analytics/2020/1/2020/2?currency=xyz'
+        ).status_code, 400)
+        self.assertEqual(self.get_download_count(), 0)
+
+    async def test_async_unknown_currency(self):
+        view = AsyncRetrieveBrazilHousingDataRange.as_view()
+        response = await view(
+            AsyncRequestFactory().get(self.URL + '?currency=xyz'),
+            year=2020, month=1, final_year=2020, final_month=2
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_download_count(), 0)
+
+    def test_unknown_currency_without_stored_rates(self):
+        CurrencyRate.objects.all().delete()
+        self.set_downloaded_rates({'brl': 5.0})
+        for _ in range(3):
+            self.assertEqual(
+                self.client.get(self.URL + '?currency=xyz').status_code, 400)
+        # the currencies are downloaded once, then cached
+        self.assertEqual(self.get_download_count(), 1)
+
+
+class CurrencyRatesTestCase(TestCase):
+    """Rates are looked up in the LRU, then in the DB, and only then
+    downloaded
+    """
+    STORED_DATE = date(2020, 1, 31)
+    MISSING_DATE = date(2020, 2, 29)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        clear_rates_cache()
+        self.addCleanup(cache.clear)
+        self.addCleanup(clear_rates_cache)
+        CurrencyRate.objects.bulk_create([
+            CurrencyRate(date=self.STORED_DATE, currency='brl', rate=5.0),
+            CurrencyRate(date=self.STORED_DATE, currency='eur', rate=0.9),
+        ])
+        patcher = mock.patch('api.utils.fetch_dolar_rates')
+        self.fetch_dolar_rates = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup_order(self):
+        # the DB, with a single query for every pair
+        with self.assertNumQueries(1):
+            rates = get_rates(['BRL', 'eur', 'usd'], [self.STORED_DATE])
+        self.assertEqual(rates, {
+            (self.STORED_DATE, 'brl'): 5.0,
+            (self.STORED_DATE, 'eur'): 0.9,
+            (self.STORED_DATE, 'usd'): 1.0,
+        })
+        # then the LRU
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_rates(['brl', 'eur'], [self.STORED_DATE])[
+                    (self.STORED_DATE, 'brl')], 5.0)
+
+        self.fetch_dolar_rates.return_value = (
+            {'brl': 4.0, 'eur': 0.8, 'usd': 1.0}, True)
+        rates = get_rates(['brl'], [self.STORED_DATE, self.MISSING_DATE])
+        self.assertEqual(rates[(self.MISSING_DATE, 'brl')], 4.0)
+        # only the day missing is downloaded, with every currency stored
+        self.fetch_dolar_rates.assert_called_once_with(self.MISSING_DATE)
+        self.assertEqual(
+            CurrencyRate.objects.filter(date=self.MISSING_DATE).count(), 3)
+        self.assertEqual(
+            get_rates(['eur'], [self.MISSING_DATE])[
+                (self.MISSING_DATE, 'eur')], 0.8)
+        self.assertEqual(self.fetch_dolar_rates.call_count, 1)
+
+    def test_bulk_insert(self):
+        # currency codes longer than the field are left out
+        day_rates = {f'c{index:03}': float(index) for index in range(300)}
+        day_rates.update({'brl': 4.0, 'toolongcode': 1.0})
+        self.fetch_dolar_rates.return_value = (day_rates, True)
+        with CaptureQueriesContext(connections['default']) as context:
+            get_rates(['brl'], [self.MISSING_DATE])
+        inserts = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('INSERT')
+        ]
+        # every currency of the day in a single query
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(
+            CurrencyRate.objects.filter(date=self.MISSING_DATE).count(),
+            301)
+        self.assertFalse(
+            CurrencyRate.objects.filter(currency='toolongcode').exists())
+
+    def test_latest_rates_are_cached(self):
+        # the day is not published yet, so the latest rates are used
+        self.fetch_dolar_rates.return_value = ({'brl': 4.0}, False)
+        for _ in range(3):
+            self.assertEqual(
+                get_rates(['brl'], [self.MISSING_DATE])[
+                    (self.MISSING_DATE, 'brl')], 4.0)
+        self.assertEqual(self.fetch_dolar_rates.call_count, 1)
+        self.assertFalse(
+            CurrencyRate.objects.filter(date=self.MISSING_DATE).exists())
+
+        # and downloaded again once they expire
+        cache.delete(LATEST_RATES_KEY.format(date=self.MISSING_DATE))
+        get_rates(['brl'], [self.MISSING_DATE])
+        self.assertEqual(self.fetch_dolar_rates.call_count, 2)
+
+    @override_settings(HOUSING_LATEST_RATES_TTL=0)
+    def test_latest_rates_ttl(self):
+        self.fetch_dolar_rates.return_value = ({'brl': 4.0}, False)
+        for _ in range(2):
+            get_rates(['brl'], [self.MISSING_DATE])
+        self.assertEqual(self.fetch_dolar_rates.call_count, 2)
+
+
+class MetricsTestCase(HousingDataTestCase):
+    """Responses carry the time spent on each phase, which /metrics
+    aggregates
+    """
+    URL = '/housing/brazil/2020/1/2020/3?currency=eur'
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        clear_rates_cache()
+        self.addCleanup(clear_rates_cache)
+        self.save_housing_data([2020], [1, 2, 3], currency='brl')
+        CurrencyRate.objects.bulk_create([
+            CurrencyRate(
+                date=get_currency_date(2020, month),
+                currency=currency,
+                rate=rate
+            )
+            for month in (1, 2, 3)
+            for currency, rate in (('brl', 5.0), ('eur', 0.9))
+        ])
+
+    def get_metric(self, line_start):
+        for line in self.client.get('/metrics').content.decode().split('\n'):
+            if line.startswith(line_start + ' '):
+                return float(line.split()[-1])
+        return 0
+
+    def test_server_timing(self):
+        response = self.client.get(self.URL)
+        self.assertEqual(response.status_code, 200)
+        durations = {
+            phase: float(duration[len('dur='):])
+            for phase, duration in (
+                timing.split(';')
+                for timing in response['Server-Timing'].split(', ')
+            )
+        }
+        self.assertLessEqual({'db', 'fx', 'serialize', 'total'}, set(
+            durations))
+        # phases don't overlap, e.g. conversion is not serialization
+        self.assertLessEqual(
+            durations['db'] + durations['fx'] + durations['serialize'],
+            durations['total'] + 0.2
+        )
+
+    def test_metrics(self):
+        keys = 'housing_data_keys_total{country="brazil",source="db"}'
+        stored_keys = self.get_metric(keys)
+        self.assertEqual(self.client.get(self.URL).status_code, 200)
+        self.assertEqual(self.get_metric(keys), stored_keys + 3)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['Content-Type'],
+            'text/plain; version=0.0.4; charset=utf-8'
+        )
+        content = response.content.decode()
+        for line in (
+                '# TYPE housing_request_duration_seconds histogram',
+                '# TYPE housing_data_keys counter',
+                f'# HELP housing_data_keys {housing_data_keys.documentation}'):
+            self.assertIn(line, content.split('\n'))
+        self.assertGreaterEqual(self.get_metric(
+            'housing_phase_duration_seconds_count'
+            '{phase="fx",country="brazil"}'), 1)
+        self.assertRegex(
+            content,
+            r'housing_request_duration_seconds_bucket\{endpoint="[^"]+",'
+            r'country="brazil",status="200",le="\+Inf"\} [1-9]'
+        )
+
+
+async def aget_remote_entries(mixin, *args, **kwargs):
+    return get_remote_entries(mixin, *args, **kwargs)
+
+
+class AsyncHousingDataViewTestCase(HousingDataTestCase):
+    """The async views answer as their DRF counterparts, fetching missing
+    months through aget_housing_data_from_remote()
+    """
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.save_housing_data([2020], states=(None, 'sc', 'rj'))
+        patcher = mock.patch.object(
+            BrazilHousingDataMixin, 'aget_housing_data_from_remote',
+            autospec=True, side_effect=aget_remote_entries)
+        self.aget_housing_data_from_remote = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def get(self, view_class, headers={}, **kwargs):
+        return await view_class.as_view()(
+            AsyncRequestFactory().get('/', headers=headers), **kwargs)
+
+    async def test_stored(self):
+        kwargs = {
+            'states': 'sc-rj',
+            'year': 2020,
+            'month': 2,
+            'final_year': 2020,
+            'final_month': 4,
+        }
+        response = await self.get(
+            AsyncRetrieveBrazilHousingDataStatesRange, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.aget_housing_data_from_remote.assert_not_called()
+
+        # as rendered by the DRF view
+        drf_response = (await sync_to_async(
+            RetrieveBrazilHousingDataStatesRange.as_view())(
+                RequestFactory().get('/'), **kwargs)).render()
+        self.assertEqual(response.content, drf_response.content)
+        self.assertEqual(response['ETag'], drf_response['ETag'])
+        self.assertEqual(
+            list(json.loads(response.content)), ['rj', 'sc'])
+
+    async def test_fill(self):
+        response = await self.get(
+            AsyncRetrieveBrazilHousingDataRange,
+            year=2020, month=11, final_year=2021, final_month=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [
+                call.args[1:5]
+                for call in
+                self.aget_housing_data_from_remote.await_args_list
+            ],
+            [(2021, 1, 2021, 2)]
+        )
+        data = json.loads(response.content)
+        self.assertEqual(
+            list(data['monthly']),
+            ['11/2020', '12/2020', '01/2021', '02/2021']
+        )
+        self.assertAlmostEqual(data['variation'], 1.01 ** 4 - 1)
+        self.assertEqual(
+            await HousingData.objects.filter(year=2021).acount(), 2)
+
+    async def test_not_modified(self):
+        response = await self.get(
+            AsyncRetrieveBrazilHousingData, year=2020, month=5)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = await self.get(
+            AsyncRetrieveBrazilHousingData,
+            headers={'If-None-Match': etag}, year=2020, month=5)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    async def test_not_found(self):
+        # the remote doesn't have it either
+        self.aget_housing_data_from_remote.side_effect = None
+        self.aget_housing_data_from_remote.return_value = []
+        response = await self.get(
+            AsyncRetrieveBrazilHousingData, year=2010, month=5)
+        self.assertEqual(response.status_code, 404)
+        self.aget_housing_data_from_remote.assert_awaited_once()
+
+
+class ReadOnlyRouterTestCase(HousingDataTransactionTestCase):
+    """GETs read stored data through the readonly alias"""
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data([2020], states=('sc', 'rj'))
+
+    def test_range_is_read_from_readonly_alias(self):
+        if READ_ONLY_DB_ALIAS not in connections.settings:
+            self.skipTest('no readonly alias (HOUSING_SQLITE_CONCURRENT=0)')
+        with CaptureQueriesContext(connections[READ_ONLY_DB_ALIAS]) as\
+                queries:
+            response = self.client.get('/housing/brazil/rj-sc/2020/1/2020/12')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['sc']['monthly']), 12)
+        self.assertIn('api_housingdata', ' '.join(
+            query['sql'].lower() for query in queries))
+
+    def test_export_is_read_from_readonly_alias(self):
+        if READ_ONLY_DB_ALIAS not in connections.settings:
+            self.skipTest('no readonly alias (HOUSING_SQLITE_CONCURRENT=0)')
+        response = self.client.get('/housing/export?format=ndjson')
+        self.assertEqual(response.status_code, 200)
+        # rows are read while the response is streamed
+        with CaptureQueriesContext(connections[READ_ONLY_DB_ALIAS]) as\
+                queries:
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 24)
+        self.assertIn('api_housingdata', ' '.join(
+            query['sql'].lower() for query in queries))
+
+
+@override_settings(HOUSING_CACHE_MAX_AGE=1000, HOUSING_RECENT_CACHE_MAX_AGE=10)
+class ConditionalHousingDataTestCase(HousingDataTestCase):
+    """Responses have strong ETags, answer 304 to matching If-None-Match
+    headers, and are cached longer once their months can't change
+    """
+    URL = '/housing/brazil/2019/1/2019/12'
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.save_housing_data((2019, 2020))
+        # the remote has nothing else (with HOUSING_ASYNC_VIEWS too)
+        for patcher in (
+                mock.patch.object(
+                    BrazilHousingDataMixin, 'get_housing_data_from_remote',
+                    return_value=[]),
+                mock.patch.object(
+                    BrazilHousingDataMixin, 'aget_housing_data_from_remote',
+                    return_value=[])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_etag(self):
+        etag = self.client.get(self.URL)['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertEqual(self.client.get(self.URL)['ETag'], etag)
+        # depends on the format
+        self.assertNotEqual(
+            self.client.get(self.URL, headers={
+                'Accept': 'application/vnd.housing.columnar+json'})['ETag'],
+            etag
+        )
+        # and on the data
+        self.save_housing_data([2019], [6], square_meter_price=1)
+        self.assertNotEqual(self.client.get(self.URL)['ETag'], etag)
+
+    def test_if_none_match(self):
+        response = self.client.get(self.URL)
+        etag = response['ETag']
+        for if_none_match in (etag, f'"other", {etag}', '*'):
+            response = self.client.get(
+                self.URL, headers={'If-None-Match': if_none_match})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(
+                response['Cache-Control'], 'public, max-age=1000')
+
+        response = self.client.get(
+            self.URL, headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+    def get_max_age(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['Cache-Control']
+
+    def test_cache_max_age(self):
+        # complete, and before the latest stored month, 12/2020
+        self.assertEqual(
+            self.get_max_age(self.URL), 'public, max-age=1000')
+        self.assertEqual(
+            self.get_max_age('/housing/brazil/2020/11'),
+            'public, max-age=1000'
+        )
+        # up to the latest month, which may still be revised
+        self.assertEqual(
+            self.get_max_age('/housing/brazil/2020/1/2020/12'),
+            'public, max-age=10'
+        )
+        self.assertEqual(
+            self.get_max_age('/housing/brazil/2020/12'),
+            'public, max-age=10'
+        )
+
+    def test_incomplete_cache_max_age(self):
+        HousingData.objects.filter(year=2019, month=6).delete()
+        self.assertEqual(
+            self.get_max_age(self.URL), 'public, max-age=10')
+
+
+@mock.patch.object(
+    BrazilHousingDataMixin, 'get_housing_data_from_remote', autospec=True,
+    side_effect=get_remote_entries)
+class HousingDataBatchTestCase(HousingDataTestCase):
+    """POST /housing/batch answers each query as its GET endpoint would"""
+    URL = '/housing/batch'
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.save_housing_data([2020], states=(None, 'sc', 'rj'))
+        CurrencyRate.objects.create(
+            date=date(2020, 3, 31), currency='eur', rate=0.5)
+        clear_rates_cache()
+        self.addCleanup(clear_rates_cache)
+
+    def post(self, data):
+        return self.client.post(
+            self.URL, data, content_type='application/json')
+
+    def test_statuses_and_ids(self, get_housing_data_from_remote):
+        response = self.post([
+            {'id': 'national', 'country': 'brazil', 'year': 2020, 'month': 3},
+            {
+                'country': 'Brazil',
+                'states': 'sc-rj',
+                'year': 2020,
+                'month': 1,
+                'final_year': 2020,
+                'final_month': 6,
+            },
+            {
+                'id': 'sc',
+                'country': 'brazil',
+                'states': ['SC'],
+                'year': 2020,
+                'month': 3,
+            },
+            {'country': 'narnia', 'year': 2020, 'month': 3},
+            {'country': 'brazil', 'states': ['xx'], 'year': 2020, 'month': 3},
+            {'country': 'brazil', 'year': 2020},
+            {
+                'country': 'brazil',
+                'year': 2020,
+                'month': 3,
+                'final_year': 2020,
+            },
+            {'country': 'brazil', 'year': 2020, 'month': 3, 'currency': 'a-b'},
+            'not a query',
+            {
+                'id': 'eur',
+                'country': 'brazil',
+                'year': 2020,
+                'month': 3,
+                'currency': 'EUR',
+            },
+            {'id': 'filled', 'country': 'brazil', 'year': 2021, 'month': 1},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        # in the order of the queries, by id or index
+        self.assertEqual(
+            list(results),
+            ['national', '1', 'sc', '3', '4', '5', '6', '7', '8', 'eur',
+             'filled']
+        )
+        self.assertEqual(
+            [result['status'] for result in results.values()],
+            [200, 200, 200, 404, 400, 400, 400, 400, 400, 200, 200]
+        )
+
+        for spec_id, url in (
+                ('national', '/housing/brazil/2020/3'),
+                ('1', '/housing/brazil/sc-rj/2020/1/2020/6'),
+                ('sc', '/housing/brazil/sc/2020/3'),
+                ('eur', '/housing/brazil/2020/3?currency=eur'),
+                ('filled', '/housing/brazil/2021/1')):
+            self.assertEqual(
+                results[spec_id]['data'], self.client.get(url).json())
+        self.assertEqual(
+            results['eur']['data']['square_meter_price'], '51.50')
+        self.assertEqual(results['3']['data'], 'Country not found')
+        self.assertEqual(results['4']['data'], 'Invalid states: xx')
+
+    def test_single_remote_pass(self, get_housing_data_from_remote):
+        response = self.post({'queries': [
+            {'country': 'brazil', 'states': ['sc'], 'year': 2021,
+             'month': 1, 'final_year': 2021, 'final_month': 3},
+            {'country': 'brazil', 'states': ['rj'], 'year': 2021,
+             'month': 1, 'final_year': 2021, 'final_month': 3},
+            {'country': 'brazil', 'year': 2021, 'month': 1},
+            {'country': 'brazil', 'year': 2020, 'month': 1},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result['status'] for result in response.json().values()],
+            [200] * 4
+        )
+        # the states sharing a range are fetched together
+        self.assertCountEqual(
+            [
+                (
+                    call.kwargs['year'],
+                    call.kwargs['month'],
+                    call.kwargs['final_year'],
+                    call.kwargs['final_month'],
+                    call.kwargs['states'],
+                )
+                for call in get_housing_data_from_remote.call_args_list
+            ],
+            [(2021, 1, 2021, 3, ['rj', 'sc']), (2021, 1, None, None, [])]
+        )
+
+    def test_fill_updates_later_months(self, get_housing_data_from_remote):
+        HousingData.objects.filter(
+            year=2020, month=3, state__isnull=True).delete()
+        response = self.post([{
+            'country': 'brazil',
+            'year': 2020,
+            'month': 1,
+            'final_year': 2020,
+            'final_month': 4,
+        }])
+        self.assertEqual(
+            response.json()['0']['data'],
+            self.client.get('/housing/brazil/2020/1/2020/4').json()
+        )
+
+    @override_settings(HOUSING_BATCH_MAX_QUERIES=2)
+    def test_invalid_batches(self, get_housing_data_from_remote):
+        query = {'country': 'brazil', 'year': 2020, 'month': 1}
+        for data in (
+                {'query': query},
+                [query] * 3,
+                [{**query, 'id': 'a'}, {**query, 'id': 'a'}],
+                # ids are compared as strings
+                [{**query, 'id': 1}, query]):
+            self.assertEqual(self.post(data).status_code, 400)
+
+
+class HousingDataExportTestCase(HousingDataTestCase):
+    """Stored housing data is exported as CSV or NDJSON rows, with the
+    prices as stored
+    """
+    URL = '/housing/export'
+    HEADER = 'country,state,year,month,square_meter_price,currency,variation'
+
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data([2020], [1, 2, 3])
+        self.save_housing_data([2020], [1, 2, 3], ['sc'], currency='brl')
+        self.save_housing_data([2020], [2, 3], ['rj'], variation=-0.005)
+
+    def get_lines(self, query: str = ''):
+        response = self.client.get(self.URL + query)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_csv(self):
+        response = self.client.get(self.URL)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="housing_data.csv"'
+        )
+        lines = b''.join(response.streaming_content).decode().split('\r\n')
+        self.assertEqual(lines[0], self.HEADER)
+        self.assertEqual(lines[-1], '')
+        self.assertEqual(len(lines), 10)
+        # national data has no state
+        self.assertIn('brazil,,2020,1,101.00,usd,0.01000', lines)
+
+        # by state and period
+        state_order = sorted(
+            ('sc', 'rj'), key=self.mixin.get_state_id_from_abbreviation)
+        expected_lines = {
+            'sc': [
+                'brazil,sc,2020,1,101.00,brl,0.01000',
+                'brazil,sc,2020,2,102.00,brl,0.01000',
+                'brazil,sc,2020,3,103.00,brl,0.01000',
+            ],
+            'rj': [
+                'brazil,rj,2020,2,102.00,usd,-0.00500',
+                'brazil,rj,2020,3,103.00,usd,-0.00500',
+            ],
+        }
+        self.assertEqual(
+            self.get_lines('?state=sc&state=RJ&country=brazil')[1:],
+            expected_lines[state_order[0]] + expected_lines[state_order[1]]
+        )
+
+    def test_ndjson(self):
+        response = self.client.get(self.URL + '?format=ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).splitlines()
+        ]
+        self.assertEqual(len(rows), 8)
+        for row in rows:
+            self.assertEqual(tuple(row), EXPORT_FIELDS)
+        self.assertIn({
+            'country': 'brazil',
+            'state': '',
+            'year': 2020,
+            'month': 1,
+            'square_meter_price': '101.00',
+            'currency': 'usd',
+            'variation': '0.01000',
+        }, rows)
+
+    def test_month_filters(self):
+        self.assertEqual(self.get_lines('?state=sc&since=2020-02'), [
+            self.HEADER,
+            'brazil,sc,2020,2,102.00,brl,0.01000',
+            'brazil,sc,2020,3,103.00,brl,0.01000',
+        ])
+        self.assertEqual(
+            self.get_lines('?state=sc&since=2020-02&until=2020-02'),
+            [self.HEADER, 'brazil,sc,2020,2,102.00,brl,0.01000']
+        )
+        self.assertEqual(len(self.get_lines('?until=2020-01')), 3)
+        self.assertEqual(self.get_lines('?since=2021-01'), [self.HEADER])
+
+    def test_invalid_filters(self):
+        for query in (
+                '?format=xml',
+                '?since=2020-13',
+                '?until=2020',
+                '?country=narnia',
+                '?state=xx'):
+            self.assertEqual(
+                self.client.get(self.URL + query).status_code, 400)
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command(
+            'export_housing', '--format', 'ndjson', '--state', 'sc',
+            '--until', '2020-02', stdout=stdout)
+        self.assertEqual(
+            [
+                json.loads(line)['month']
+                for line in stdout.getvalue().splitlines()
+            ],
+            [1, 2]
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'housing.csv')
+            call_command(
+                'export_housing', '--country', 'brazil', '--state', 'rj',
+                '-o', path)
+            with open(path, newline='') as output:
+                self.assertEqual(output.read(), '\r\n'.join([
+                    self.HEADER,
+                    'brazil,rj,2020,2,102.00,usd,-0.00500',
+                    'brazil,rj,2020,3,103.00,usd,-0.00500',
+                    '',
+                ]))
+
+        for args in (('--since', '2020'), ('--state', 'xx')):
+            with self.assertRaises(CommandError):
+                call_command('export_housing', *args, stdout=StringIO())
+
+
+@mock.patch.object(
+    BrazilHousingDataMixin, 'get_housing_data_from_remote', autospec=True,
+    side_effect=get_remote_entries)
+class SyncHousingTestCase(HousingDataTestCase):
+    """sync_housing fetches each country's national and state data with a
+    remote call per level
+    """
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.states = registry.get_country_states('brazil')
+
+    def sync(self, *args):
+        stdout = StringIO()
+        call_command('sync_housing', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def get_remote_calls(self, get_housing_data_from_remote):
+        return [
+            (
+                call.kwargs['year'],
+                call.kwargs['month'],
+                call.kwargs['final_year'],
+                call.kwargs['final_month'],
+                call.kwargs['states'],
+            )
+            for call in get_housing_data_from_remote.call_args_list
+        ]
+
+    def test_full_sync(self, get_housing_data_from_remote):
+        self.save_housing_data([2020], [1], square_meter_price=50)
+        output = self.sync(
+            '--country', 'Brazil', '--since', '2020-01', '--until', '2020-03')
+        self.assertEqual(
+            self.get_remote_calls(get_housing_data_from_remote),
+            [(2020, 1, 2020, 3, []), (2020, 1, 2020, 3, self.states)]
+        )
+        self.assertEqual(
+            output, f'brazil: {3 + 3 * len(self.states)} entries saved\n')
+        self.assertEqual(
+            HousingData.objects.count(), 3 + 3 * len(self.states))
+        # stored months are updated
+        self.assertEqual(
+            HousingData.objects.get(
+                state__isnull=True, year=2020, month=1).square_meter_price,
+            100
+        )
+
+    def test_incremental_sync(self, get_housing_data_from_remote):
+        self.save_housing_data([2020], [1, 2])
+        self.save_housing_data([2020], [1], self.states)
+        self.save_housing_data([2020], [2], self.states[1:])
+        self.sync(
+            '--incremental', '--since', '2019-06', '--until', '2020-04')
+        # from the month after the latest stored, for the state furthest
+        # behind
+        self.assertEqual(
+            self.get_remote_calls(get_housing_data_from_remote),
+            [(2020, 3, 2020, 4, []), (2020, 2, 2020, 4, self.states)]
+        )
+
+        get_housing_data_from_remote.reset_mock()
+        self.sync(
+            '--incremental', '--since', '2019-06', '--until', '2020-04')
+        self.assertEqual(
+            self.get_remote_calls(get_housing_data_from_remote), [])
+
+        # states never stored are synced from --since
+        HousingData.objects.filter(state__abbreviation='sc').delete()
+        self.sync(
+            '--incremental', '--since', '2019-06', '--until', '2020-04')
+        self.assertEqual(
+            self.get_remote_calls(get_housing_data_from_remote),
+            [(2019, 6, 2020, 4, self.states)]
+        )
+
+    def test_errors(self, get_housing_data_from_remote):
+        for args in (
+                ('--country', 'narnia'),
+                ('--since', '2020-13'),
+                ('--until', '2020')):
+            with self.assertRaises(CommandError):
+                self.sync(*args)
+
+        # a provider without a Country row
+        Country.objects.filter(base_uri='brazil').delete()
+        with self.assertRaisesMessage(
+                CommandError, 'No Country stored for brazil'):
+            self.sync('--country', 'brazil')
+        get_housing_data_from_remote.assert_not_called()
+
+
+@mock.patch.object(
+    BrazilHousingDataMixin, 'get_housing_data_from_remote', return_value=[])
+class HousingDataAnalyticsTestCase(HousingDataTestCase):
+    """Analytics are computed over the stored months, with windows framed by
+    period
+    """
+    URL = '/housing/brazil/analytics/2020/1/2020/12'
+    FIRST_PERIOD = get_period(2018, 1)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        # grows by 1 a month from 100 in 01/2018
+        self.save_housing_data(
+            (2018, 2019, 2020),
+            states=(None, 'sc'),
+            square_meter_price=lambda year, month, state:
+            100 + get_period(year, month) - self.FIRST_PERIOD,
+            currency='usd'
+        )
+
+    def get_price(self, year, month):
+        return 100 + get_period(year, month) - self.FIRST_PERIOD
+
+    def get_analytics(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_values(self, get_housing_data_from_remote):
+        analytics = self.get_analytics(self.URL)
+        self.assertEqual(analytics['currency'], 'usd')
+        self.assertEqual(len(analytics['monthly']), 12)
+        self.assertAlmostEqual(
+            analytics['cagr'],
+            (self.get_price(2020, 12) / self.get_price(2020, 1)) ** (12 / 11)
+            - 1
+        )
+        self.assertAlmostEqual(
+            analytics['monthly']['03/2020']['yoy'],
+            self.get_price(2020, 3) / self.get_price(2019, 3) - 1
+        )
+        # the first months' windows reach back before the range
+        self.assertEqual(
+            analytics['monthly']['01/2020']['rolling_mean'],
+            sum(self.get_price(2019, month) for month in range(2, 13))
+            / 12 + self.get_price(2020, 1) / 12
+        )
+
+    @mock.patch('api.utils.fetch_dolar_rates')
+    def test_mixed_currencies(
+            self, fetch_dolar_rates, get_housing_data_from_remote):
+        def get_rate(year, month):
+            return 4 + month / 10
+
+        expected = self.get_analytics(self.URL + '?window=18')
+        # from 2019 on, prices are stored in reais, converted with the rate
+        # of the last day of their month
+        clear_rates_cache()
+        self.addCleanup(clear_rates_cache)
+        CurrencyRate.objects.bulk_create([
+            CurrencyRate(date=rate_date, currency='brl', rate=rate)
+            for year in (2018, 2019, 2020)
+            for month in range(1, 13)
+            for rate_date, rate in (
+                (get_currency_date(year, month),
+                 get_rate(year, month)),
+                # not the last day of any month
+                (date(year, month, 15), 100.0),
+            )
+        ])
+        self.save_housing_data(
+            (2019, 2020),
+            square_meter_price=lambda year, month, state:
+            self.get_price(year, month) * get_rate(year, month),
+            currency='brl'
+        )
+
+        analytics = self.get_analytics(self.URL + '?window=18')
+        self.assertEqual(analytics['currency'], 'usd')
+        self.assertAlmostEqual(analytics['cagr'], expected['cagr'])
+        for month, values in expected['monthly'].items():
+            self.assertAlmostEqual(
+                analytics['monthly'][month]['yoy'], values['yoy'])
+            self.assertAlmostEqual(
+                analytics['monthly'][month]['rolling_mean'],
+                values['rolling_mean'],
+                delta=0.01
+            )
+
+        # the months stored in dolars are converted to reais too
+        analytics = self.get_analytics(self.URL + '?window=18&currency=brl')
+        self.assertEqual(analytics['currency'], 'brl')
+        self.assertAlmostEqual(
+            analytics['monthly']['01/2020']['rolling_mean'],
+            sum(
+                self.get_price(*get_year_month(period))
+                * get_rate(*get_year_month(period))
+                for period in range(
+                    get_period(2018, 8), get_period(2020, 1) + 1)
+            ) / 18,
+            delta=0.01
+        )
+        fetch_dolar_rates.assert_not_called()
+
+    def test_states(self, get_housing_data_from_remote):
+        analytics = self.get_analytics(
+            '/housing/brazil/sc-rj/analytics/2020/1/2020/12')
+        # states without stored data are left out
+        self.assertEqual(list(analytics), ['sc'])
+        self.assertEqual(
+            analytics['sc'], self.get_analytics(self.URL))
+
+    def test_window_bounds(self, get_housing_data_from_remote):
+        analytics = self.get_analytics(self.URL + '?window=1')
+        for month, values in analytics['monthly'].items():
+            self.assertEqual(
+                values['rolling_mean'],
+                self.get_price(2020, int(month[:2]))
+            )
+
+        analytics = self.get_analytics(self.URL + '?window=3')
+        self.assertEqual(
+            analytics['monthly']['01/2020']['rolling_mean'],
+            self.get_price(2019, 12)
+        )
+
+        # more months than stored before the range
+        analytics = self.get_analytics(self.URL + '?window=120')
+        for values in analytics['monthly'].values():
+            self.assertIsNone(values['rolling_mean'])
+        self.assertIsNotNone(analytics['monthly']['01/2020']['yoy'])
+
+        for window in ('0', '121', 'a'):
+            self.assertEqual(self.client.get(
+                self.URL + f'?window={window}').status_code, 400)
+
+    def test_missing_months(self, get_housing_data_from_remote):
+        HousingData.objects.filter(year=2019, month=3).delete()
+        analytics = self.get_analytics(self.URL + '?window=3')
+        # compared to the first stored month of the year before
+        self.assertIsNone(analytics['monthly']['03/2020']['yoy'])
+        self.assertIsNotNone(analytics['monthly']['04/2020']['yoy'])
+
+        analytics = self.get_analytics(
+            '/housing/brazil/analytics/2019/4/2019/6?window=3')
+        self.assertEqual(
+            [
+                values['rolling_mean']
+                for values in analytics['monthly'].values()
+            ],
+            [None, None, self.get_price(2019, 5)]
+        )
+
+    def test_not_found(self, get_housing_data_from_remote):
+        self.assertEqual(self.client.get(
+            '/housing/brazil/analytics/2010/1/2010/12').status_code, 404)
+
+
+class SerializerFastPathTestCase(HousingDataTestCase):
+    """represent_row() and represent_rows() render the same bytes as the DRF
+    serializers they stand in for
+    """
+    def setUp(self):
+        super().setUp()
+        self.save_housing_data(
+            [2020],
+            states=(None, 'sc', 'rj'),
+            square_meter_price=lambda year, month, state: 1000 + month * 12.34,
+            # rj's price drops to zero in June, which breaks its cumulative
+            # log growth, so its range variation is compounded instead
+            variation=lambda year, month, state:
+            -1 if state == 'rj' and month == 6 else (month - 6) / 1000
+        )
+
+    def get_rows(self, instances):
+        """Yields the rows of instances as read from a queryset and from
+        model instances (see HousingDataMixin.get_housing_data_rows())
+        """
+        yield self.mixin.get_housing_data_rows(instances)
+        yield self.mixin.get_housing_data_rows(list(instances))
+
+    def assertRendersEqual(self, fast_data, data):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(fast_data), renderer.render(data))
+
+    def test_single(self):
+        instances = self.mixin.get_housing_data_from_db(2020, 3)
+        for rows in self.get_rows(instances):
+            self.assertRendersEqual(
+                HousingDataValuesSerializer.represent_row(rows[0]),
+                HousingDataValuesSerializer(instances[0]).data
+            )
+
+    def test_range(self):
+        for final_month in (1, 5, 12):
+            instances = self.mixin.get_housing_data_from_db(
+                2020, 1, 2020, final_month)
+            for rows in self.get_rows(instances):
+                self.assertRendersEqual(
+                    HousingDataRangeSerializer.represent_rows(rows),
+                    HousingDataRangeSerializer(list(instances)).data
+                )
+
+    def test_states(self):
+        instances = self.mixin.get_housing_data_from_db(
+            2020, 6, states=['sc', 'rj'])
+        for rows in self.get_rows(instances):
+            self.assertRendersEqual(
+                HousingDateStatesSerializer.represent_rows(rows),
+                HousingDateStatesSerializer(instances).data
+            )
+
+    def test_states_range(self):
+        instances = self.mixin.get_housing_data_from_db(
+            2020, 1, 2020, 12, states=['sc', 'rj'])
+        for rows in self.get_rows(instances):
+            self.assertRendersEqual(
+                HousingDateStatesRangeSerializer.represent_rows(rows),
+                HousingDateStatesRangeSerializer(instances).data
+            )
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    """Concurrent calls for the same key share a single upstream call"""
+    KEY = 'brazil:24240:24251:'
+
+    def setUp(self):
+        lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(lock_dir.cleanup)
+        self.lock_dir = lock_dir.name
+        settings = override_settings(
+            HOUSING_LOCK_DIR=self.lock_dir, HOUSING_LEASE_TIMEOUT=10)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.upstream_calls = 0
+        self.upstream_lock = threading.Lock()
+
+    def upstream(self):
+        with self.upstream_lock:
+            self.upstream_calls += 1
+        return 'data'
+
+    def run_threads(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+    def test_followers_share_the_leaders_call(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def fn():
+            started.set()
+            release.wait(10)
+            return self.upstream()
+
+        def call():
+            results.append(single_flight.do(self.KEY, fn))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(10)
+        followers = [threading.Thread(target=call) for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        # let the followers find the leader's call in flight
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(10)
+
+        self.assertEqual(results, ['data'] * 5)
+        self.assertEqual(self.upstream_calls, 1)
+        self.assertEqual(single_flight._calls, {})
+
+    def test_followers_share_the_leaders_error(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def fn():
+            started.set()
+            release.wait(10)
+            raise ConnectionError('upstream down')
+
+        def call():
+            try:
+                single_flight.do(self.KEY, fn)
+            except ConnectionError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(10)
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in (leader, follower):
+            thread.join(10)
+
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    @skipIf(fcntl is None, 'file locks are not supported')
+    def test_lease_hand_off(self):
+        # flock() locks are held per open file, so separate SingleFlight
+        # instances compete for leases as separate processes would
+        acquired = threading.Event()
+
+        def wait_for_lease():
+            with SingleFlight().lease(self.KEY):
+                acquired.set()
+
+        with SingleFlight().lease(self.KEY):
+            waiter = threading.Thread(target=wait_for_lease)
+            waiter.start()
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(10))
+        waiter.join(10)
+        # lease files are removed on release
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+    @skipIf(fcntl is None, 'file locks are not supported')
+    @override_settings(HOUSING_LEASE_TIMEOUT=0.1)
+    def test_lease_timeout(self):
+        acquired = threading.Event()
+
+        def wait_for_lease():
+            with SingleFlight().lease(self.KEY):
+                acquired.set()
+
+        with SingleFlight().lease(self.KEY):
+            waiter = threading.Thread(target=wait_for_lease)
+            waiter.start()
+            # proceeds without the lease
+            self.assertTrue(acquired.wait(10))
+        waiter.join(10)
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+    def test_concurrent_callers(self):
+        # two "processes" with concurrent callers each, storing what they
+        # fetch, and re-checking the store once they run
+        store = {}
+        barrier = threading.Barrier(8)
+
+        def fn():
+            if self.KEY not in store:
+                # long enough for the other callers to queue up
+                time.sleep(0.1)
+                store[self.KEY] = self.upstream()
+            return store[self.KEY]
+
+        results = []
+
+        def call(single_flight):
+            barrier.wait(10)
+            results.append(single_flight.do(self.KEY, fn))
+
+        processes = (SingleFlight(), SingleFlight())
+        self.run_threads([
+            lambda single_flight=single_flight: call(single_flight)
+            for single_flight in processes
+            for _ in range(4)
+        ])
+
+        self.assertEqual(results, ['data'] * 8)
+        self.assertEqual(self.upstream_calls, 1)
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+    def test_async_callers(self):
+        single_flight = SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            return self.upstream()
+
+        async def main():
+            return await asyncio.gather(*(
+                single_flight.ado(self.KEY, fn) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(main()), ['data'] * 5)
+        self.assertEqual(self.upstream_calls, 1)
+        self.assertEqual(single_flight._async_calls, {})
+
+
+@override_settings(
+    HOUSING_UPSTREAM_MAX_RETRIES=3,
+    HOUSING_UPSTREAM_BACKOFF=0.5,
+    HOUSING_UPSTREAM_READ_TIMEOUT=30
+)
+class UpstreamRetryTestCase(SimpleTestCase):
+    """Transient upstream failures are retried with bounded backoff"""
+    URL = 'https://upstream.test/data'
+
+    def setUp(self):
+        self.upstream_client = UpstreamClient()
+        # a label of its own, so counts from other tests don't add up
+        self.upstream = self.id()
+        sleep_patcher = mock.patch('api.upstream.time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    @staticmethod
+    def get_response(status_code: int, headers: dict = {}):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers)
+        return response
+
+    def get(self, *outcomes):
+        """Returns (response, session.get mock) for a GET whose attempts
+        return or raise outcomes in turn
+        """
+        session = mock.Mock()
+        session.get.side_effect = [
+            self.get_response(outcome) if isinstance(outcome, int)
+            else outcome
+            for outcome in outcomes
+        ]
+        with mock.patch.object(
+                self.upstream_client, 'get_session', return_value=session):
+            response = self.upstream_client.get(self.URL, self.upstream)
+        return response, session.get
+
+    def get_count(self, counter):
+        return counter._values.get((self.upstream,), 0)
+
+    def assertBackoffs(self, attempts: int):
+        self.assertEqual(self.sleep.call_count, attempts)
+        for attempt, call in enumerate(self.sleep.call_args_list):
+            self.assertGreaterEqual(call.args[0], 0)
+            self.assertLessEqual(call.args[0], 0.5 * 2 ** attempt)
+
+    def test_retries_server_errors(self):
+        response, session_get = self.get(503, 502, 429, 200)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session_get.call_count, 4)
+        self.assertBackoffs(3)
+        self.assertEqual(self.get_count(upstream_retries), 3)
+        self.assertEqual(self.get_count(upstream_failures), 0)
+
+    def test_retries_timeouts(self):
+        response, session_get = self.get(
+            requests.Timeout(), requests.ConnectionError(), 200)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session_get.call_count, 3)
+        self.assertBackoffs(2)
+
+    def test_does_not_retry(self):
+        for status_code in (200, 400, 404, 501):
+            response, session_get = self.get(status_code)
+            self.assertEqual(response.status_code, status_code)
+            session_get.assert_called_once()
+        self.sleep.assert_not_called()
+        self.assertEqual(self.get_count(upstream_retries), 0)
+        self.assertEqual(self.get_count(upstream_failures), 3)
+
+        # nor errors other than connection errors and timeouts
+        with self.assertRaises(requests.exceptions.InvalidURL):
+            self.get(requests.exceptions.InvalidURL(), 200)
+        self.sleep.assert_not_called()
+
+    def test_gives_up(self):
+        response, session_get = self.get(503, 503, 503, 503, 200)
+        # the last response is returned
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(session_get.call_count, 4)
+        self.assertBackoffs(3)
+
+        self.sleep.reset_mock()
+        with self.assertRaises(requests.ConnectionError):
+            self.get(*[requests.ConnectionError()] * 4, 200)
+        self.assertBackoffs(3)
+        self.assertEqual(self.get_count(upstream_retries), 6)
+        self.assertEqual(self.get_count(upstream_failures), 2)
+
+    def test_backoff(self):
+        for attempt in range(5):
+            for _ in range(50):
+                backoff = self.upstream_client.get_backoff(attempt)
+                self.assertGreaterEqual(backoff, 0)
+                self.assertLessEqual(backoff, 0.5 * 2 ** attempt)
+
+        # Retry-After is honoured, up to the read timeout
+        for retry_after, backoff in (('2', 2), ('120', 30)):
+            self.assertEqual(self.upstream_client.get_backoff(
+                0, self.get_response(503, {'Retry-After': retry_after})),
+                backoff
+            )
+        self.assertLessEqual(
+            self.upstream_client.get_backoff(0, self.get_response(
+                503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})),
+            0.5
+        )
+
+    def aget(self, *outcomes):
+        """Async version of get(), returning (response, requests made)"""
+        outcomes = list(outcomes)
+        requests_made = []
+
+        def handler(request):
+            requests_made.append(request)
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return httpx.Response(outcome)
+
+        async def main():
+            async with httpx.AsyncClient(
+                    transport=httpx.MockTransport(handler)) as client:
+                with mock.patch.object(
+                        self.upstream_client, 'get_async_client',
+                        return_value=client):
+                    return await self.upstream_client.aget(
+                        self.URL, self.upstream)
+
+        with mock.patch(
+                'api.upstream.asyncio.sleep', new_callable=mock.AsyncMock)\
+                as sleep:
+            response = asyncio.run(main())
+        return response, requests_made, sleep
+
+    def test_async_retries(self):
+        response, requests_made, sleep = self.aget(
+            503, httpx.ConnectTimeout('timed out'), 200)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(requests_made), 3)
+        self.assertEqual(sleep.await_count, 2)
+
+        response, requests_made, sleep = self.aget(404, 200)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(requests_made), 1)
+        sleep.assert_not_awaited()
+
+        with self.assertRaises(httpx.ConnectError):
+            self.aget(*[httpx.ConnectError('refused')] * 4)
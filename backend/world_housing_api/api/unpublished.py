@@ -0,0 +1,96 @@
+from datetime import date
+from django.conf import settings
+from django.core.cache import cache
+from .utils import get_period
+
+UNPUBLISHED_KEY = 'housing:unpublished:{country}:{state}:{period}'
+LATEST_PUBLISHED_KEY = 'housing:latest-published:{country}'
+
+# a fetch only moves the latest published period if the months it lacked
+# reach this close to the current one, so a gap in old data (e.g. a value
+# IBGE withheld) doesn't hide the months after it
+PUBLICATION_LAG_MONTHS = 12
+
+
+class UnpublishedCache:
+    """Negative cache of housing data months a provider had nothing for, so
+    requests for them don't call the remotes again until it expires.
+
+    It keeps, for HOUSING_UNPUBLISHED_TTL seconds, each (country, state,
+    period) key a remote fetch didn't return, and each country's latest
+    published period: the latest month returned by a fetch that asked for
+    later, recent ones too. Months after it are taken as not published yet,
+    for any state. Months after the current one are never published.
+
+    Entries live in Django's cache, so they are shared between processes if
+    CACHES points to a shared backend.
+    """
+    @staticmethod
+    def get_timeout():
+        return getattr(settings, 'HOUSING_UNPUBLISHED_TTL', 0)
+
+    @staticmethod
+    def get_key(country: str, key: tuple):
+        period, state = key
+        return UNPUBLISHED_KEY.format(
+            country=country, state=state or '', period=period)
+
+    @staticmethod
+    def get_current_period():
+        today = date.today()
+        return get_period(today.year, today.month)
+
+    def get_unpublished_keys(self, country: str, keys: set):
+        """Returns the subset of (period, state) keys known not to be
+        published.
+        """
+        current_period = self.get_current_period()
+        unpublished_keys = set(
+            key for key in keys if key[0] > current_period)
+        keys = keys - unpublished_keys
+        if not keys or not self.get_timeout():
+            return unpublished_keys
+
+        latest_period = cache.get(
+            LATEST_PUBLISHED_KEY.format(country=country))
+        if latest_period is not None:
+            unpublished_keys |= set(
+                key for key in keys if key[0] > latest_period)
+            keys = keys - unpublished_keys
+
+        cache_keys = {self.get_key(country, key): key for key in keys}
+        unpublished_keys |= set(
+            cache_keys[cache_key] for cache_key in cache.get_many(cache_keys))
+        return unpublished_keys
+
+    def add(self, country: str, requested_keys: set, returned_keys: set):
+        """Records the requested (period, state) keys that a remote fetch
+        didn't return, given the keys it returned.
+        """
+        timeout = self.get_timeout()
+        if not timeout:
+            return
+        unpublished_keys = set(requested_keys) - set(returned_keys)
+        if not unpublished_keys:
+            return
+        cache.set_many({
+            self.get_key(country, key): True for key in unpublished_keys
+        }, timeout)
+
+        if returned_keys:
+            latest_period = max(period for period, state in returned_keys)
+            latest_unpublished_period = max(
+                period for period, state in unpublished_keys)
+            recent_period = self.get_current_period() - PUBLICATION_LAG_MONTHS
+            if latest_unpublished_period > latest_period\
+                    and latest_unpublished_period >= recent_period:
+                cache.set(
+                    LATEST_PUBLISHED_KEY.format(country=country),
+                    latest_period, timeout)
+
+    def clear(self, country: str):
+        """Makes the country's months be fetched again on next request"""
+        cache.delete(LATEST_PUBLISHED_KEY.format(country=country))
+
+
+unpublished = UnpublishedCache()
@@ -0,0 +1,166 @@
+import asyncio
+import httpx
+import logging
+import random
+import requests
+import threading
+import time
+import weakref
+from django.conf import settings
+from .metrics import (
+    timed,
+    upstream_duration,
+    upstream_failures,
+    upstream_retries
+)
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+logger = logging.getLogger()
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class UpstreamClient:
+    """HTTP client shared by every country provider to call remote APIs.
+
+    Keeps a keep-alive connection pool per host (requests for sync code, an
+    httpx client per event loop for async code), bounds each request with
+    connect/read timeouts and retries connection errors, timeouts, 429 and
+    5xx responses with jittered exponential backoff (honouring Retry-After).
+    Latency, retries and failures are recorded per upstream, the URL's host
+    by default, in the metrics served by /metrics.
+
+    Settings: HOUSING_UPSTREAM_CONNECT_TIMEOUT, HOUSING_UPSTREAM_READ_TIMEOUT,
+    HOUSING_UPSTREAM_MAX_RETRIES, HOUSING_UPSTREAM_BACKOFF and
+    HOUSING_UPSTREAM_POOL_SIZE.
+    """
+    def __init__(self):
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def get_setting(name: str, default):
+        return getattr(settings, f'HOUSING_UPSTREAM_{name}', default)
+
+    def get_timeout(self):
+        return (
+            self.get_setting('CONNECT_TIMEOUT', 5),
+            self.get_setting('READ_TIMEOUT', 30),
+        )
+
+    def get_session(self):
+        with self._session_lock:
+            if self._session is None:
+                pool_size = self.get_setting('POOL_SIZE', 10)
+                adapter = HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size)
+                self._session = requests.Session()
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def get_async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            connect_timeout, read_timeout = self.get_timeout()
+            pool_size = self.get_setting('POOL_SIZE', 10)
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size
+                ),
+            )
+        return client
+
+    def get_backoff(self, attempt: int, response=None):
+        """Seconds to wait before retrying attempt (0-based)"""
+        retry_after = response.headers.get('Retry-After')\
+            if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.get_timeout()[1])
+        return random.uniform(
+            0, self.get_setting('BACKOFF', 0.5) * 2 ** attempt)
+
+    def should_retry(self, attempt: int, response=None):
+        if attempt >= self.get_setting('MAX_RETRIES', 3):
+            return False
+        return response is None\
+            or response.status_code in RETRY_STATUS_CODES
+
+    def record(self, upstream: str, seconds: float, retries: int,
+               failed: bool):
+        upstream_duration.observe(seconds, upstream=upstream)
+        if retries:
+            upstream_retries.inc(retries, upstream=upstream)
+        if failed:
+            upstream_failures.inc(upstream=upstream)
+
+    def get(self, url: str, upstream: str = None):
+        """GETs url, retrying transient failures. Returns the last response,
+        or raises the last connection error/timeout.
+        """
+        upstream = upstream or urlsplit(url).netloc
+        with timed(upstream):
+            return self._get(url, upstream)
+
+    def _get(self, url: str, upstream: str):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.get_session().get(
+                    url, timeout=self.get_timeout())
+            except (requests.ConnectionError, requests.Timeout):
+                if not self.should_retry(attempt):
+                    self.record(
+                        upstream, time.perf_counter() - start, attempt, True)
+                    raise
+            if response is not None and not self.should_retry(
+                    attempt, response):
+                self.record(
+                    upstream, time.perf_counter() - start, attempt,
+                    response.status_code >= 400)
+                return response
+
+            backoff = self.get_backoff(attempt, response)
+            logger.info(f'Retrying {upstream} in {backoff:.2f}s ({url})')
+            time.sleep(backoff)
+            attempt += 1
+
+    async def aget(self, url: str, upstream: str = None):
+        """Async version of get()"""
+        upstream = upstream or urlsplit(url).netloc
+        with timed(upstream):
+            return await self._aget(url, upstream)
+
+    async def _aget(self, url: str, upstream: str):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = await self.get_async_client().get(url)
+            except httpx.TransportError:
+                if not self.should_retry(attempt):
+                    self.record(
+                        upstream, time.perf_counter() - start, attempt, True)
+                    raise
+            if response is not None and not self.should_retry(
+                    attempt, response):
+                self.record(
+                    upstream, time.perf_counter() - start, attempt,
+                    response.status_code >= 400)
+                return response
+
+            backoff = self.get_backoff(attempt, response)
+            logger.info(f'Retrying {upstream} in {backoff:.2f}s ({url})')
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+
+upstream = UpstreamClient()
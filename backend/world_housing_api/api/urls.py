@@ -1,12 +1,18 @@
 from django.urls import path, include
 from .views import (
     CountryStateView,
-    CountryView
+    CountryView,
+    HousingDataBatchView,
+    HousingDataExportView,
+    HousingDataFillView
 )
 
 
 urlpatterns = [
     path('brazil/', include('brazil.urls')),
     path('countries', CountryView.as_view()),
+    path('batch', HousingDataBatchView.as_view()),
+    path('export', HousingDataExportView.as_view()),
+    path('fills/<str:token>', HousingDataFillView.as_view()),
     path('<str:country>/states', CountryStateView.as_view()),
 ]
@@ -1,43 +1,469 @@
-import requests
+import asyncio
 import logging
-from datetime import date as Date
+import math
+import threading
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min
+from datetime import (
+    date as Date,
+    datetime,
+    timedelta
+)
+from .models import (
+    CurrencyRate,
+    HousingData
+)
+from .upstream import upstream
 
 logger = logging.getLogger()
 
+CURRENCY_API_URL = 'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@'\
+                   '[DATE]/v1/currencies/usd.json'
+# currency rates are quoted against, always worth 1
+DOLAR = 'usd'
 
-def convert_to_dolar(currency: str, value: float | int, date: Date):
-    """Uses https://github.com/fawazahmed0/exchange-api to convert a value in a
-    currency to dolar.
+# currency codes rates can be downloaded for (see get_known_currencies())
+CURRENCIES_KEY = 'housing:currencies'
 
-    :param currency: value's currency;
-    :type currency: string;
-    :param value: amount to be converted;
-    :type value: float or int;
-    :param date: day to get the currency;
-    :type date: datetime.date
+# rates of a day from the 'latest' fallback, cached for
+# HOUSING_LATEST_RATES_TTL seconds as they are not stored
+LATEST_RATES_KEY = 'housing:latest-rates:{date}'
+
+# in-process LRU in front of the CurrencyRate table: (date, currency) -> rate
+RATES_CACHE_SIZE = 4096
+_rates_cache = OrderedDict()
+_rates_cache_lock = threading.Lock()
+
+
+def get_period(year: int, month: int):
+    """Returns a month ordinal, so consecutive months are consecutive
+    integers.
+    """
+    return year * 12 + month - 1
+
+
+def get_year_month(period: int):
+    """Returns the (year, month) pair for a get_period() ordinal"""
+    year, month = divmod(period, 12)
+    return year, month + 1
+
+
+def get_log_growth(variation):
+    """Returns log(1 + variation), or None when the price dropped to zero or
+    below, which growth can't be accumulated through.
+    """
+    if variation is None or variation <= -1:
+        return None
+    return math.log1p(float(variation))
+
+
+def update_cumulative_log_growth(
+        country_id: int, state_id: int, first_period: int):
+    """Recomputes HousingData.cumulative_log_growth for a country and state
+    (None for national data) from first_period on, accumulating from the
+    stored month before it. Months before first_period are left untouched.
+
+    Returns {period: cumulative_log_growth} for the recomputed months.
+    """
+    entries = HousingData.objects.filter(
+        country_id=country_id, state_id=state_id)
+    previous_entry = entries.filter(period__lt=first_period)\
+        .order_by('-period').values_list('cumulative_log_growth').first()
+    # None if accumulation was already broken before first_period
+    cumulative_log_growth = previous_entry[0]\
+        if previous_entry is not None else 0.0
+
+    updated_entries = []
+    for entry_id, period, variation in entries.filter(
+            period__gte=first_period).order_by('period').values_list(
+                'id', 'period', 'variation'):
+        log_growth = get_log_growth(variation)
+        if cumulative_log_growth is not None and log_growth is not None:
+            cumulative_log_growth += log_growth
+        else:
+            cumulative_log_growth = None
+        updated_entries.append(HousingData(
+            id=entry_id,
+            period=period,
+            cumulative_log_growth=cumulative_log_growth
+        ))
+
+    HousingData.objects.bulk_update(
+        updated_entries, ['cumulative_log_growth'], batch_size=500)
+    return {
+        entry.period: entry.cumulative_log_growth
+        for entry in updated_entries
+    }
+
+
+def delete_housing_data(queryset):
+    """Deletes the HousingData entries of queryset, then recomputes
+    cumulative_log_growth once per country and state, from the earliest
+    deleted month on (see update_cumulative_log_growth()). Returns the number
+    of deleted entries.
+    """
+    with transaction.atomic():
+        first_periods = list(queryset.order_by().values(
+                'country_id', 'state_id'
+            ).annotate(first_period=Min('period')).values_list(
+                'country_id', 'state_id', 'first_period'))
+        deleted, _ = queryset.delete()
+        for country_id, state_id, first_period in first_periods:
+            update_cumulative_log_growth(country_id, state_id, first_period)
+    return deleted
+
+
+def get_range_variation(first_entry, last_entry):
+    """Returns the compound variation over the months from first_entry to
+    last_entry, both (variation, cumulative_log_growth) pairs of the same
+    country and state, or None if it can't be told from the cumulative
+    values.
+    """
+    first_variation, first_cumulative_log_growth = first_entry
+    last_cumulative_log_growth = last_entry[1]
+    if first_cumulative_log_growth is None\
+            or last_cumulative_log_growth is None:
+        return None
+    return math.expm1(
+        last_cumulative_log_growth
+        - first_cumulative_log_growth
+        + get_log_growth(first_variation)
+    )
+
+
+def get_currency_date(year: int, month: int):
+    """Returns the date used to convert values from a year-month pair:
+    the last day of the month, or today for the current month.
+    """
+    today = datetime.today()
+    if month == 12:
+        month = 0
+        year += 1
+
+    # use last day of month
+    currency_date = datetime(
+        year=year, month=month + 1, day=1) - timedelta(days=1)
+
+    if currency_date > today:
+        currency_date = today
+
+    return currency_date.date()
+
+
+def get_conversion_factor(
+        rates: dict, date: Date, from_currency: str, to_currency: str):
+    """Returns what a value in from_currency is multiplied by to get it in
+    to_currency on date, from get_rates() rates.
+    """
+    return rates[(date, to_currency)] / rates[(date, from_currency)]
+
+
+def _get_cached_rate(date: Date, currency: str):
+    with _rates_cache_lock:
+        rate = _rates_cache.get((date, currency))
+        if rate is not None:
+            _rates_cache.move_to_end((date, currency))
+        return rate
+
+
+def _set_cached_rate(date: Date, currency: str, rate: float):
+    with _rates_cache_lock:
+        _rates_cache[(date, currency)] = rate
+        _rates_cache.move_to_end((date, currency))
+        while len(_rates_cache) > RATES_CACHE_SIZE:
+            _rates_cache.popitem(last=False)
+
+
+def clear_rates_cache():
+    """Empties the in-process exchange rate cache and forgets the known
+    currencies.
     """
-    url = f'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@'\
-          f'{date.strftime("%Y-%m-%d")}/v1/currencies/usd.json'
+    with _rates_cache_lock:
+        _rates_cache.clear()
+    cache.delete(CURRENCIES_KEY)
+
+
+def get_currency_api_url(date: str):
+    """Returns the currency API URL for date ('YYYY-MM-DD' or 'latest'),
+    from HOUSING_CURRENCY_API_URL if set.
+    """
+    url = getattr(settings, 'HOUSING_CURRENCY_API_URL', None)\
+        or CURRENCY_API_URL
+    return url.replace('[DATE]', date)
+
+
+def fetch_dolar_rates(date: Date):
+    """Downloads all the dolar exchange rates for a day from
+    https://github.com/fawazahmed0/exchange-api. Falls back to the latest
+    rates if that day is not available.
+
+    Returns a tuple (rates, is_exact), where rates maps lowercase currency
+    codes to units per dolar and is_exact is False when the latest rates were
+    used instead.
+    """
+    url = get_currency_api_url(date.strftime('%Y-%m-%d'))
+    is_exact = True
+
+    response = upstream.get(url, upstream='currency-api')
+    if response.status_code != 200:
+        logger.warn(
+            f"Failed to fetch currencies on "
+            f"{date.strftime('%Y-%m-%d')}, using latest."
+        )
+        url = get_currency_api_url('latest')
+        response = upstream.get(url, upstream='currency-api')
+        is_exact = False
 
-    response = requests.get(url)
+    if response.status_code != 200:
+        raise Exception(
+            f"Failed to fetch currencies on {date.strftime('%Y-%m-%d')}"
+        )
+
+    return response.json()['usd'], is_exact
+
+
+async def afetch_dolar_rates(date: Date):
+    """Async version of fetch_dolar_rates()"""
+    url = get_currency_api_url(date.strftime('%Y-%m-%d'))
+    is_exact = True
+
+    response = await upstream.aget(url, upstream='currency-api')
     if response.status_code != 200:
         logger.warn(
-            f"Failed to fetch {currency.upper()} currency on "
+            f"Failed to fetch currencies on "
             f"{date.strftime('%Y-%m-%d')}, using latest."
         )
-        url = 'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@'\
-              'latest/v1/currencies/usd.json'
-        response = requests.get(url)
+        url = get_currency_api_url('latest')
+        response = await upstream.aget(url, upstream='currency-api')
+        is_exact = False
 
     if response.status_code != 200:
         raise Exception(
-            f"Failed to fetch {currency.upper()} currency on "
-            f"{date.strftime('%Y-%m-%d')}"
+            f"Failed to fetch currencies on {date.strftime('%Y-%m-%d')}"
         )
 
-    response = response.json()
-    dolar_currency = response['usd'].get(currency.lower())
-    if dolar_currency is None:
-        raise Exception(f"{currency.upper()} is not a valid currency")
-    
-    return value / dolar_currency
+    return response.json()['usd'], is_exact
+
+
+def _get_stored_currencies():
+    return set(CurrencyRate.objects.values_list(
+        'currency', flat=True).distinct())
+
+
+def _set_known_currencies(currencies: set):
+    cache.set(
+        CURRENCIES_KEY,
+        currencies,
+        getattr(settings, 'HOUSING_CURRENCIES_TTL', 60 * 60 * 24)
+    )
+
+
+def get_known_currencies():
+    """Returns the currency codes rates can be downloaded for, as cached for
+    HOUSING_CURRENCIES_TTL seconds: the ones in the CurrencyRate table, or
+    today's download if it is still empty.
+    """
+    currencies = cache.get(CURRENCIES_KEY)
+    if currencies is None:
+        currencies = _get_stored_currencies()\
+            or set(fetch_dolar_rates(Date.today())[0])
+        _set_known_currencies(currencies)
+    return currencies
+
+
+async def aget_known_currencies():
+    """Async version of get_known_currencies()"""
+    currencies = await cache.aget(CURRENCIES_KEY)
+    if currencies is None:
+        currencies = await sync_to_async(_get_stored_currencies)()\
+            or set((await afetch_dolar_rates(Date.today()))[0])
+        await sync_to_async(_set_known_currencies)(currencies)
+    return currencies
+
+
+def _check_currencies(currencies: set, known_currencies: set):
+    """Raises ValueError for currencies not in known_currencies"""
+    for currency in sorted(currencies - known_currencies):
+        raise ValueError(f"{currency.upper()} is not a valid currency")
+
+
+def _get_known_rates(currencies: set, dates: set):
+    """Looks (date, currency) pairs up in the LRU, then in the CurrencyRate
+    table, with a single query, and last in the cached 'latest' fallbacks
+    """
+    rates = {}
+    missing_dates = set()
+    for date in dates:
+        for currency in currencies:
+            rate = _get_cached_rate(date, currency)
+            if rate is None:
+                missing_dates.add(date)
+            else:
+                rates[(date, currency)] = rate
+
+    if missing_dates:
+        for date, currency, rate in CurrencyRate.objects.filter(
+                currency__in=currencies,
+                date__in=missing_dates
+                ).values_list('date', 'currency', 'rate'):
+            rates[(date, currency)] = rate
+            _set_cached_rate(date, currency, rate)
+
+    missing_dates = [
+        date for date in missing_dates
+        if any((date, currency) not in rates for currency in currencies)
+    ]
+    if missing_dates:
+        latest_rates = cache.get_many([
+            LATEST_RATES_KEY.format(date=date) for date in missing_dates])
+        for date in missing_dates:
+            day_rates = latest_rates.get(LATEST_RATES_KEY.format(date=date))
+            for currency in currencies:
+                if day_rates is not None and currency in day_rates:
+                    rates[(date, currency)] = day_rates[currency]
+    return rates
+
+
+def _store_fetched_rates(currencies: set, fetched_rates: dict):
+    """Takes {date: (day_rates, is_exact)} as returned by
+    fetch_dolar_rates(), stores the exact ones, for every currency in them,
+    and returns {(date, currency): rate} for currencies. Raises ValueError if
+    a currency is not in them.
+    """
+    max_length = CurrencyRate._meta.get_field('currency').max_length
+    rates = {}
+    new_rates = []
+    for date, (day_rates, is_exact) in fetched_rates.items():
+        for currency in currencies:
+            if currency in day_rates:
+                rates[(date, currency)] = day_rates[currency]
+
+        # rates from the 'latest' fallback are not stored, so the day is
+        # fetched again once it gets published, but cached for a while so
+        # reads of the current month don't download them every time
+        if not is_exact:
+            cache.set(
+                LATEST_RATES_KEY.format(date=date),
+                day_rates,
+                getattr(settings, 'HOUSING_LATEST_RATES_TTL', 60 * 60)
+            )
+        else:
+            for currency, rate in day_rates.items():
+                if len(currency) > max_length:
+                    continue
+                if currency in currencies:
+                    _set_cached_rate(date, currency, rate)
+                new_rates.append(
+                    CurrencyRate(date=date, currency=currency, rate=rate))
+
+    if new_rates:
+        CurrencyRate.objects.bulk_create(
+            new_rates, batch_size=500, ignore_conflicts=True)
+
+    for date in fetched_rates:
+        for currency in currencies:
+            if (date, currency) not in rates:
+                raise ValueError(
+                    f"{currency.upper()} is not a valid currency")
+    return rates
+
+
+def _normalize_dates(dates):
+    return set(
+        date.date() if isinstance(date, datetime) else date
+        for date in dates
+    )
+
+
+def _normalize_currencies(currencies):
+    """Lowercases currencies, leaving the dolar out, as it's always 1"""
+    return set(currency.lower() for currency in currencies) - {DOLAR}
+
+
+def _add_dolar_rates(rates: dict, dates: set):
+    for date in dates:
+        rates[(date, DOLAR)] = 1.0
+    return rates
+
+
+def get_rates(currencies, dates):
+    """Returns how many units of each currency a dolar was worth on each of
+    the dates, as a dict {(date, currency): rate}.
+
+    Rates are looked up in an in-process LRU, then in the CurrencyRate table
+    (a single query for all the pairs missing from the LRU), then in the
+    'latest' fallbacks cached for days not published yet and only then
+    downloaded, once per distinct date still missing, by up to
+    HOUSING_CURRENCY_MAX_WORKERS threads. A download has the rates of every
+    currency for its day, which are all stored, so other
+    currencies are looked up locally afterwards. Raises ValueError for
+    unknown currencies, checked against get_known_currencies() before
+    downloading anything.
+
+    :param currencies: currency codes, e.g. ['brl', 'eur'];
+    :type currencies: iterable of string;
+    :param dates: days to get the rates for;
+    :type dates: iterable of datetime.date
+    """
+    dates = _normalize_dates(dates)
+    currencies = _normalize_currencies(currencies)
+    rates = _get_known_rates(currencies, dates) if currencies else {}
+
+    missing_dates = sorted(
+        date for date in dates
+        if any((date, currency) not in rates for currency in currencies))
+    if not missing_dates:
+        return _add_dolar_rates(rates, dates)
+    _check_currencies(currencies, get_known_currencies())
+
+    if len(missing_dates) == 1:
+        fetched_rates = [fetch_dolar_rates(missing_dates[0])]
+    else:
+        with ThreadPoolExecutor(min(
+                len(missing_dates),
+                getattr(settings, 'HOUSING_CURRENCY_MAX_WORKERS', 4))
+                ) as executor:
+            futures = [
+                # a context per task, so upstream timings reach the
+                # request's Server-Timing
+                executor.submit(copy_context().run, fetch_dolar_rates, date)
+                for date in missing_dates
+            ]
+        fetched_rates = [future.result() for future in futures]
+
+    rates.update(_store_fetched_rates(
+        currencies, dict(zip(missing_dates, fetched_rates))))
+    return _add_dolar_rates(rates, dates)
+
+
+async def aget_rates(currencies, dates):
+    """Async version of get_rates()"""
+    dates = _normalize_dates(dates)
+    currencies = _normalize_currencies(currencies)
+    rates = await sync_to_async(_get_known_rates)(currencies, dates)\
+        if currencies else {}
+
+    missing_dates = sorted(
+        date for date in dates
+        if any((date, currency) not in rates for currency in currencies))
+    if missing_dates:
+        _check_currencies(currencies, await aget_known_currencies())
+        semaphore = asyncio.Semaphore(
+            getattr(settings, 'HOUSING_CURRENCY_MAX_WORKERS', 4))
+
+        async def fetch(date):
+            async with semaphore:
+                return await afetch_dolar_rates(date)
+
+        fetched_rates = await asyncio.gather(*(
+            fetch(date) for date in missing_dates
+        ))
+        rates.update(await sync_to_async(_store_fetched_rates)(
+            currencies, dict(zip(missing_dates, fetched_rates))))
+    return _add_dolar_rates(rates, dates)
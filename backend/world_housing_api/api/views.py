@@ -1,36 +1,266 @@
+from django.conf import settings
+from django.http import (
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse
+)
+from django.utils.http import parse_etags
+from django.views import View
 from rest_framework.generics import ListAPIView
-from rest_framework.status import HTTP_400_BAD_REQUEST
+from rest_framework.status import (
+    HTTP_304_NOT_MODIFIED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND
+)
 from rest_framework.response import Response
-from django.shortcuts import get_object_or_404
+from rest_framework.views import APIView
 
 from .models import (
     Country,
     CountryState
 )
+from .background import background_fills
+from .catalogue import catalogue
+from .metrics import metrics
+from .export import (
+    EXPORT_FORMATS,
+    export_housing_data
+)
+from .registry import registry
+from .routers import read_only_iterator
 from .serializers import (
     CountrySerializer,
     CountryStateSerializer
 )
+from .sync import (
+    get_providers,
+    parse_year_month
+)
 
 
-class CountryView(ListAPIView):
+class CatalogueResponseMixin:
+    """Serves catalogue data (see api.catalogue) with its ETag, answering
+    304 Not Modified for matching If-None-Match headers.
+    """
+    def get_catalogue_response(self, data, etag):
+        headers = {'ETag': etag, 'Cache-Control': 'public, no-cache'}
+        if_none_match = parse_etags(
+            self.request.headers.get('If-None-Match', ''))
+        if '*' in if_none_match or etag in if_none_match:
+            return Response(status=HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(data, headers=headers)
+
+
+class CountryView(CatalogueResponseMixin, ListAPIView):
     """List all countries"""
-    queryset = Country.objects.all()
+    queryset = Country.objects.prefetch_related('states')
     serializer_class = CountrySerializer
 
+    def list(self, request, *args, **kwargs):
+        return self.get_catalogue_response(*catalogue.get_countries())
+
 
-class CountryStateView(ListAPIView):
+class CountryStateView(CatalogueResponseMixin, ListAPIView):
     """List all states for a certain country"""
     queryset = CountryState.objects.all()
     serializer_class = CountryStateSerializer
 
     def list(self, request, *args, **kwargs):
-        # get country states and set self.queryset
         country_name = kwargs.get('country')
         if not country_name:
             return Response('Country not provided', HTTP_400_BAD_REQUEST)
-        country = get_object_or_404(Country, base_uri=country_name)
-        self.queryset = country.states.all()
+        country_states = catalogue.get_country_states(country_name)
+        if country_states is None:
+            raise Http404('No Country matches the given query.')
+        return self.get_catalogue_response(*country_states)
+
+
+class HousingDataBatchView(APIView):
+    """Resolves many housing data requests at once. Takes a list of specs
+    (or {"queries": [...]}) such as:
+
+    {
+        "id": "sc-2023",        # optional, defaults to the spec's index
+        "country": "brazil",
+        "states": ["sc", "rj"], # optional, or "sc-rj"
+        "year": 2023,
+        "month": 1,
+        "final_year": 2023,     # optional
+        "final_month": 12,      # optional
+        "currency": "eur"       # optional, USD by default
+    }
+
+    Specs are grouped by country and resolved with one DB query and one
+    planned remote pass per country (see
+    HousingDataMixin.get_housing_data_batch()). Returns
+    {id: {"status": int, "data": ...}}, where data is what the equivalent
+    GET endpoint would return.
+    """
+    SPEC_INT_FIELDS = ('year', 'month', 'final_year', 'final_month')
+
+    def parse_spec(self, spec):
+        """Returns a normalized spec, or raises ValueError"""
+        if not isinstance(spec, dict):
+            raise ValueError('Each query must be an object')
+        if not isinstance(spec.get('country'), str):
+            raise ValueError('Country not provided')
+
+        parsed_spec = {'country': spec['country'].lower()}
+        for field in self.SPEC_INT_FIELDS:
+            value = spec.get(field)
+            if value is None:
+                if field in ('year', 'month'):
+                    raise ValueError(f'{field} not provided')
+                parsed_spec[field] = None
+                continue
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError(f'{field} must be an integer')
+            parsed_spec[field] = value
+        if (parsed_spec['final_year'] is None)\
+                != (parsed_spec['final_month'] is None):
+            raise ValueError(
+                'final_year and final_month must be provided together')
+
+        states = spec.get('states') or []
+        if isinstance(states, str):
+            states = states.split('-')
+        if not isinstance(states, list)\
+                or not all(isinstance(state, str) for state in states):
+            raise ValueError('states must be a list of abbreviations')
+        parsed_spec['states'] = [state.lower() for state in states]
+
+        currency = spec.get('currency')
+        if currency is not None and (
+                not isinstance(currency, str)
+                or not currency.isalnum() or len(currency) > 10):
+            raise ValueError('Invalid currency')
+        parsed_spec['currency'] = currency.lower() if currency else None
+        return parsed_spec
+
+    def post(self, request, *args, **kwargs):
+        specs = request.data
+        if isinstance(specs, dict):
+            specs = specs.get('queries')
+        if not isinstance(specs, list):
+            return Response('Expected a list of queries', HTTP_400_BAD_REQUEST)
+        max_queries = getattr(settings, 'HOUSING_BATCH_MAX_QUERIES', 100)
+        if len(specs) > max_queries:
+            return Response(
+                f'At most {max_queries} queries are allowed per batch',
+                HTTP_400_BAD_REQUEST
+            )
+
+        ids = [
+            str(spec['id']) if isinstance(spec, dict) and 'id' in spec
+            else str(index)
+            for index, spec in enumerate(specs)
+        ]
+        if len(set(ids)) != len(ids):
+            return Response('Query ids must be unique', HTTP_400_BAD_REQUEST)
+
+        results = {}
+        country_specs = {}
+        providers = get_providers()
+        for spec_id, spec in zip(ids, specs):
+            try:
+                spec = self.parse_spec(spec)
+            except ValueError as e:
+                results[spec_id] = {
+                    'status': HTTP_400_BAD_REQUEST, 'data': str(e)}
+                continue
+            if spec['country'] not in providers:
+                results[spec_id] = {
+                    'status': HTTP_404_NOT_FOUND, 'data': 'Country not found'}
+                continue
+            unknown_states = set(spec['states'])\
+                - set(registry.get_country_states(spec['country']))
+            if unknown_states:
+                results[spec_id] = {
+                    'status': HTTP_400_BAD_REQUEST,
+                    'data': 'Invalid states: '
+                    f'{", ".join(sorted(unknown_states))}'
+                }
+                continue
+            country_specs.setdefault(spec['country'], []).append(
+                (spec_id, spec))
+
+        for country, id_specs in country_specs.items():
+            provider = providers[country]()
+            country_results = provider.get_housing_data_batch(
+                [spec for spec_id, spec in id_specs])
+            for (spec_id, spec), (status, data) in zip(
+                    id_specs, country_results):
+                results[spec_id] = {'status': status, 'data': data}
+
+        return Response({spec_id: results[spec_id] for spec_id in ids})
+
+
+class HousingDataFillView(APIView):
+    """Status of a background fill queued by a stale-while-revalidate housing
+    data request (see HousingDataMixin.retrieve_stale()): pending, done or
+    failed. Once done, repeating the request returns the complete data.
+    """
+    def get(self, request, *args, **kwargs):
+        token = kwargs.get('token')
+        fill_status = background_fills.get_status(token)
+        if fill_status is None:
+            return Response('Fill not found', HTTP_404_NOT_FOUND)
+        return Response({'token': token, 'status': fill_status})
+
+
+class HousingDataExportView(View):
+    """Streams stored housing data as CSV or NDJSON, for bulk exports.
+
+    Query parameters: format (csv or ndjson, csv by default), country and
+    state (repeatable, all by default), since and until (YYYY-MM). Rows are
+    read from the DB in chunks and written as they are read, so memory stays
+    flat however large the export is. Plain Django view, since DRF reserves
+    the format parameter for content negotiation.
+    """
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv')
+        try:
+            since = until = None
+            if request.GET.get('since'):
+                since = parse_year_month(request.GET['since'])
+            if request.GET.get('until'):
+                until = parse_year_month(request.GET['until'])
+        except ValueError:
+            return JsonResponse(
+                'Months must be formatted as YYYY-MM',
+                safe=False, status=HTTP_400_BAD_REQUEST)
+
+        try:
+            lines = export_housing_data(
+                export_format,
+                countries=[
+                    country.lower()
+                    for country in request.GET.getlist('country')
+                ],
+                states=request.GET.getlist('state'),
+                since=since,
+                until=until,
+            )
+        except ValueError as e:
+            return JsonResponse(
+                str(e), safe=False, status=HTTP_400_BAD_REQUEST)
+
+        # streamed once the request has left ReadOnlyRequestMiddleware
+        response = StreamingHttpResponse(
+            read_only_iterator(lines),
+            content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] =\
+            f'attachment; filename="housing_data.{export_format}"'
+        return response
+
 
-        # proceed with behaviour from ListAPIView
-        return super().list(request, *args, **kwargs)
+class MetricsView(View):
+    """Serves this process' metrics (see api.metrics) in the Prometheus text
+    format.
+    """
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(
+            metrics.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
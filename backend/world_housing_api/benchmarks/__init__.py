@@ -0,0 +1,4 @@
+"""Offline benchmarks of the housing data endpoints, run with the
+benchmark_housing command against local stand-ins for the remote APIs (see
+fake_upstreams and runner).
+"""
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import date
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+)
+from urllib.parse import (
+    parse_qs,
+    unquote,
+    urlsplit
+)
+
+IBGE_PATH = re.compile(
+    r'/api/v3/agregados/2296/periodos/(?P<periods>[^/]+)'
+    r'/variaveis/(?P<variables>[^/?]+)'
+)
+IBGE_LOCALITIES = re.compile(r'(?P<level>N\d)\[(?P<codes>[^\]]*)\]')
+CURRENCY_PATH = re.compile(
+    r'/currency-api@(?P<date>[^/]+)/v1/currencies/usd\.json')
+
+IBGE_VARIABLES = {
+    '48': {
+        'variavel': 'Custo médio m² - moeda corrente',
+        'unidade': 'Moeda corrente',
+    },
+    '1196': {
+        'variavel': 'Variação percentual no mês',
+        'unidade': '%',
+    },
+}
+
+
+def get_noise(*key):
+    """Returns a deterministic value in [0, 1) for key"""
+    digest = hashlib.sha1(repr(key).encode()).digest()
+    return int.from_bytes(digest[:4], 'big') / 2 ** 32
+
+
+class FakeUpstreams:
+    """Local stand-ins for IBGE's aggregate 2296 API and the currency API,
+    serving payloads shaped like the real ones from a thread per request.
+
+    Values are deterministic for a period and locality, so runs are
+    comparable. Periods after published_until are answered with IBGE's
+    '...' (not published), as the real API does for recent months. Each
+    response is delayed by latency seconds, plus up to jitter seconds.
+
+    Use as a context manager; ibge_url and currency_url are the values for
+    HOUSING_IBGE_API_URL and HOUSING_CURRENCY_API_URL.
+    """
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0,
+                 published_until: tuple = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.published_until = published_until\
+            or (date.today().year, date.today().month)
+        self.requests = {'ibge': 0, 'currency-api': 0}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def ibge_url(self):
+        return f'{self.base_url}/api/v3'
+
+    @property
+    def currency_url(self):
+        return f'{self.base_url}/currency-api@[DATE]/v1/currencies/usd.json'
+
+    def __enter__(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                upstreams.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def count(self, upstream: str):
+        with self._lock:
+            self.requests[upstream] += 1
+
+    def handle(self, request):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        url = urlsplit(unquote(request.path))
+
+        match = IBGE_PATH.fullmatch(url.path)
+        if match:
+            self.count('ibge')
+            localities = IBGE_LOCALITIES.fullmatch(
+                parse_qs(url.query).get('localidades', [''])[0])
+            if localities is None:
+                return self.respond(request, 400, {'message': 'Bad request'})
+            return self.respond(request, 200, self.get_ibge_payload(
+                match['periods'].split('|'),
+                match['variables'].split('|'),
+                localities['level'],
+                localities['codes'].split(','),
+            ))
+
+        match = CURRENCY_PATH.fullmatch(url.path)
+        if match:
+            self.count('currency-api')
+            return self.respond(
+                request, 200, self.get_currency_payload(match['date']))
+
+        self.respond(request, 404, {'message': 'Not found'})
+
+    @staticmethod
+    def respond(request, status: int, payload):
+        body = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def get_ibge_value(self, variable: str, period: str, locality: str):
+        year, month = int(period[:4]), int(period[4:])
+        if (year, month) > self.published_until:
+            return '...'
+        if variable == '1196':
+            return f'{0.1 + get_noise(locality, period) * 0.9:.2f}'
+        # roughly SINAPI's cost per m², growing ~6% a year since 2000
+        months = (year - 2000) * 12 + month - 1
+        return f'{(500 + 400 * get_noise(locality)) * 1.005 ** months:.2f}'
+
+    def get_ibge_payload(self, periods: list, variables: list, level: str,
+                         codes: list):
+        if level == 'N1':
+            codes = ['1']
+        return [
+            {
+                'id': variable,
+                **IBGE_VARIABLES.get(variable, {}),
+                'resultados': [{
+                    'classificacoes': [],
+                    'series': [
+                        {
+                            'localidade': {
+                                'id': code,
+                                'nivel': {'id': level},
+                            },
+                            'serie': {
+                                period: self.get_ibge_value(
+                                    variable, period, code)
+                                for period in sorted(periods)
+                            },
+                        }
+                        for code in codes
+                    ],
+                }],
+            }
+            for variable in variables
+        ]
+
+    @staticmethod
+    def get_currency_payload(day: str):
+        noise = get_noise(day)
+        return {
+            'date': day if day != 'latest' else date.today().isoformat(),
+            'usd': {
+                'brl': round(4 + 2 * noise, 4),
+                'eur': round(0.85 + 0.1 * noise, 4),
+                'gbp': round(0.75 + 0.1 * noise, 4),
+                'usd': 1,
+            },
+        }
@@ -0,0 +1,293 @@
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from django import get_version
+from django.conf import settings
+from django.core.management import call_command
+from django.db import (
+    connection,
+    connections
+)
+from django.test import Client
+from django.test.utils import override_settings
+from api.models import (
+    CurrencyRate,
+    HousingData
+)
+from api.registry import registry
+from api.utils import (
+    clear_rates_cache,
+    get_period,
+    get_year_month
+)
+from .fake_upstreams import FakeUpstreams
+
+COUNTRY = 'brazil'
+ENDPOINTS = ('single', 'range', 'states', 'states_range')
+SCENARIOS = ('cold', 'warm', 'mixed')
+
+
+def get_percentile(sorted_values: list, percentile: float):
+    """Nearest-rank percentile of sorted_values"""
+    if not sorted_values:
+        return None
+    rank = max(1, round(percentile / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkRunner:
+    """Measures the Brazil housing data endpoints against FakeUpstreams, on a
+    throwaway copy of the DB.
+
+    Each case is an endpoint with a number of states (for the states
+    endpoints) and a range length in months (for the range endpoints), ending
+    at until, under a scenario:
+
+    - cold: no housing data or exchange rates stored nor cached, so every
+      request goes to the remotes
+    - warm: everything requested is already stored
+    - mixed: like warm, but each request has a miss_ratio chance of its
+      latest month missing from the DB, so it has to be fetched
+
+    Requests go through Django's test client, so latencies include routing,
+    DB access, remote calls and rendering, but no network or server
+    overhead on the API side.
+    """
+    def __init__(
+            self,
+            requests: int = 50,
+            concurrency: int = 1,
+            state_counts: tuple = (1, 5, 27),
+            range_months: tuple = (12, 60),
+            until: tuple = (2024, 6),
+            latency: float = 0.05,
+            jitter: float = 0.0,
+            miss_ratio: float = 0.2,
+            seed: int = 0,
+            log=None):
+        self.requests = requests
+        self.concurrency = concurrency
+        self.state_counts = state_counts
+        self.range_months = range_months
+        self.until = until
+        self.latency = latency
+        self.jitter = jitter
+        self.miss_ratio = miss_ratio
+        self.random = random.Random(seed)
+        self.log = log or (lambda message: None)
+
+    def get_cases(self, endpoints: tuple = ENDPOINTS):
+        """Yields (endpoint, state count, range months) for every case"""
+        for endpoint in endpoints:
+            state_counts = self.state_counts\
+                if endpoint.startswith('states') else (None,)
+            range_months = self.range_months\
+                if endpoint.endswith('range') else (None,)
+            for state_count in state_counts:
+                for months in range_months:
+                    yield endpoint, state_count, months
+
+    def get_url(self, endpoint: str, state_count: int, months: int):
+        final_year, final_month = self.until
+        url = f'/housing/{COUNTRY}/'
+        if state_count:
+            states = registry.get_country_states(COUNTRY)[:state_count]
+            url += '-'.join(states) + '/'
+        if months:
+            year, month = get_year_month(
+                get_period(final_year, final_month) - months + 1)
+            return url + f'{year}/{month}/{final_year}/{final_month}'
+        return url + f'{final_year}/{final_month}'
+
+    def get_latest_entries(self, state_count: int):
+        states = registry.get_country_states(COUNTRY)[:state_count or 0]
+        entries = HousingData.objects.filter(
+            country_id=registry.get_country_id(COUNTRY),
+            period=get_period(*self.until)
+        )
+        if states:
+            return entries.filter(
+                state_id__in=registry.get_state_ids(COUNTRY, states))
+        return entries.filter(state_id__isnull=True)
+
+    @staticmethod
+    def clear():
+        HousingData.objects.all().delete()
+        CurrencyRate.objects.all().delete()
+        clear_rates_cache()
+
+    def prepare(self, scenario: str, state_count: int):
+        """Sets the DB up for the next request of a case"""
+        if scenario == 'cold':
+            self.clear()
+        elif scenario == 'mixed' and self.random.random() < self.miss_ratio:
+            self.get_latest_entries(state_count).delete()
+
+    def run_case(self, scenario: str, endpoint: str, state_count: int,
+                 months: int):
+        url = self.get_url(endpoint, state_count, months)
+        if scenario == 'cold':
+            self.clear()
+        else:
+            Client().get(url)
+
+        # cold requests reset the DB first, so they are issued one at a time
+        concurrency = self.concurrency if scenario != 'cold' else 1
+        upstream_requests = dict(self.upstreams.requests)
+        latencies = []
+        statuses = {}
+
+        def request():
+            client = Client()
+            response_start = time.perf_counter()
+            response = client.get(url)
+            latency = time.perf_counter() - response_start
+            return response.status_code, latency
+
+        start = time.perf_counter()
+        elapsed = 0.0
+        issued = 0
+        with ThreadPoolExecutor(concurrency) as executor:
+            while issued < self.requests:
+                batch = min(concurrency, self.requests - issued)
+                for _ in range(batch):
+                    self.prepare(scenario, state_count)
+                batch_start = time.perf_counter()
+                for status, latency in executor.map(
+                        lambda _: request(), range(batch)):
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+                    latencies.append(latency)
+                elapsed += time.perf_counter() - batch_start
+                issued += batch
+        wall_seconds = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            'scenario': scenario,
+            'endpoint': endpoint,
+            'url': url,
+            'states': state_count,
+            'months': months,
+            'requests': len(latencies),
+            'concurrency': concurrency,
+            'p50_ms': get_percentile(latencies, 50) * 1000,
+            'p95_ms': get_percentile(latencies, 95) * 1000,
+            'p99_ms': get_percentile(latencies, 99) * 1000,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'min_ms': latencies[0] * 1000,
+            'max_ms': latencies[-1] * 1000,
+            # requests per second of time spent serving, leaving the DB
+            # resets between requests out
+            'throughput_rps': len(latencies) / elapsed,
+            'wall_seconds': wall_seconds,
+            'statuses': statuses,
+            'upstream_requests': {
+                name: count - upstream_requests[name]
+                for name, count in self.upstreams.requests.items()
+            },
+        }
+
+    def run(self, scenarios: tuple = SCENARIOS,
+            endpoints: tuple = ENDPOINTS):
+        """Runs every case of scenarios and endpoints on a throwaway DB and
+        returns the results, with metadata about the run.
+        """
+        old_name = connection.settings_dict['NAME']
+        mirrors = {
+            alias: connections[alias].settings_dict['NAME']
+            for alias in connections
+            if connections[alias].settings_dict['TEST']['MIRROR']
+            == connection.alias
+        }
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # a file, so threads share it
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                temp_dir, 'benchmark.sqlite3')
+            connection.creation.create_test_db(
+                verbosity=0, autoclobber=True)
+            for alias in mirrors:
+                connections[alias].close()
+                connections[alias].creation.set_as_test_mirror(
+                    connection.settings_dict)
+            try:
+                call_command('loaddata', COUNTRY, verbosity=0)
+                registry.invalidate()
+                with FakeUpstreams(
+                        latency=self.latency,
+                        jitter=self.jitter,
+                        published_until=self.until) as upstreams,\
+                        override_settings(
+                            HOUSING_IBGE_API_URL=upstreams.ibge_url,
+                            HOUSING_CURRENCY_API_URL=upstreams.currency_url,
+                            HOUSING_LOCK_DIR=temp_dir,
+                            ALLOWED_HOSTS=['*']):
+                    self.upstreams = upstreams
+                    results = []
+                    for scenario in scenarios:
+                        for case in self.get_cases(endpoints):
+                            self.log(f'{scenario} {" ".join(map(str, case))}')
+                            results.append(self.run_case(scenario, *case))
+            finally:
+                for alias, name in mirrors.items():
+                    connections[alias].close()
+                    connections[alias].settings_dict['NAME'] = name
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                registry.invalidate()
+
+        return {
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'django': get_version(),
+                'async_views': settings.HOUSING_ASYNC_VIEWS,
+                'requests': self.requests,
+                'concurrency': self.concurrency,
+                'upstream_latency_ms': self.latency * 1000,
+                'upstream_jitter_ms': self.jitter * 1000,
+                'miss_ratio': self.miss_ratio,
+                'until': '{}-{:02d}'.format(*self.until),
+            },
+            'results': results,
+        }
+
+
+def compare_results(baseline: dict, results: dict):
+    """Yields (case, metric, baseline value, value, ratio) for the latency
+    percentiles of cases present in both results.
+    """
+    def get_key(result):
+        return (result['scenario'], result['endpoint'], result['states'],
+                result['months'])
+
+    baseline_results = {
+        get_key(result): result for result in baseline['results']}
+    for result in results['results']:
+        baseline_result = baseline_results.get(get_key(result))
+        if baseline_result is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            yield (
+                get_key(result),
+                metric,
+                baseline_result[metric],
+                result[metric],
+                result[metric] / baseline_result[metric]
+                if baseline_result[metric] else None,
+            )
@@ -1,11 +1,22 @@
-import requests
+import asyncio
+import threading
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from django.conf import settings
+from requests.utils import requote_uri
 from api.mixins import HousingDataMixin
-from api.models import CountryState
+from api.registry import registry
+from api.upstream import upstream
+
+IBGE_API_URL = 'https://servicodados.ibge.gov.br/api/v3'
 
 
 class BrazilHousingDataMixin(HousingDataMixin):
     """Implements get_housing_data_from_remote() for Brazil"""
     COUNTRY = 'brazil'
+    # IBGE publishes prices in reais
+    CURRENCY = 'brl'
     STATES_IBGE_FACTORY = {
         # equivalent codes for each state for IBGE API
         'ac': 12,
@@ -44,32 +55,20 @@ class BrazilHousingDataMixin(HousingDataMixin):
         'state': 'N3'
     }
 
+    # IBGE's symbols for values that are not available
+    IBGE_MISSING_VALUES = ('...', '..', 'X')
+
     def get_state_from_id(self, id: int):
         """Returns state abbreviation based on IBGE's state ID"""
-        for key, value in self.STATES_IBGE_FACTORY.items():
-            if value == id:
-                return key
-        return None
+        return registry.get_state_from_code(self.COUNTRY, id)
 
-    def get_housing_data_from_remote(
-            self,
-            year: int,
-            month: int,
-            final_year: int = None,
-            final_month: int = None,
-            states: list = []):
-        """More info at
-        https://servicodados.ibge.gov.br/api/docs/agregados?versao=3#api-acervo
+    def get_ibge_url(self, periods: list, states: list = []):
+        """Returns the IBGE aggregate URL for periods ('YYYYMM' strings) and
+        states (all the country if empty).
         """
-        url = 'https://servicodados.ibge.gov.br/api/v3/agregados/2296/periodos/[PERIODS]/variaveis/48|1196?localidades=[LEVEL][[STATES]]'
-        requested_entries = HousingDataMixin.get_requested_entries(
-            year=year, month=month, final_year=final_year,
-            final_month=final_month, states=states)
-
-        periods = list(set([
-            f'{entry["year"]}{"{:02d}".format(entry["month"])}'
-            for entry in requested_entries
-        ]))
+        url = (getattr(settings, 'HOUSING_IBGE_API_URL', None) or IBGE_API_URL)\
+            + '/agregados/2296/periodos/[PERIODS]/variaveis/48|1196'\
+            '?localidades=[LEVEL][[STATES]]'
         url = url.replace('[PERIODS]', '|'.join(periods))
 
         if states:
@@ -82,17 +81,94 @@ class BrazilHousingDataMixin(HousingDataMixin):
         else:
             url = url.replace('[LEVEL]', self.LEVELS_IBGE_FACTORY['national'])
             url = url.replace('[STATES]', self.STATES_IBGE_FACTORY['all'])
+        return url
 
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise Exception(
-                f'Failed to retrieve Brazilian data from IBGE API ({url}).'
+    def get_ibge_url_length(self, periods: list, states: list = []):
+        """Returns the length of get_ibge_url() once percent-encoded"""
+        return len(requote_uri(self.get_ibge_url(periods, states)))
+
+    @staticmethod
+    def split_chunks(items: list, base_length: int, item_length,
+                     max_length: int):
+        """Splits items into chunks whose base_length plus the
+        item_length() of each item doesn't exceed max_length, unless a
+        single item does.
+        """
+        chunks = []
+        chunk = []
+        length = base_length
+        for item in items:
+            if chunk and length + item_length(item) > max_length:
+                chunks.append(chunk)
+                chunk = []
+                length = base_length
+            chunk.append(item)
+            length += item_length(item)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def plan_ibge_requests(self, periods: list, states: list = []):
+        """Splits the requested periods ('YYYYMM' strings) and states into
+        (periods, states) chunks whose get_ibge_url() is at most
+        HOUSING_IBGE_MAX_URL_LENGTH characters long once encoded. States are
+        split first, as few times as possible, then each group's periods into
+        chunks of even sizes.
+        """
+        max_length = getattr(settings, 'HOUSING_IBGE_MAX_URL_LENGTH', 2000)
+        periods = sorted(periods)
+        # separators included: '|' is encoded as %7C
+        period_length = len(requote_uri('|')) + 6
+
+        state_chunks = [[]]
+        if states:
+            state_chunks = self.split_chunks(
+                sorted(states),
+                self.get_ibge_url_length([], []) + period_length,
+                lambda state:
+                len(str(self.STATES_IBGE_FACTORY[state.lower()])) + 1,
+                max_length
+            )
+        chunks = []
+        for state_chunk in state_chunks:
+            period_chunks = self.split_chunks(
+                periods,
+                self.get_ibge_url_length([], state_chunk),
+                lambda period: period_length,
+                max_length
             )
+            # as many chunks, but of even sizes, so they take about as long
+            size = -(-len(periods) // len(period_chunks))
+            chunks += [
+                (periods[index:index + size], state_chunk)
+                for index in range(0, len(periods), size)
+            ]
+        return chunks
 
-        response = response.json()
+    @staticmethod
+    def get_ibge_periods(
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None):
+        """Returns the requested periods as IBGE 'YYYYMM' strings"""
+        requested_entries = HousingDataMixin.get_requested_entries(
+            year=year, month=month, final_year=final_year,
+            final_month=final_month)
 
-        # restructure data
-        data = {}
+        return list(set([
+            f'{entry["year"]}{"{:02d}".format(entry["month"])}'
+            for entry in requested_entries
+        ]))
+
+    @staticmethod
+    def parse_ibge_response(response: list, data: dict = None):
+        """Restructures an IBGE aggregate response as
+        {location: {'YYYYMM': {'square_meter_price': float,
+        'variation': float}}}, merging into data if given.
+        """
+        if data is None:
+            data = {}
         for stats in response:
             stat_field = 'variation'
             if stats['id'] == '48':
@@ -102,6 +178,9 @@ class BrazilHousingDataMixin(HousingDataMixin):
                 if result['localidade']['id'] not in data:
                     data[result['localidade']['id']] = {}
                 for date, value in result['serie'].items():
+                    if value in BrazilHousingDataMixin.IBGE_MISSING_VALUES:
+                        # period not published (yet)
+                        continue
                     try:
                         float(value)
                     except Exception as e:
@@ -113,19 +192,23 @@ class BrazilHousingDataMixin(HousingDataMixin):
                         data[result['localidade']['id']][date] = {}
                     data[result['localidade']['id']][date][stat_field]\
                         = float(value)
+        return data
 
+    def get_ibge_entries(self, data: dict, states: list):
+        """Returns parsed IBGE data in the get_housing_data_from_remote()
+        format, with prices in reais.
+        """
         res = []
         for location in data:
             for date, values in data[location].items():
+                if len(values) < 2:
+                    # only one of the variables was published
+                    continue
                 res.append({
                     "year": int(date[:4]),
                     "month": int(date[-2:]),
-                    "square_meter_price": self.convert_to_dolar_on_month(
-                        currency='brl',
-                        value=values['square_meter_price'],
-                        year=int(date[:4]),
-                        month=int(date[-2:])
-                    ),
+                    "square_meter_price": values['square_meter_price'],
+                    "currency": self.CURRENCY,
                     "variation": values['variation'] / 100,
                     "state_id": None if not states
                     else self.get_state_id_from_abbreviation(
@@ -134,3 +217,108 @@ class BrazilHousingDataMixin(HousingDataMixin):
                 })
         return res
 
+    def get_housing_data_from_remote(
+            self,
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = []):
+        """More info at
+        https://servicodados.ibge.gov.br/api/docs/agregados?versao=3#api-acervo
+
+        Requests are split by plan_ibge_requests() and fetched by up to
+        HOUSING_IBGE_MAX_WORKERS threads.
+        """
+        urls = [
+            self.get_ibge_url(periods, url_states)
+            for periods, url_states in self.plan_ibge_requests(
+                self.get_ibge_periods(year, month, final_year, final_month),
+                states
+            )
+        ]
+
+        data = {}
+        data_lock = threading.Lock()
+
+        def fetch(url):
+            # merged as soon as it arrives, so only the responses in flight
+            # are held at once
+            response = self.get_ibge_response(url)
+            with data_lock:
+                self.parse_ibge_response(response, data)
+
+        if len(urls) == 1:
+            fetch(urls[0])
+        else:
+            with ThreadPoolExecutor(min(
+                    len(urls),
+                    getattr(settings, 'HOUSING_IBGE_MAX_WORKERS', 4))
+                    ) as executor:
+                futures = [
+                    # a context per task, so upstream timings reach the
+                    # request's Server-Timing
+                    executor.submit(copy_context().run, fetch, url)
+                    for url in urls
+                ]
+            for future in futures:
+                future.result()
+
+        return self.get_ibge_entries(data, states)
+
+    @staticmethod
+    def get_ibge_response(url: str):
+        """Returns the decoded IBGE response for url"""
+        response = upstream.get(url, upstream='ibge')
+        if response.status_code != 200:
+            raise Exception(
+                f'Failed to retrieve Brazilian data from IBGE API ({url}).'
+            )
+        return response.json()
+
+    @staticmethod
+    async def aget_ibge_response(url: str, semaphore: asyncio.Semaphore):
+        """Async version of get_ibge_response(), holding semaphore while
+        requesting
+        """
+        async with semaphore:
+            response = await upstream.aget(url, upstream='ibge')
+        if response.status_code != 200:
+            raise Exception(
+                f'Failed to retrieve Brazilian data from IBGE API ({url}).'
+            )
+        return response.json()
+
+    async def aget_housing_data_from_remote(
+            self,
+            year: int,
+            month: int,
+            final_year: int = None,
+            final_month: int = None,
+            states: list = []):
+        """Async version of get_housing_data_from_remote(), requesting the
+        chunks concurrently.
+        """
+        urls = [
+            self.get_ibge_url(periods, url_states)
+            for periods, url_states in self.plan_ibge_requests(
+                self.get_ibge_periods(year, month, final_year, final_month),
+                states
+            )
+        ]
+
+        semaphore = asyncio.Semaphore(
+            getattr(settings, 'HOUSING_IBGE_MAX_WORKERS', 4))
+        data = {}
+        for response in asyncio.as_completed([
+                self.aget_ibge_response(url, semaphore) for url in urls]):
+            self.parse_ibge_response(await response, data)
+
+        return await sync_to_async(self.get_ibge_entries)(data, states)
+
+
+registry.register_state_codes(BrazilHousingDataMixin.COUNTRY, {
+    state: code
+    for state, code in BrazilHousingDataMixin.STATES_IBGE_FACTORY.items()
+    if state != 'all'
+})
@@ -1,3 +1,178 @@
-from django.test import TestCase
+import httpx
+import json
+import re
+import requests
+from unittest import mock
+from urllib.parse import unquote
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    override_settings
+)
 
-# Create your tests here.
+from api.upstream import upstream
+from .mixins import BrazilHousingDataMixin
+
+
+class IBGERequestPlanTestCase(SimpleTestCase):
+    """Long IBGE requests are split into URLs of bounded length"""
+    @override_settings(HOUSING_IBGE_MAX_URL_LENGTH=1000)
+    def test_plan(self):
+        mixin = BrazilHousingDataMixin()
+        periods = mixin.get_ibge_periods(2000, 1, 2024, 12)
+        states = mixin.STATES_IBGE_FACTORY.keys() - {'all'}
+        for requested_states in ([], states):
+            plan = mixin.plan_ibge_requests(periods, requested_states)
+            self.assertGreater(len(plan), 1)
+            for chunk_periods, chunk_states in plan:
+                self.assertLessEqual(
+                    mixin.get_ibge_url_length(chunk_periods, chunk_states),
+                    1000
+                )
+            keys = [
+                (period, state)
+                for chunk_periods, chunk_states in plan
+                for period in chunk_periods
+                for state in chunk_states or [None]
+            ]
+            self.assertEqual(len(keys), len(set(keys)))
+            self.assertEqual(
+                len(keys), len(periods) * len(requested_states or [None]))
+
+
+@override_settings(
+    HOUSING_IBGE_API_URL='https://ibge.test', HOUSING_IBGE_MAX_URL_LENGTH=200)
+class IBGERemoteTestCase(TestCase):
+    """Remote data is fetched in chunks, whose series are merged into a
+    single list of entries
+    """
+    fixtures = ['brazil']
+
+    # (location, 'YYYYMM', variable id) -> value, as IBGE marks months not
+    # published, e.g. a price published before its variation
+    MISSING_VALUES = {
+        ('1', '202106', '1196'): '...',
+        ('33', '202001', '48'): '..',
+        ('33', '202001', '1196'): '..',
+        ('35', '202112', '48'): 'X',
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.mixin = BrazilHousingDataMixin()
+        self.urls = []
+
+    def get_ibge_data(self, url: str):
+        """Returns what IBGE answers to url, for every requested month"""
+        self.urls.append(url)
+        url = unquote(url)
+        periods = re.search(r'/periodos/([^/]+)/', url).group(1).split('|')
+        locations = re.search(
+            r'localidades=N\d\[([^\]]+)\]', url).group(1).split(',')
+        if locations == ['all']:
+            locations = ['1']
+        return [
+            {
+                'id': variable_id,
+                'resultados': [{'series': [
+                    {
+                        'localidade': {'id': location},
+                        'serie': {
+                            period: self.MISSING_VALUES.get(
+                                (location, period, variable_id),
+                                f'{1000 + int(period[-2:])}'
+                                if variable_id == '48' else '1.0'
+                            )
+                            for period in periods
+                        },
+                    }
+                    for location in locations
+                ]}],
+            }
+            for variable_id in ('48', '1196')
+        ]
+
+    def get_session(self):
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(self.get_ibge_data(url)).encode()
+            return response
+
+        session = mock.Mock()
+        session.get.side_effect = get
+        return session
+
+    def get_async_client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(
+                200, json=self.get_ibge_data(str(request.url)))
+        ))
+
+    def get_keys(self, entries: list):
+        keys = [
+            (entry['year'], entry['month'], entry['state_id'])
+            for entry in entries
+        ]
+        self.assertEqual(len(keys), len(set(keys)))
+        return set(keys)
+
+    def get_expected_keys(self, states: list, skipped: set):
+        state_ids = [
+            self.mixin.get_state_id_from_abbreviation(state)
+            for state in states
+        ] or [None]
+        return set(
+            (year, month, state_id)
+            for year in (2020, 2021)
+            for month in range(1, 13)
+            for state_id in state_ids
+        ) - skipped
+
+    def assertEntries(self, entries: list, states: list):
+        state_ids = {
+            state: self.mixin.get_state_id_from_abbreviation(state)
+            for state in states
+        }
+        # months with a missing value are left out
+        skipped = {(2021, 6, None)} if not states else {
+            (2020, 1, state_ids['rj']),
+            (2021, 12, state_ids['sp']),
+        }
+        self.assertEqual(
+            self.get_keys(entries), self.get_expected_keys(states, skipped))
+        self.assertGreater(len(self.urls), 1)
+        self.assertEqual(
+            len(self.urls),
+            len(self.mixin.plan_ibge_requests(
+                self.mixin.get_ibge_periods(2020, 1, 2021, 12), states))
+        )
+
+        entry = next(
+            entry for entry in entries
+            if (entry['year'], entry['month']) == (2020, 3)
+            and entry['state_id'] == state_ids.get('sc')
+        )
+        self.assertEqual(entry['square_meter_price'], 1003)
+        self.assertEqual(entry['variation'], 0.01)
+        self.assertEqual(entry['currency'], 'brl')
+
+    def test_chunks_are_merged(self):
+        for states in ([], ['sc', 'rj', 'sp']):
+            self.urls.clear()
+            with mock.patch.object(
+                    upstream, 'get_session', self.get_session):
+                entries = self.mixin.get_housing_data_from_remote(
+                    2020, 1, 2021, 12, states)
+            self.assertEntries(entries, states)
+
+    async def test_async_chunks_are_merged(self):
+        for states in ([], ['sc', 'rj', 'sp']):
+            self.urls.clear()
+            client = self.get_async_client()
+            with mock.patch.object(
+                    upstream, 'get_async_client', return_value=client):
+                entries = await self.mixin.aget_housing_data_from_remote(
+                    2020, 1, 2021, 12, states)
+            await client.aclose()
+            self.assertEntries(entries, states)
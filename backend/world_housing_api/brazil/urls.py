@@ -1,13 +1,33 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
+    AsyncRetrieveBrazilHousingData,
+    AsyncRetrieveBrazilHousingDataRange,
+    AsyncRetrieveBrazilHousingDataStates,
+    AsyncRetrieveBrazilHousingDataStatesRange,
     RetrieveBrazilHousingData,
+    RetrieveBrazilHousingDataAnalytics,
     RetrieveBrazilHousingDataRange,
     RetrieveBrazilHousingDataStates,
     RetrieveBrazilHousingDataStatesRange,
 )
 
 
+if settings.HOUSING_ASYNC_VIEWS:
+    RetrieveBrazilHousingData = AsyncRetrieveBrazilHousingData
+    RetrieveBrazilHousingDataRange = AsyncRetrieveBrazilHousingDataRange
+    RetrieveBrazilHousingDataStates = AsyncRetrieveBrazilHousingDataStates
+    RetrieveBrazilHousingDataStatesRange =\
+        AsyncRetrieveBrazilHousingDataStatesRange
+
 urlpatterns = [
+    # before the states patterns, which would take "analytics" as states
+    path('analytics/<int:year>/<int:month>/<int:final_year>'
+         '/<int:final_month>',
+         RetrieveBrazilHousingDataAnalytics.as_view()),
+    path('<str:states>/analytics/<int:year>/<int:month>/<int:final_year>'
+         '/<int:final_month>',
+         RetrieveBrazilHousingDataAnalytics.as_view()),
     path('<int:year>/<int:month>', RetrieveBrazilHousingData.as_view()),
     path('<str:states>/<int:year>/<int:month>',
          RetrieveBrazilHousingDataStates.as_view()),
@@ -1,4 +1,9 @@
 from api.generics import (
+    AsyncRetrieveHousingDataAPIView,
+    AsyncRetrieveHousingDataRangeAPIView,
+    AsyncRetrieveHousingDataStatesAPIView,
+    AsyncRetrieveHousingDataStatesRangeAPIView,
+    RetrieveHousingDataAnalyticsAPIView,
     RetrieveHousingDataAPIView,
     RetrieveHousingDataRangeAPIView,
     RetrieveHousingDataStatesAPIView,
@@ -26,3 +31,32 @@ class RetrieveBrazilHousingDataStatesRange(
         BrazilHousingDataMixin,
         RetrieveHousingDataStatesRangeAPIView):
     pass
+
+
+class RetrieveBrazilHousingDataAnalytics(
+        BrazilHousingDataMixin,
+        RetrieveHousingDataAnalyticsAPIView):
+    pass
+
+
+class AsyncRetrieveBrazilHousingData(BrazilHousingDataMixin,
+                                     AsyncRetrieveHousingDataAPIView):
+    pass
+
+
+class AsyncRetrieveBrazilHousingDataRange(
+        BrazilHousingDataMixin,
+        AsyncRetrieveHousingDataRangeAPIView):
+    pass
+
+
+class AsyncRetrieveBrazilHousingDataStates(
+        BrazilHousingDataMixin,
+        AsyncRetrieveHousingDataStatesAPIView):
+    pass
+
+
+class AsyncRetrieveBrazilHousingDataStatesRange(
+        BrazilHousingDataMixin,
+        AsyncRetrieveHousingDataStatesRangeAPIView):
+    pass
@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'world_housing_api.settings')
+os.environ.setdefault('HOUSING_ASYNC_VIEWS', '1')
+# no persistent DB connections, see settings.DATABASES
+os.environ['HOUSING_ASGI'] = '1'
 
 application = get_asgi_application()
@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.ServerTimingMiddleware',
+    'api.middleware.ReadOnlyRequestMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -85,6 +87,47 @@ DATABASES = {
     }
 }
 
+# Concurrent SQLite profile (disable with HOUSING_SQLITE_CONCURRENT=0): WAL
+# so readers don't wait for remote fills being written, IMMEDIATE write
+# transactions and a busy timeout instead of "database is locked" errors,
+# a larger page cache and memory-mapped reads, and persistent connections
+# (except under ASGI, where Django advises against them, see asgi.py).
+# GET requests read through the "readonly" alias (see api.routers), so the
+# read path never holds or waits for a write lock.
+if os.environ.get('HOUSING_SQLITE_CONCURRENT', '1') == '1':
+    SQLITE_CONN_MAX_AGE = 0 if os.environ.get('HOUSING_ASGI') == '1' else 600
+    SQLITE_PRAGMAS = [
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -65536',  # in KiB
+        'PRAGMA mmap_size = 268435456',
+        'PRAGMA temp_store = MEMORY',
+    ]
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': SQLITE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': ';'.join(SQLITE_PRAGMAS),
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
+    })
+    DATABASES['readonly'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASES['default']['NAME'],
+        'CONN_MAX_AGE': SQLITE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': ';'.join(
+                SQLITE_PRAGMAS + ['PRAGMA query_only = ON']),
+            'timeout': 20,
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+    DATABASE_ROUTERS = ['api.routers.ReadOnlyRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -130,3 +173,83 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # CORS
 ALLOWED_HOSTS=['*']
 CORS_ALLOW_ALL_ORIGINS = True
+
+# Cache for the country catalogue (see api.catalogue). Point it to a shared
+# backend (e.g. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+# and CACHE_LOCATION=redis://...) so processes share it
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Serve housing data with async views (set by asgi.py), so upstream I/O
+# doesn't block workers
+HOUSING_ASYNC_VIEWS = os.environ.get('HOUSING_ASYNC_VIEWS') == '1'
+
+# Housing data HTTP caching (seconds): responses ending before the latest
+# published month are not expected to change
+HOUSING_CACHE_MAX_AGE = 60 * 60 * 24 * 30
+HOUSING_RECENT_CACHE_MAX_AGE = 60 * 5
+
+# Single-flight remote fetches (see api.singleflight): directory for the
+# cross-process lease files, removed on release (a temporary directory by
+# default), and how long to wait for a lease, in seconds
+HOUSING_LOCK_DIR = os.environ.get('HOUSING_LOCK_DIR')
+HOUSING_LEASE_TIMEOUT = 60
+
+# Upstream APIs (see api.upstream): timeouts in seconds, retries for
+# transient failures with jittered exponential backoff starting at
+# HOUSING_UPSTREAM_BACKOFF seconds, and keep-alive connections per host
+HOUSING_UPSTREAM_CONNECT_TIMEOUT = 5
+HOUSING_UPSTREAM_READ_TIMEOUT = 30
+HOUSING_UPSTREAM_MAX_RETRIES = 3
+HOUSING_UPSTREAM_BACKOFF = 0.5
+HOUSING_UPSTREAM_POOL_SIZE = 10
+
+# Base URLs of the remote APIs, defaulting to the public ones (see
+# brazil.mixins.IBGE_API_URL and api.utils.CURRENCY_API_URL); the benchmarks
+# point them to local stand-ins
+HOUSING_IBGE_API_URL = os.environ.get('HOUSING_IBGE_API_URL')
+HOUSING_CURRENCY_API_URL = os.environ.get('HOUSING_CURRENCY_API_URL')
+
+# IBGE requests are split so their URLs are at most this long, and fetched
+# by up to HOUSING_IBGE_MAX_WORKERS threads (or coroutines) at once
+HOUSING_IBGE_MAX_URL_LENGTH = 2000
+HOUSING_IBGE_MAX_WORKERS = 4
+
+# Months a remote fetch had no data for, and each country's latest published
+# month, are remembered for this many seconds so requests for them are not
+# fetched again meanwhile (see api.unpublished); 0 disables it
+HOUSING_UNPUBLISHED_TTL = 60 * 60
+
+# Threads filling missing housing data in the background for requests with
+# 'Prefer: respond-async' (see api.background)
+HOUSING_BACKGROUND_WORKERS = 4
+
+# Maximum number of (month, state) keys per page of range requests; larger
+# ranges are paginated (see HousingDataMixin.retrieve_page())
+HOUSING_MAX_PAGE_SIZE = 5000
+
+# Maximum number of queries in a POST /housing/batch request
+HOUSING_BATCH_MAX_QUERIES = 100
+
+# Currency housing data prices are returned in unless requested otherwise
+# with ?currency= (see HousingDataMixin.convert_housing_data_rows())
+HOUSING_DEFAULT_CURRENCY = 'usd'
+
+# Seconds the currency codes rates can be downloaded for are cached, so
+# unknown ?currency= codes are answered without calling the currency API
+HOUSING_CURRENCIES_TTL = 60 * 60 * 24
+
+# Seconds the 'latest' rates used for days not published yet by the currency
+# API are cached, as they are not stored
+HOUSING_LATEST_RATES_TTL = 60 * 60
+
+# Exchange rates of missing days are downloaded by up to
+# HOUSING_CURRENCY_MAX_WORKERS threads (or coroutines) at once
+HOUSING_CURRENCY_MAX_WORKERS = 4
@@ -16,8 +16,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from api.views import MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('housing/', include('api.urls')),
+    path('metrics', MetricsView.as_view()),
 ]